@@ -0,0 +1,174 @@
+import asyncio
+import collections
+import concurrent.futures
+
+# drain returns once at most this many bytes are queued in the sliding window
+DRAIN_LOW_WATER = 1024
+
+
+# Runs a sliding window on an asyncio event loop. The ticks run in a worker
+# thread (the decoder and audio stream have their own threads already), and
+# the callbacks of the sliding window are passed back to the event loop. The
+# received data is available through an asyncio.StreamReader, data is send
+# through a LinkWriter.
+class AsyncLink:
+    def __init__(self, sliding_window, tick_interval=0.1):
+        self.__sliding_window = sliding_window
+        self.__tick_interval = tick_interval
+        self.__loop = asyncio.get_running_loop()
+        # a single worker, such that the ticks never run concurrently
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.__reader = asyncio.StreamReader()
+        self.__writer = LinkWriter(self)
+        self.__pending = collections.deque()
+        self.__ticked = asyncio.Event()
+        self.__sent = asyncio.Event()
+        self.__sent.set()
+        self.__task = None
+        # the exception raised by tick, the link does not run anymore
+        self.__exception = None
+
+        call_soon = self.__loop.call_soon_threadsafe
+        self.__sliding_window.attach_on_data_availbale(lambda: call_soon(self.__on_data_available))
+        self.__sliding_window.attach_on_send_complete(lambda: call_soon(self.__on_send_complete))
+
+
+    def __on_data_available(self):
+        data = self.__sliding_window.recv()
+        if data:
+            self.__reader.feed_data(data)
+
+
+    # the completion may have been scheduled before more data was written,
+    # hence the state is checked again on the event loop
+    def __on_send_complete(self):
+        if not self.__pending and self.__sliding_window.is_send_complete():
+            self.__sent.set()
+
+
+    # move data that did not fit in the send buffer of the sliding window
+    def __flush_pending(self):
+        while self.__pending:
+            if not self.__sliding_window.send(self.__pending[0]):
+                break
+            self.__pending.popleft()
+
+
+    async def __run(self):
+        while True:
+            try:
+                await self.__loop.run_in_executor(self.__executor, self.__sliding_window.tick)
+            except Exception as e:
+                # the readers and writers waiting for the link get the exception
+                print(f'Error in tick of the link: {e!r}')
+                self.__exception = e
+                self.__reader.set_exception(e)
+                self.__ticked.set()
+                self.__sent.set()
+                return
+            self.__flush_pending()
+
+            # wake up the tasks waiting in drain
+            self.__ticked.set()
+            self.__ticked.clear()
+            await asyncio.sleep(self.__tick_interval)
+
+
+    def start(self):
+        self.__task = self.__loop.create_task(self.__run())
+
+
+    def get_reader(self):
+        return self.__reader
+
+
+    def get_writer(self):
+        return self.__writer
+
+
+    def write(self, data):
+        self.__sent.clear()
+        self.__pending.append(data)
+        self.__flush_pending()
+
+
+    def __check_exception(self):
+        if self.__exception is not None:
+            raise self.__exception
+
+
+    async def drain(self):
+        self.__check_exception()
+        while self.__pending or self.__sliding_window.get_send_buffer_size() > DRAIN_LOW_WATER:
+            await self.__ticked.wait()
+            self.__check_exception()
+
+
+    async def wait_sent(self):
+        self.__check_exception()
+        # the data is not held back for more data to come (see SlidingWindow.flush)
+        self.__sliding_window.flush()
+        await self.__sent.wait()
+        self.__check_exception()
+
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+        await self.__loop.run_in_executor(self.__executor, self.__sliding_window.stop)
+        self.__executor.shutdown()
+        self.__reader.feed_eof()
+
+
+# writer side of an AsyncLink, similar to asyncio.StreamWriter
+class LinkWriter:
+    def __init__(self, link):
+        self.__link = link
+        self.__closing = None
+
+
+    # queue data, never blocks
+    def write(self, data):
+        self.__link.write(data)
+
+
+    # wait until the sliding window has room for more data
+    async def drain(self):
+        await self.__link.drain()
+
+
+    # wait until all data written so far has been acknowledged
+    async def wait_sent(self):
+        await self.__link.wait_sent()
+
+
+    def close(self):
+        if self.__closing is None:
+            self.__closing = asyncio.ensure_future(self.__link.stop())
+
+
+    def is_closing(self):
+        return self.__closing is not None
+
+
+    async def wait_closed(self):
+        await self.__closing
+
+
+# open a link, the SlidingWindow (which starts the audio stream) is created
+# in a worker thread. Returns (reader, writer).
+async def open_link(params, tick_interval=0.1):
+    from sliding_window import SlidingWindow
+
+    loop = asyncio.get_running_loop()
+    sliding_window = await loop.run_in_executor(None, SlidingWindow, params)
+    link = AsyncLink(sliding_window, tick_interval)
+    link.start()
+    return link.get_reader(), link.get_writer()
@@ -1,16 +1,22 @@
 import time
 import threading
 
-import sounddevice as sd
 import numpy as np
 
+from echo_canceller import EchoCanceller
 
 MAX_RECV_BUF_SIZE = 1024 * 1024 # 1 MiB
 
 
 class AudioStream(threading.Thread):
-    def __init__(self, params):
+    # the played and recorded frames are passed to recorder (a
+    # SessionRecorder) if given
+    def __init__(self, params, recorder=None):
         threading.Thread.__init__(self)
+        # sounddevice initializes PortAudio on import, only pay for this
+        # when an audio stream is actually opened
+        import sounddevice as sd
+
         sample_rate = params.get_sample_rate()
         block_size = sample_rate // 20
         #block_size = 0
@@ -22,6 +28,16 @@ class AudioStream(threading.Thread):
         self.__send_buf = np.empty((0,), dtype='float32')
         self.__recv_buf = np.empty((0,), dtype='float32')
         self.__is_dropping = False
+        self.__recorder = recorder
+
+        # the frames written to the stream are the reference of the echo
+        # canceller, a written frame is heard after the output latency
+        self.__echo_canceller = None
+        if params.get_echo_cancellation():
+            delay = round(self.__stream.latency[1] * sample_rate)
+            self.__echo_canceller = EchoCanceller(params, delay)
+            if self.__recorder is not None:
+                self.__recorder.set_echo_delay(delay)
 
 
     def run(self):
@@ -50,6 +66,10 @@ class AudioStream(threading.Thread):
                     np.zeros(nframes_zero, dtype='float32')])
                 self.__send_buf = self.__send_buf[nframes_buf:]
             self.__stream.write(frames)
+            if self.__echo_canceller is not None:
+                self.__echo_canceller.add_played(frames)
+            if self.__recorder is not None:
+                self.__recorder.add_played(frames)
 
             time.sleep(.01)
         self.__stream.stop()
@@ -70,5 +90,11 @@ class AudioStream(threading.Thread):
         with self.__lock:
             data = self.__recv_buf
             self.__recv_buf = np.empty((0,), dtype='float32')
+        # the recording contains the audio as it is captured, replaying it
+        # runs the echo canceller again
+        if self.__recorder is not None:
+            self.__recorder.add_recorded(data)
+        if self.__echo_canceller is not None:
+            data = self.__echo_canceller.process(data)
         return data
 
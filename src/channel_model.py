@@ -0,0 +1,396 @@
+import enum
+import threading
+import time
+
+import numpy as np
+
+from echo_canceller import EchoCanceller
+from message_protocol import MessageDecoder
+from message_protocol import MessageEncoder
+
+
+class NoiseColor(enum.Enum):
+    WHITE = 0
+    # power density falls 3 dB per octave
+    PINK = 1
+    # power density falls 6 dB per octave
+    BROWN = 2
+
+
+# Settings of a simulated audio channel, i.e., the room and hardware between
+# the speaker of one side and the microphone of the other side
+class ChannelParameters:
+    def __init__(self):
+        # snr (dB) of the complete band relative to the power of a transmitted
+        # message, None disables the noise. Note that the snr per channel is
+        # far higher, as a channel only picks up the noise in a narrow band.
+        self.__snr = None
+        self.__noise_color = NoiseColor.WHITE
+        # list of (delay (s), gain) of the reflections
+        self.__echoes = []
+        # (low, high) cutoff frequencies (Hz) of the speaker and microphone,
+        # None for an unlimited band
+        self.__band = None
+        # clock difference (ppm) of the sound cards of both sides
+        self.__clock_skew = 0.0
+        # (min, max) gain (dB), drawn for every block of audio
+        self.__gain_range = (0.0, 0.0)
+        # list of (delay (s), gain) of the paths from the speaker to the
+        # microphone of the same side, i.e., what a side hears of itself
+        self.__self_echoes = []
+
+
+    def set_snr(self, snr):
+        self.__snr = snr
+
+
+    def get_snr(self):
+        return self.__snr
+
+
+    def set_noise_color(self, noise_color):
+        self.__noise_color = noise_color
+
+
+    def get_noise_color(self):
+        return self.__noise_color
+
+
+    def set_echoes(self, echoes):
+        self.__echoes = list(echoes)
+
+
+    def get_echoes(self):
+        return self.__echoes
+
+
+    def set_band(self, band):
+        self.__band = band
+
+
+    def get_band(self):
+        return self.__band
+
+
+    def set_clock_skew(self, clock_skew):
+        self.__clock_skew = clock_skew
+
+
+    def get_clock_skew(self):
+        return self.__clock_skew
+
+
+    def set_gain_range(self, gain_range):
+        self.__gain_range = gain_range
+
+
+    def get_gain_range(self):
+        return self.__gain_range
+
+
+    def set_self_echoes(self, self_echoes):
+        self.__self_echoes = list(self_echoes)
+
+
+    def get_self_echoes(self):
+        return self.__self_echoes
+
+
+# windowed sinc band pass filter
+def band_filter(low, high, sample_rate, ntaps=255):
+    t = np.arange(ntaps) - (ntaps - 1) / 2
+    lowpass = lambda freq: 2 * freq / sample_rate * np.sinc(2 * freq / sample_rate * t)
+    return (lowpass(high) - lowpass(low)) * np.hamming(ntaps)
+
+
+# impulse response of the reflections, without the direct path
+def echo_taps(echoes, sample_rate):
+    if not echoes:
+        return np.zeros(1)
+    taps = np.zeros(1 + max(round(delay * sample_rate) for delay, _ in echoes))
+    for delay, gain in echoes:
+        taps[round(delay * sample_rate)] += gain
+    return taps
+
+
+# mean power of the audio while a message of maximal size is transmitted
+def signal_power(params):
+    encoder = MessageEncoder(params)
+    audio_data = encoder.encode(bytes(params.get_max_payload_size()))
+    return np.mean(audio_data**2)
+
+
+# noise with unit power, colored by shaping the spectrum of white noise
+def make_noise(rng, size, noise_color):
+    noise = rng.standard_normal(size)
+    if noise_color == NoiseColor.WHITE or size < 2:
+        return noise
+
+    spectrum = np.fft.rfft(noise)
+    freqs = np.arange(len(spectrum))
+    freqs[0] = 1
+    exponent = 0.5 if noise_color == NoiseColor.PINK else 1.0
+    noise = np.fft.irfft(spectrum / freqs**exponent, size)
+    return noise / np.sqrt(np.mean(noise**2))
+
+
+# Applies the impairments of a channel to the audio send by the side with
+# the given params. The model keeps the state of the filters and the
+# resampler, hence the audio has to be passed in order, in blocks of any size.
+class ChannelModel:
+    def __init__(self, params, channel_params, seed=None):
+        self.__channel_params = channel_params
+        self.__rng = np.random.default_rng(seed)
+        sample_rate = params.get_sample_rate()
+
+        snr = channel_params.get_snr()
+        self.__noise_std = 0.0
+        if snr is not None:
+            self.__noise_std = np.sqrt(signal_power(params) / 10**(snr / 10))
+
+        # the echoes and band limit are combined in a single impulse response
+        response = np.ones(1)
+        band = channel_params.get_band()
+        if band is not None:
+            response = band_filter(band[0], band[1], sample_rate)
+        echoes = channel_params.get_echoes()
+        if echoes:
+            taps = echo_taps(echoes, sample_rate)
+            taps[0] += 1.0
+            response = np.convolve(response, taps)
+        self.__response = response
+        self.__history = np.zeros(len(response) - 1)
+
+        # input samples per output sample, and the position of the next
+        # output sample in the samples that are not resampled yet
+        self.__ratio = 1.0 + channel_params.get_clock_skew() * 1e-6
+        self.__pending = np.empty((0,))
+        self.__position = 0.0
+
+
+    def __filter(self, frames):
+        data = np.hstack([self.__history, frames])
+        if len(self.__history):
+            self.__history = data[len(data) - len(self.__history):]
+        return np.convolve(data, self.__response, 'valid')
+
+
+    def __resample(self, frames):
+        if self.__ratio == 1.0:
+            return frames
+
+        self.__pending = np.hstack([self.__pending, frames])
+        count = int(np.ceil((len(self.__pending) - 1 - self.__position) / self.__ratio))
+        if count <= 0:
+            return np.empty((0,))
+        positions = self.__position + self.__ratio * np.arange(count)
+        resampled = np.interp(positions, np.arange(len(self.__pending)), self.__pending)
+
+        next_position = self.__position + self.__ratio * count
+        consumed = int(next_position)
+        self.__pending = self.__pending[consumed:]
+        self.__position = next_position - consumed
+        return resampled
+
+
+    def apply(self, frames):
+        if len(frames) == 0:
+            return np.empty((0,), dtype='float32')
+
+        low, high = self.__channel_params.get_gain_range()
+        gain = 10**(self.__rng.uniform(low, high) / 20)
+
+        audio_data = self.__resample(self.__filter(gain * np.asarray(frames, dtype='float64')))
+        if self.__noise_std > 0:
+            noise = make_noise(self.__rng, len(audio_data), self.__channel_params.get_noise_color())
+            audio_data = audio_data + self.__noise_std * noise
+        return audio_data.astype('float32')
+
+
+# Simulated audio stream with the interface of an AudioStream. The audio
+# played by the peer passes the channel model and is recorded in real time
+# (multiplied by speed), silence is recorded when the peer does not play.
+# The audio played by this side is heard through self_taps (see echo_taps),
+# and removed again by the echo canceller if given.
+class SimulatedStream:
+    def __init__(self, sample_rate, channel_model, speed=1.0, self_taps=None, echo_canceller=None):
+        self.__sample_rate = sample_rate
+        self.__channel_model = channel_model
+        self.__speed = speed
+        self.__peer = None
+        self.__lock = threading.Lock()
+        # audio played by the peer that did not pass the channel yet
+        self.__incoming = np.empty((0,), dtype='float32')
+        self.__start = None
+        self.__recorded = 0
+
+        # audio played by this side that is not played yet, and the state of
+        # the path from the speaker to the microphone
+        self.__outgoing = np.empty((0,), dtype='float32')
+        self.__self_taps = self_taps
+        self.__self_history = np.zeros(0 if self_taps is None else len(self_taps) - 1)
+        self.__echo_canceller = echo_canceller
+
+
+    def set_peer(self, peer):
+        self.__peer = peer
+
+
+    def __deliver(self, frames):
+        with self.__lock:
+            self.__incoming = np.hstack([self.__incoming, frames])
+
+
+    def start(self):
+        self.__start = time.monotonic()
+
+
+    def stop(self):
+        pass
+
+
+    # simulated time (s) since the stream started, i.e., real time multiplied by speed
+    def get_time(self):
+        if self.__start is None:
+            self.start()
+        return (time.monotonic() - self.__start) * self.__speed
+
+
+    def play(self, frames):
+        self.__peer.__deliver(frames)
+        if self.__self_taps is not None or self.__echo_canceller is not None:
+            with self.__lock:
+                self.__outgoing = np.hstack([self.__outgoing, frames])
+
+
+    # the audio this side plays while nframes are recorded
+    def __take_outgoing(self, nframes):
+        with self.__lock:
+            frames = self.__outgoing[:nframes]
+            self.__outgoing = self.__outgoing[nframes:]
+        return np.hstack([frames, np.zeros(nframes - len(frames), dtype='float32')])
+
+
+    def record(self):
+        if self.__start is None:
+            self.start()
+
+        nframes = int(self.get_time() * self.__sample_rate) - self.__recorded
+        self.__recorded += nframes
+        with self.__lock:
+            frames = self.__incoming[:nframes]
+            self.__incoming = self.__incoming[nframes:]
+        frames = np.hstack([frames, np.zeros(nframes - len(frames), dtype='float32')])
+        recorded = self.__channel_model.apply(frames)
+        if self.__self_taps is None and self.__echo_canceller is None:
+            return recorded
+
+        # with clock skew the peer is not recorded at the same rate as this
+        # side plays, the own audio is cut to the recorded length
+        played = self.__take_outgoing(nframes)[:len(recorded)]
+        played = np.hstack([played, np.zeros(len(recorded) - len(played), dtype='float32')])
+        if self.__self_taps is not None and len(played):
+            data = np.hstack([self.__self_history, played])
+            if len(self.__self_history):
+                self.__self_history = data[len(data) - len(self.__self_history):]
+            recorded = recorded + np.convolve(data, self.__self_taps, 'valid').astype('float32')
+        if self.__echo_canceller is not None:
+            self.__echo_canceller.add_played(played)
+            recorded = self.__echo_canceller.process(recorded)
+        return recorded
+
+
+# returns the (master, slave) streams of a simulated link, the channel is the
+# same in both directions
+def make_loopback(params_master, params_slave, channel_params, speed=1.0, seed=None):
+    rng = np.random.default_rng(seed)
+    sample_rate = params_master.get_sample_rate()
+    to_master = ChannelModel(params_slave, channel_params, rng.integers(2**32))
+    to_slave = ChannelModel(params_master, channel_params, rng.integers(2**32))
+
+    self_taps = None
+    if channel_params.get_self_echoes():
+        self_taps = echo_taps(channel_params.get_self_echoes(), sample_rate)
+    streams = []
+    for params, channel_model in [(params_master, to_master), (params_slave, to_slave)]:
+        echo_canceller = EchoCanceller(params) if params.get_echo_cancellation() else None
+        streams.append(SimulatedStream(sample_rate, channel_model, speed, self_taps, echo_canceller))
+    stream_master, stream_slave = streams
+    stream_master.set_peer(stream_slave)
+    stream_slave.set_peer(stream_master)
+    return stream_master, stream_slave
+
+
+# sends nframes messages of maximal size from the side with params_send to
+# the side with params_recv, returns the fraction of messages that is lost
+def frame_error_rate(params_send, params_recv, channel_params, nframes=20, seed=None):
+    rng = np.random.default_rng(seed)
+    channel_model = ChannelModel(params_send, channel_params, rng.integers(2**32))
+    encoder = MessageEncoder(params_send)
+    decoder = MessageDecoder(params_recv)
+    decoder.start()
+
+    # leave a gap between the messages, and enough audio at the end for the
+    # decoder to wait for a message of maximal size
+    max_payload_size = params_send.get_max_payload_size()
+    gap = np.zeros(params_send.get_window_size() * 4, dtype='float32')
+    tail = np.zeros(len(encoder.encode(bytes(max_payload_size))), dtype='float32')
+
+    messages = [rng.bytes(max_payload_size) for _ in range(nframes)]
+    decoder.add_frames(channel_model.apply(gap))
+    for message in messages:
+        decoder.add_frames(channel_model.apply(encoder.encode(message)))
+        decoder.add_frames(channel_model.apply(gap))
+    decoder.add_frames(channel_model.apply(tail))
+    decoder.wait_idle()
+    decoder.stop()
+
+    received = decoder.get_messages()
+    errors = sum(message not in received for message in messages)
+    return errors / nframes
+
+
+# transfers nbytes from the master to the slave over a pair of sliding
+# windows, returns the goodput (bytes/s of simulated time), 0 if the transfer
+# did not complete within timeout (s of real time)
+def measure_goodput(params_master, params_slave, channel_params, nbytes=64, speed=10.0,
+        timeout=120.0, seed=None):
+    from sliding_window import SlidingWindow
+
+    stream_master, stream_slave = make_loopback(params_master, params_slave,
+            channel_params, speed, seed)
+    # the timeouts of the sliding windows run at the simulated speed as well
+    master = SlidingWindow(params_master, stream_master, clock=stream_master.get_time)
+    slave = SlidingWindow(params_slave, stream_slave, clock=stream_slave.get_time)
+
+    data = np.random.default_rng(seed).bytes(nbytes)
+    received = bytearray()
+    start = stream_master.get_time()
+    master.send(data)
+    while len(received) < nbytes and stream_master.get_time() - start < timeout * speed:
+        master.tick()
+        slave.tick()
+        received += slave.recv()
+        time.sleep(0.01)
+    elapsed = stream_master.get_time() - start
+
+    master.stop()
+    slave.stop()
+    if bytes(received) != data:
+        return 0.0
+    return nbytes / elapsed
+
+
+# frame error rate and goodput (bytes/s) at every snr (dB), the other
+# impairments are taken from channel_params. Returns a list of (snr, fer, goodput).
+def snr_sweep(params_master, params_slave, channel_params, snrs, nframes=20,
+        nbytes=64, speed=10.0, seed=None):
+    results = []
+    for snr in snrs:
+        channel_params.set_snr(snr)
+        fer = frame_error_rate(params_master, params_slave, channel_params, nframes, seed)
+        goodput = measure_goodput(params_master, params_slave, channel_params, nbytes,
+                speed, seed=seed)
+        print(f'snr {snr} dB: frame error rate {fer:.2f}, goodput {goodput:.1f} B/s')
+        results.append((snr, fer, goodput))
+    return results
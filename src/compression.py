@@ -0,0 +1,42 @@
+import zlib
+
+# preset dictionary shared by both sides of the link, the compressor can refer
+# to these strings from the first byte on. zlib favours the end of the
+# dictionary, hence the most common strings are at the end.
+DICTIONARY = (
+    b'Traceback (most recent call last):  File  line  in  Exception Error: '
+    b'DEBUG INFO WARNING ERROR CRITICAL  [DEBUG] [INFO] [WARNING] [ERROR] '
+    b'https://www. http:// .com .org .net  localhost 127.0.0.1 '
+    b'000 001 100 200 2020- 2021- 2022- 2023- 2024- 2025- 2026- T00:00:00Z '
+    b'status message error result value count name type data time date id '
+    b'{"id": {"name": {"type": {"data": {"value": "status": "message": '
+    b'null, true, false, ", "": [], {}, }, ], "\n'
+    b'the of and to in is it you that was for on are with as have be at this '
+    b'The And To In Is It You That This What Hello hello Hi hi OK ok yes no \n'
+)
+
+
+# Compresses a byte stream, every call of compress returns all data needed to
+# decompress the data passed so far (i.e., the stream is flushed at the end
+# of every message)
+class StreamCompressor:
+    def __init__(self):
+        # raw deflate, the zlib header and checksum are not needed as the
+        # frames have their own redundancy check
+        self.__compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS,
+                zdict=DICTIONARY)
+
+
+    def compress(self, data):
+        return self.__compressor.compress(data) + self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class StreamDecompressor:
+    def __init__(self):
+        self.__decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DICTIONARY)
+
+
+    # data can be split at arbitrary positions, returns the bytes that can be
+    # decompressed so far
+    def decompress(self, data):
+        return self.__decompressor.decompress(data)
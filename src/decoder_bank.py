@@ -0,0 +1,192 @@
+import threading
+
+import numpy as np
+
+from message_protocol import decode_message
+from message_protocol import detect_start_seq
+from message_protocol import MessageQueue
+from transmission_parameters import FrequencySet
+from transmission_parameters import Preamble
+
+# number of spectrum rows per window, i.e., the step size of the start
+# sequence search is a quarter of a window as in the MessageDecoder
+HOPS_PER_WINDOW = 4
+
+
+# Decodes the messages of multiple peers from a single audio stream. Every
+# peer has its own frequency plan (the parameters as seen from this side of
+# the link), the RECV frequencies of all plans are demodulated at once and
+# the resulting spectrum is shared by the per plan start sequence search and
+# message decoding.
+class DecoderBank(threading.Thread):
+    def __init__(self, plans):
+        threading.Thread.__init__(self)
+        self.__running = True
+
+        self.__plans = [params.snapshot() for params in plans]
+        plans = self.__plans
+        self.__buffer = np.empty((0,), dtype='float32')
+        self.__buffer_lock = threading.Condition()
+        self.__messages = [MessageQueue() for _ in plans]
+
+        # the plans can only share the spectrum if the windows line up
+        self.__window_size = plans[0].get_window_size()
+        sample_rate = plans[0].get_sample_rate()
+        for params in plans:
+            assert params.get_window_size() == self.__window_size
+            assert params.get_sample_rate() == sample_rate
+            assert params.get_analysis_window() == plans[0].get_analysis_window()
+            assert params.get_symbol_ramp() == plans[0].get_symbol_ramp()
+            # the chirp is not part of the shared spectrum
+            assert params.get_preamble() != Preamble.CHIRP
+
+        # column of every RECV channel of a plan in the combined spectrum
+        frequencies = []
+        self.__columns = []
+        for params in plans:
+            plan_frequencies = list(params.get_frequencies(FrequencySet.RECV))
+            self.__columns.append(np.arange(len(plan_frequencies)) + len(frequencies))
+            frequencies += plan_frequencies
+        # plans that share a frequency would decode each others messages
+        assert len(np.unique(frequencies)) == len(frequencies)
+
+        window = plans[0].get_integration_window()
+        t = np.arange(self.__window_size) / sample_rate
+        self.__basis = window[:, np.newaxis] * np.exp(-2j * np.pi * np.outer(t, frequencies))
+
+        # audio that is not demodulated yet, starting at sample __sample_offset
+        self.__samples = np.empty((0,), dtype='float32')
+        self.__sample_offset = 0
+        # magnitudes of every hop (rows) and frequency (columns), starting at
+        # hop __hop_offset. Hop h starts at sample h * window_size // HOPS_PER_WINDOW,
+        # hence hop h + HOPS_PER_WINDOW * k starts exactly k windows later.
+        self.__spectrum = np.empty((0, len(frequencies)))
+        self.__hop_offset = 0
+        self.__cursors = len(plans) * [0]
+
+
+    def __hop_start(self, hop):
+        return hop * self.__window_size // HOPS_PER_WINDOW
+
+
+    def __demodulate(self, new_data):
+        self.__samples = np.hstack([self.__samples, new_data])
+        end = self.__sample_offset + len(self.__samples)
+
+        first = self.__hop_offset + len(self.__spectrum)
+        last = first
+        while self.__hop_start(last) + self.__window_size <= end:
+            last += 1
+        if last == first:
+            return
+
+        starts = np.array([self.__hop_start(hop) for hop in range(first, last)]) - self.__sample_offset
+        windows = self.__samples[starts[:, np.newaxis] + np.arange(self.__window_size)]
+        self.__spectrum = np.vstack([self.__spectrum, np.abs(windows @ self.__basis)])
+
+        # drop the audio that is no longer needed for the next hop
+        drop = self.__hop_start(last) - self.__sample_offset
+        self.__samples = self.__samples[drop:]
+        self.__sample_offset += drop
+
+
+    def __process_plan(self, plan):
+        params = self.__plans[plan]
+        columns = self.__columns[plan]
+        max_windows = params.get_message_windows(params.get_max_payload_size(), FrequencySet.RECV)
+        max_rows = HOPS_PER_WINDOW * (max_windows - 1) + 1
+        start_seq_rows = HOPS_PER_WINDOW * np.arange(len(params.get_start_seq()))
+
+        cursor = self.__cursors[plan]
+        end = self.__hop_offset + len(self.__spectrum)
+        while cursor + max_rows <= end:
+            row = cursor - self.__hop_offset
+            if detect_start_seq(params, self.__spectrum[np.ix_(row + start_seq_rows, columns)].T):
+                rows = row + HOPS_PER_WINDOW * np.arange(max_windows)
+                fbin_data_ch = [self.__spectrum[rows, column] for column in columns]
+                message = decode_message(params, fbin_data_ch)
+                if message is not None:
+                    print(f'recved from peer {plan}: {message}')
+                    self.__messages[plan].put(message)
+                    cursor += HOPS_PER_WINDOW * params.get_message_windows(len(message), FrequencySet.RECV)
+                    continue
+            cursor += 1
+        self.__cursors[plan] = cursor
+
+
+    # block until either 1) data is received or when the thread is stopped
+    def __wait_for_data(self):
+        new_data = np.empty((0,), dtype='float32')
+        with self.__buffer_lock:
+            while len(self.__buffer) == 0:
+                self.__buffer_lock.wait()
+                if not self.__running:
+                    return new_data
+            new_data = self.__buffer
+            self.__buffer = np.empty((0,), dtype='float32')
+        return new_data
+
+
+    def run(self):
+        while self.__running:
+            new_data = self.__wait_for_data()
+            self.__demodulate(new_data)
+
+            for plan, _ in enumerate(self.__plans):
+                self.__process_plan(plan)
+
+            # drop the rows every plan has moved past
+            processed = min(self.__cursors) - self.__hop_offset
+            self.__spectrum = self.__spectrum[processed:]
+            self.__hop_offset += processed
+
+
+    def add_frames(self, frames):
+        with self.__buffer_lock:
+            self.__buffer = np.hstack([self.__buffer, frames])
+            self.__buffer_lock.notify()
+
+
+    # see MessageQueue.get_message
+    def get_message(self, plan, block=False, timeout=None):
+        return self.__messages[plan].get_message(block, timeout)
+
+
+    # see MessageQueue.get_messages
+    def get_messages(self, plan, max_n=None, block=False, timeout=None):
+        return self.__messages[plan].get_messages(max_n, block, timeout)
+
+
+    def get_dropped(self, plan):
+        return self.__messages[plan].get_dropped()
+
+
+    # decoder like view on the messages of a single plan, this can be passed
+    # to a SlidingWindow instead of a MessageDecoder
+    def get_decoder(self, plan):
+        return PlanDecoder(self, plan)
+
+
+    def stop(self):
+        self.__running = False
+        with self.__buffer_lock:
+            self.__buffer_lock.notify()
+        self.join()
+
+
+class PlanDecoder:
+    def __init__(self, decoder_bank, plan):
+        self.__decoder_bank = decoder_bank
+        self.__plan = plan
+
+
+    def get_message(self, block=False, timeout=None):
+        return self.__decoder_bank.get_message(self.__plan, block, timeout)
+
+
+    def get_messages(self, max_n=None, block=False, timeout=None):
+        return self.__decoder_bank.get_messages(self.__plan, max_n, block, timeout)
+
+
+    def get_dropped(self):
+        return self.__decoder_bank.get_dropped(self.__plan)
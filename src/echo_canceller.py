@@ -0,0 +1,171 @@
+import threading
+
+import numpy as np
+
+from transmission_parameters import FrequencySet
+
+# length (s) of the echo path that is modelled, i.e., the delay of the last
+# reflection after the bulk delay
+ECHO_TAIL = 0.04
+# step size of the adaptive filter, in (0, 1]. A small step converges slower
+# but is less disturbed by the remote side (double talk).
+ECHO_STEP_SIZE = 0.3
+# smoothing of the power estimate used to normalize the step size
+ECHO_SMOOTHING = 0.9
+# the filter only adapts when the local speaker plays at least this rms level,
+# there is nothing to learn from silence
+ECHO_MIN_LEVEL = 1e-3
+# regularization of the normalization, relative to the mean power
+ECHO_REGULARIZATION = 1e-3
+# smoothing (per block) of the mean of every carrier. The remote side uses
+# the same carriers and on/off keying, i.e., the local and the remote audio
+# are correlated through the mean of their carriers. The filter adapts to
+# the audio without these means, which leaves the (uncorrelated) keying.
+CARRIER_SMOOTHING = 0.7
+# the remote side is heard when a channel that is not played locally has
+# more than DOUBLE_TALK_RATIO of the power of the played channels
+DOUBLE_TALK_RATIO = 0.1
+# a channel is played when it has this fraction of the power of the loudest
+ECHO_ON_LEVEL = 0.01
+# step size during double talk
+ECHO_DOUBLE_TALK_STEP_SIZE = 0.03
+# blocks the step size stays small after double talk was detected
+DOUBLE_TALK_HANG = 16
+
+
+# Removes the slowly changing mean of the carriers from blocks of audio,
+# i.e., a narrow notch filter at every frequency.
+class CarrierNotch:
+    def __init__(self, frequencies, block_size, sample_rate):
+        t = np.arange(block_size) / sample_rate
+        self.__tones = np.exp(-2j * np.pi * np.outer(t, frequencies))
+        # phase of the carriers at the start of the next block
+        self.__rotation = np.exp(-2j * np.pi * frequencies * block_size / sample_rate)
+        self.__phase = np.ones(len(frequencies), dtype='complex128')
+        self.__means = np.zeros(len(frequencies), dtype='complex128')
+
+
+    # returns the block without the means and the (complex) amplitudes of
+    # the carriers in the block
+    def process(self, block):
+        amplitudes = 2 * (block @ self.__tones) / len(block)
+        self.__means = CARRIER_SMOOTHING * self.__means + (1 - CARRIER_SMOOTHING) * amplitudes * self.__phase
+        carriers = np.real(np.conj(self.__tones) @ (self.__means * np.conj(self.__phase)))
+        self.__phase *= self.__rotation
+        return block - carriers, amplitudes
+
+
+# Removes the echo of the local speaker from the recorded audio. The played
+# audio is the reference, it is passed to add_played in the order it is
+# played. The echo path is modelled by a frequency domain (block) NLMS
+# filter. delay (samples) is the expected delay of the echo (e.g., the output
+# latency of the sound card), the reference is aligned such that the filter
+# also covers an echo that arrives a quarter of a block earlier. Audio is
+# processed in blocks, process returns the cleaned audio of all complete blocks.
+class EchoCanceller:
+    def __init__(self, params, delay=0):
+        sample_rate = params.get_sample_rate()
+
+        # block size and number of taps, the filter uses FFTs of twice this size
+        self.__block_size = 1 << (round(ECHO_TAIL * sample_rate) - 1).bit_length()
+        nbins = self.__block_size + 1
+        self.__weights = np.zeros(nbins, dtype='complex128')
+        # smoothed power of the reference, None until something is played
+        self.__power = None
+        self.__previous = np.zeros(self.__block_size)
+
+        # the channels of the remote side
+        frequencies = params.get_frequencies(FrequencySet.RECV)
+        self.__reference_notch = CarrierNotch(frequencies, self.__block_size, sample_rate)
+        self.__recorded_notch = CarrierNotch(frequencies, self.__block_size, sample_rate)
+        self.__previous_notched = np.zeros(self.__block_size)
+        self.__previous_played = np.zeros(len(frequencies))
+        self.__hang = 0
+
+        # the reference (playback ring buffer) is written by the audio thread
+        self.__lock = threading.Lock()
+        self.__reference = np.zeros(max(0, delay - self.__block_size // 4), dtype='float32')
+        self.__pending = np.empty((0,), dtype='float32')
+
+
+    def add_played(self, frames):
+        with self.__lock:
+            self.__reference = np.hstack([self.__reference, frames])
+
+
+    # take the reference of the next size recorded samples, silence if
+    # nothing has been played
+    def __take_reference(self, size):
+        with self.__lock:
+            reference = self.__reference[:size]
+            self.__reference = self.__reference[size:]
+        return np.hstack([reference, np.zeros(size - len(reference), dtype='float32')])
+
+
+    # channels that are silent locally (in this and the previous block) can
+    # only contain the remote side, undecided while all channels are played
+    def __is_double_talk(self, played, heard):
+        played = played**2
+        heard = np.abs(heard)**2
+        is_on = played >= ECHO_ON_LEVEL * np.max(played)
+        if np.all(is_on):
+            return self.__hang > 0
+
+        if np.max(heard[~is_on]) > DOUBLE_TALK_RATIO * np.mean(heard[is_on]):
+            self.__hang = DOUBLE_TALK_HANG
+        else:
+            self.__hang = max(0, self.__hang - 1)
+        return self.__hang > 0
+
+
+    def __process_block(self, reference, recorded):
+        size = self.__block_size
+        spectrum = np.fft.rfft(np.hstack([self.__previous, reference]))
+        self.__previous = reference
+
+        # overlap save, the second half is the linear convolution
+        echo = np.fft.irfft(spectrum * self.__weights)[size:]
+        error = recorded - echo
+
+        # the filter adapts to the audio without the means of the carriers
+        notched, played = self.__reference_notch.process(reference)
+        notched_recorded, heard = self.__recorded_notch.process(recorded)
+        notched_spectrum = np.fft.rfft(np.hstack([self.__previous_notched, notched]))
+        self.__previous_notched = notched
+        # the echo of a carrier of the previous block is still heard
+        played, self.__previous_played = np.maximum(np.abs(played), np.abs(self.__previous_played)), played
+
+        if np.sqrt(np.mean(reference**2)) < ECHO_MIN_LEVEL:
+            return error
+        step_size = ECHO_STEP_SIZE
+        if self.__is_double_talk(played, heard):
+            step_size = ECHO_DOUBLE_TALK_STEP_SIZE
+
+        power = np.abs(notched_spectrum)**2
+        if self.__power is None:
+            self.__power = power
+        # a bin that was silent for a while must not get a large step
+        self.__power = np.maximum(ECHO_SMOOTHING * self.__power + (1 - ECHO_SMOOTHING) * power, power)
+        regularization = ECHO_REGULARIZATION * np.mean(self.__power) + 1e-12
+
+        error_spectrum = np.fft.rfft(np.hstack([np.zeros(size), error]))
+        gradient = np.conj(notched_spectrum) * error_spectrum / (self.__power + regularization)
+        # constrain the filter to size taps (i.e., no circular convolution)
+        gradient = np.fft.irfft(gradient)[:size]
+        self.__weights += step_size * np.fft.rfft(np.hstack([gradient, np.zeros(size)]))
+        return error
+
+
+    # returns the recorded audio without the echo, delayed by less than a block
+    def process(self, frames):
+        data = np.hstack([self.__pending, frames])
+        nblocks = len(data) // self.__block_size
+        self.__pending = data[nblocks * self.__block_size:]
+
+        output = []
+        for block in data[:nblocks * self.__block_size].reshape((nblocks, self.__block_size)):
+            reference = self.__take_reference(self.__block_size).astype('float64')
+            output.append(self.__process_block(reference, block.astype('float64')))
+        if not output:
+            return np.empty((0,), dtype='float32')
+        return np.hstack(output).astype('float32')
@@ -0,0 +1,263 @@
+import mmap
+import os
+import zlib
+
+# size of the chunks a file is split into, every chunk has its own checksum
+# in the manifest
+CHUNK_SIZE = 1024
+# number of chunks the sender keeps queued in the sliding window
+SEND_AHEAD = 4
+
+# the records exchanged over the sliding window, every record starts with a
+# 1 byte type and a 4 byte length of the body
+MANIFEST = 0x4d
+RESUME = 0x52
+CHUNK = 0x43
+COMPLETE = 0x44
+RECORD_HEADER_SIZE = 5
+
+
+def record_header(record_type, length):
+    return bytes([record_type]) + length.to_bytes(4, 'big')
+
+
+def encode_manifest(name, size, chunk_size, checksums):
+    name = name.encode('utf-8')
+    body = len(name).to_bytes(2, 'big') + name
+    body += size.to_bytes(8, 'big') + chunk_size.to_bytes(4, 'big')
+    body += b''.join(checksum.to_bytes(4, 'big') for checksum in checksums)
+    return record_header(MANIFEST, len(body)) + body
+
+
+# returns (name, size, chunk_size, checksums)
+def decode_manifest(body):
+    name_size = int.from_bytes(body[0:2], 'big')
+    name = body[2:2 + name_size].decode('utf-8')
+    cursor = 2 + name_size
+    size = int.from_bytes(body[cursor:cursor + 8], 'big')
+    chunk_size = int.from_bytes(body[cursor + 8:cursor + 12], 'big')
+    cursor += 12
+    checksums = [int.from_bytes(body[i:i + 4], 'big') for i in range(cursor, len(body), 4)]
+    return name, size, chunk_size, checksums
+
+
+# splits the received byte stream into records
+class RecordReader:
+    def __init__(self):
+        self.__buffer = bytearray()
+
+
+    def feed(self, data):
+        self.__buffer += data
+
+
+    # returns a list of (type, body) of the records that are complete
+    def records(self):
+        records = []
+        while len(self.__buffer) >= RECORD_HEADER_SIZE:
+            length = int.from_bytes(self.__buffer[1:RECORD_HEADER_SIZE], 'big')
+            if len(self.__buffer) < RECORD_HEADER_SIZE + length:
+                break
+            record_type = self.__buffer[0]
+            records.append((record_type, bytes(self.__buffer[RECORD_HEADER_SIZE:RECORD_HEADER_SIZE + length])))
+            del self.__buffer[:RECORD_HEADER_SIZE + length]
+        return records
+
+
+# Sends a file over a sliding window. The file is memory mapped and the
+# chunks are queued in the sliding window as the window advances, hence only
+# a few chunks are in memory at a time. The receiver answers the manifest with
+# the offset it already has, so a restarted transfer continues where the
+# previous one stopped.
+#
+# Like the sliding window, this object is polling based, call tick after
+# every tick of the sliding window.
+class FileSender:
+    def __init__(self, sliding_window, path, chunk_size=CHUNK_SIZE):
+        self.__sliding_window = sliding_window
+        self.__reader = RecordReader()
+        self.__chunk_size = chunk_size
+        self.__offset = None
+        self.__done = False
+        # records (or parts of) the sliding window did not accept yet, they
+        # are sent in order such that the record stream stays intact
+        self.__pending = []
+
+        self.__file = open(path, 'rb')
+        self.__size = os.fstat(self.__file.fileno()).st_size
+        self.__mmap = None
+        self.__view = memoryview(b'')
+        if self.__size > 0:
+            self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__view = memoryview(self.__mmap)
+
+        checksums = []
+        for offset in range(0, self.__size, chunk_size):
+            checksums.append(zlib.crc32(self.__view[offset:offset + chunk_size]))
+        name = os.path.basename(path)
+        self.__pending.append(encode_manifest(name, self.__size, chunk_size, checksums))
+        self.__send_pending()
+
+
+    # returns True if all pending data has been accepted
+    def __send_pending(self):
+        while self.__pending:
+            if not self.__sliding_window.send(self.__pending[0]):
+                return False
+            self.__pending.pop(0)
+        return True
+
+
+    def tick(self):
+        if self.__done:
+            return
+        if not self.__send_pending():
+            return
+
+        self.__reader.feed(self.__sliding_window.recv())
+        for record_type, body in self.__reader.records():
+            if record_type == RESUME:
+                self.__offset = int.from_bytes(body, 'big')
+                print(f'file transfer resumes at offset {self.__offset}')
+            elif record_type == COMPLETE:
+                self.__done = True
+                return
+
+        if self.__offset is None:
+            # wait for the receiver to tell where to start
+            return
+
+        # the sliding window keeps a reference to the mapped memory, the
+        # data is only copied when it is put in a frame
+        while self.__offset < self.__size and \
+                self.__sliding_window.get_send_buffer_size() < SEND_AHEAD * self.__chunk_size:
+            length = min(self.__chunk_size, self.__size - self.__offset)
+            header = record_header(CHUNK, 8 + length) + self.__offset.to_bytes(8, 'big')
+            self.__pending += [header, self.__view[self.__offset:self.__offset + length]]
+            self.__offset += length
+            if not self.__send_pending():
+                break
+
+
+    # the receiver has verified the complete file
+    def is_done(self):
+        return self.__done
+
+
+    # returns (bytes queued, file size)
+    def get_progress(self):
+        return (self.__offset or 0, self.__size)
+
+
+    def close(self):
+        self.__view.release()
+        if self.__mmap:
+            try:
+                self.__mmap.close()
+            except BufferError:
+                # the send buffer of the sliding window still refers to the
+                # mapped memory, it is unmapped once those are released
+                pass
+        self.__file.close()
+
+
+class FileReceiver:
+    def __init__(self, sliding_window, path):
+        self.__sliding_window = sliding_window
+        self.__reader = RecordReader()
+        self.__path = path
+        self.__file = None
+        self.__size = 0
+        self.__chunk_size = CHUNK_SIZE
+        self.__checksums = []
+        self.__offset = 0
+        self.__done = False
+        self.__failed = False
+
+
+    # the first part of the file that matches the checksums in the manifest,
+    # i.e., the chunks delivered by a previous transfer
+    def __verified_offset(self):
+        offset = 0
+        for checksum in self.__checksums:
+            self.__file.seek(offset)
+            chunk = self.__file.read(self.__chunk_size)
+            if zlib.crc32(chunk) != checksum:
+                break
+            offset += len(chunk)
+        return offset
+
+
+    def __complete(self):
+        self.__file.flush()
+        self.__sliding_window.send(record_header(COMPLETE, 0))
+        self.__done = True
+        print(f'file transfer of {self.__path} complete')
+
+
+    def __process_manifest(self, body):
+        name, self.__size, self.__chunk_size, self.__checksums = decode_manifest(body)
+        print(f'receiving {name} ({self.__size} bytes) into {self.__path}')
+
+        if self.__file is None:
+            mode = 'r+b' if os.path.exists(self.__path) else 'w+b'
+            self.__file = open(self.__path, mode)
+        # the file is sparse, the chunks are written at their offset
+        self.__file.truncate(self.__size)
+
+        self.__offset = self.__verified_offset()
+        self.__sliding_window.send(record_header(RESUME, 8) + self.__offset.to_bytes(8, 'big'))
+        if self.__offset == self.__size:
+            self.__complete()
+
+
+    def __process_chunk(self, body):
+        offset = int.from_bytes(body[0:8], 'big')
+        data = body[8:]
+
+        # a chunk at another offset or with another checksum than announced,
+        # e.g., the source file changed during the transfer
+        index = offset // self.__chunk_size
+        if offset != self.__offset or offset >= self.__size or index >= len(self.__checksums) or \
+                zlib.crc32(data) != self.__checksums[index]:
+            print(f'file transfer failed, invalid chunk at offset {offset}')
+            self.__failed = True
+            return
+
+        self.__file.seek(offset)
+        self.__file.write(data)
+        self.__offset += len(data)
+        if self.__offset == self.__size:
+            self.__complete()
+
+
+    def tick(self):
+        if self.__done or self.__failed:
+            return
+
+        self.__reader.feed(self.__sliding_window.recv())
+        for record_type, body in self.__reader.records():
+            if record_type == MANIFEST:
+                self.__process_manifest(body)
+            elif record_type == CHUNK and self.__file is not None:
+                self.__process_chunk(body)
+            if self.__done or self.__failed:
+                return
+
+
+    def is_done(self):
+        return self.__done
+
+
+    def has_failed(self):
+        return self.__failed
+
+
+    # returns (bytes written, file size)
+    def get_progress(self):
+        return (self.__offset, self.__size)
+
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
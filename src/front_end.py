@@ -0,0 +1,118 @@
+import numpy as np
+
+from transmission_parameters import FrequencySet
+from transmission_parameters import Preamble
+
+# the decimated sample rate is at least this factor above the width of the
+# RECV band (including the guard at both sides)
+OVERSAMPLING = 1.25
+# filter taps per unit of decimation
+TAPS_PER_DECIMATION = 8
+
+
+# (low, high) frequency of the RECV band, i.e., of the channels and the chirp
+def pass_band(params):
+    frequencies = params.get_frequencies(FrequencySet.RECV)
+    low = np.min(frequencies)
+    high = np.max(frequencies)
+    if params.get_preamble() == Preamble.CHIRP:
+        chirp_low, chirp_high = params.get_chirp_band(FrequencySet.RECV)
+        low = min(low, chirp_low)
+        high = max(high, chirp_high)
+    return low, high
+
+
+# largest factor that divides the window size and keeps the RECV band,
+# including a guard of two Fourier bins at both sides, below the new rate
+def decimation_factor(params):
+    sample_rate = params.get_sample_rate()
+    window_size = params.get_window_size()
+
+    low, high = pass_band(params)
+    guard = 2 * sample_rate / window_size
+    span = high - low + 2 * guard
+    factor = 1
+    for candidate in range(1, window_size + 1):
+        if sample_rate / candidate < OVERSAMPLING * span:
+            break
+        if window_size % candidate == 0:
+            factor = candidate
+    return factor
+
+
+# Mixes the RECV band down to baseband (complex), low pass filters and
+# decimates the audio. The decoder then works on window_size / factor samples
+# per window, with a basis at the lower rate (get_basis). The state of the
+# filter and mixer is kept between blocks, hence the audio has to be passed
+# in order, in blocks of any size.
+class FrontEnd:
+    def __init__(self, params):
+        frequencies = params.get_frequencies(FrequencySet.RECV)
+        sample_rate = params.get_sample_rate()
+        window_size = params.get_window_size()
+
+        self.__factor = decimation_factor(params)
+        low, high = pass_band(params)
+        self.__center = (low + high) / 2
+
+        # windowed sinc low pass, shifted up to the RECV band such that the
+        # filter can run on the real input and only the decimated samples
+        # have to be mixed down
+        ntaps = TAPS_PER_DECIMATION * self.__factor
+        cutoff = (high - low) / 2 + 2 * sample_rate / window_size
+        k = np.arange(ntaps)
+        lowpass = 2 * cutoff / sample_rate * np.sinc(2 * cutoff / sample_rate * (k - (ntaps - 1) / 2))
+        lowpass *= np.hamming(ntaps)
+        bandpass = lowpass * np.exp(2j * np.pi * self.__center * k / sample_rate)
+        # the filter is applied per block of factor input samples (polyphase),
+        # taps[i] holds the real and imaginary taps for the i-th block of the
+        # input, oldest first. The output of a block is taken at its last sample.
+        reversed_taps = bandpass[::-1].reshape((TAPS_PER_DECIMATION, self.__factor))
+        self.__taps = np.stack([reversed_taps.real, reversed_taps.imag], axis=2).astype('float32')
+        # cycles of the mixer per input sample
+        self.__mixer_rate = self.__center / sample_rate
+
+        self.__history = np.zeros((TAPS_PER_DECIMATION - 1, self.__factor), dtype='float32')
+        # input samples that do not fill a block yet
+        self.__pending = np.empty((0,), dtype='float32')
+        # number of decimated samples produced so far
+        self.__produced = 0
+
+        # the decimated basis is scaled by the factor, such that the
+        # magnitudes match the full rate decoder
+        decimated_size = window_size // self.__factor
+        window = params.get_integration_window()[::self.__factor]
+        t = np.arange(decimated_size) * self.__factor / sample_rate
+        offsets = frequencies - self.__center
+        self.__basis = self.__factor * window[:, np.newaxis] * np.exp(-2j * np.pi * np.outer(t, offsets))
+
+
+    def get_factor(self):
+        return self.__factor
+
+
+    def get_window_size(self):
+        return self.__basis.shape[0]
+
+
+    def get_basis(self):
+        return self.__basis
+
+
+    def process(self, frames):
+        data = np.hstack([self.__pending, np.asarray(frames, dtype='float32')])
+        count = len(data) // self.__factor
+        self.__pending = data[count * self.__factor:]
+        if count == 0:
+            return np.empty((0,), dtype='complex64')
+
+        blocks = np.vstack([self.__history, data[:count * self.__factor].reshape((count, self.__factor))])
+        filtered = np.zeros((count, 2), dtype='float32')
+        for i, taps in enumerate(self.__taps):
+            filtered += blocks[i:i + count] @ taps
+        self.__history = blocks[count:]
+
+        last_samples = (self.__produced + np.arange(count)) * self.__factor + self.__factor - 1
+        mixer = np.exp(-2j * np.pi * ((self.__mixer_rate * last_samples) % 1.0))
+        self.__produced += count
+        return ((filtered[:, 0] + 1j * filtered[:, 1]) * mixer).astype('complex64')
@@ -0,0 +1,47 @@
+from decoder_bank import DecoderBank
+from sliding_window import SlidingWindow
+from audio_stream import AudioStream
+
+
+# Serves multiple links from a single audio stream. Every peer has its own
+# frequency plan, i.e., the parameters of the link as seen from the hub. The
+# RECV frequencies of the plans may not overlap and the plans have to share
+# the sample rate and window length. The captured audio is decoded once for
+# all peers by a DecoderBank, and a sliding window runs per peer.
+#
+# Note that the sessions share the audio output, hence the frames for
+# different peers are played one after the other.
+class Hub:
+    def __init__(self, plans):
+        self.__decoder_bank = DecoderBank(plans)
+        self.__decoder_bank.start()
+
+        self.__audio_stream = AudioStream(plans[0])
+        self.__audio_stream.start()
+
+        self.__sessions = []
+        for peer, params in enumerate(plans):
+            message_decoder = self.__decoder_bank.get_decoder(peer)
+            session = SlidingWindow(params, self.__audio_stream, message_decoder)
+            self.__sessions.append(session)
+
+
+    # the sliding window of a peer, used to send and recv data and to attach callbacks
+    def get_session(self, peer):
+        return self.__sessions[peer]
+
+
+    # call this methods around 10 times a second, see SlidingWindow.tick
+    def tick(self):
+        recv_data = self.__audio_stream.record()
+        self.__decoder_bank.add_frames(recv_data)
+
+        for session in self.__sessions:
+            session.tick()
+
+
+    def stop(self):
+        for session in self.__sessions:
+            session.stop()
+        self.__decoder_bank.stop()
+        self.__audio_stream.stop()
@@ -0,0 +1,345 @@
+import copy
+import math
+import time
+
+import numpy as np
+
+from message_protocol import MessageDecoder
+from message_protocol import MessageEncoder
+from transmission_parameters import START_SEQ
+from audio_stream import AudioStream
+
+# number of channels swept by a probe, this is the maximum number of channels
+# that can be selected in the ui
+PROBE_CHANNELS = 16
+# silent windows at the end of a probe, used to measure the noise floor
+NOISE_WINDOWS = 2
+# candidate window lengths (s), shortest first
+WINDOW_LENGTHS = [0.02, 0.03, 0.05, 0.07, 0.1, 0.15, 0.2, 0.3, 0.5]
+# minimal snr (dB) of a channel before it is considered to be error free
+REQUIRED_SNR = 15.0
+# assumed round trip latency of the audio hardware (s)
+LATENCY = 3.0
+# frequencies of the sync tones of the master and the slave, relative to the
+# base frequency. They lie below all channels, such that the start sequence of
+# a data frame can not be mistaken for the sync of a probe.
+MASTER_SYNC_TONE = 0.8
+SLAVE_SYNC_TONE = 0.6
+
+# message types exchanged during probing
+REPORT = 0x52
+DECISION = 0x44
+DECISION_ACK = 0x41
+
+
+# the tones of all channels that can be selected, independent of the number
+# of channels that is currently configured
+def probe_tones(params):
+    sweep_params = copy.copy(params)
+    sweep_params.set_num_channels(PROBE_CHANNELS)
+    return sweep_params.get_channel_frequencies()
+
+
+def sync_tone(params, is_master):
+    return (MASTER_SYNC_TONE if is_master else SLAVE_SYNC_TONE) * params.get_base_freq()
+
+
+# power of the discrete Fourier coefficient of every window (rows) at the
+# given frequencies (columns)
+def window_power(windows, frequencies, sample_rate):
+    t = np.arange(windows.shape[1]) / sample_rate
+    basis = np.exp(-2j * np.pi * np.outer(t, frequencies))
+    return np.abs(windows @ basis)**2
+
+
+# the probe consists of a start sequence on the sync tone of the sender,
+# followed by every tone in isolation and a few silent windows
+def make_probe(params):
+    window_size = params.get_window_size()
+    sample_rate = params.get_sample_rate()
+    tones = probe_tones(params)
+    sync_freq = sync_tone(params, params.get_is_master())
+
+    t = np.arange(window_size) / sample_rate
+    windows = [bit * np.cos(2 * np.pi * sync_freq * t) for bit in START_SEQ]
+    windows += [np.cos(2 * np.pi * freq * t) for freq in tones]
+    windows += NOISE_WINDOWS * [np.zeros(window_size)]
+    return np.hstack(windows).astype('float32')
+
+
+# find the start of the probe send by the remote side, returns -1 if there
+# is no probe in the audio data. In the on windows of the start sequence the
+# sync tone has to be louder than every channel, other audio (e.g., a data
+# frame) can key the sync tone only by leaking into it.
+def find_probe(params, audio):
+    window_size = params.get_window_size()
+    sample_rate = params.get_sample_rate()
+    frequencies = [sync_tone(params, not params.get_is_master())] + list(probe_tones(params))
+
+    start_seq = np.array(START_SEQ, dtype='bool')
+    start_seq_size = len(START_SEQ) * window_size
+    step_size = window_size // 4
+
+    def sync_power(cursor):
+        windows = audio[cursor:cursor + start_seq_size].reshape((-1, window_size))
+        return window_power(windows, frequencies, sample_rate)
+
+    cursor = 0
+    while cursor + start_seq_size <= len(audio):
+        power = sync_power(cursor)
+        threshold = (power[0, 0] + power[1, 0]) / 2
+        if np.array_equal(power[:, 0] > threshold, start_seq) and \
+                np.all(power[start_seq, 0] > np.max(power[start_seq, 1:], axis=1)):
+            break
+        cursor += step_size
+    else:
+        return -1
+
+    # the first match can be off by a fraction of a window, the off windows
+    # at both ends of the start sequence contain the least energy when the
+    # cursor is aligned
+    best_cursor = cursor
+    best_power = math.inf
+    first = max(0, cursor - window_size // 2)
+    last = min(cursor + window_size // 2, len(audio) - start_seq_size)
+    for offset in range(first, last + 1, max(1, window_size // 16)):
+        power = sync_power(offset)[:, 0]
+        if power[0] + power[-1] < best_power:
+            best_cursor = offset
+            best_power = power[0] + power[-1]
+    return best_cursor
+
+
+# measure the snr (dB) of every probe tone, cursor points to the start of
+# the probe. The noise includes the energy that leaks from other channels.
+def measure_snr(params, audio, cursor):
+    window_size = params.get_window_size()
+    sample_rate = params.get_sample_rate()
+    tones = probe_tones(params)
+
+    start = cursor + len(START_SEQ) * window_size
+    nwindows = PROBE_CHANNELS + NOISE_WINDOWS
+    windows = audio[start:start + nwindows * window_size].reshape((nwindows, window_size))
+
+    # only use the center half of every window, such that a small misalignment
+    # does not carry energy of the neighbouring windows into the measurement
+    windows = windows[:, window_size // 4:window_size - window_size // 4]
+    power = window_power(windows, tones, sample_rate)
+
+    snr = np.empty(PROBE_CHANNELS)
+    for ch in range(PROBE_CHANNELS):
+        signal = power[ch, ch]
+        noise = np.max(np.delete(power[:, ch], ch))
+        snr[ch] = 10 * np.log10(max(signal, 1e-20) / max(noise, 1e-20))
+
+    # the snr grows linearly with the integration length, scale back to the
+    # snr of a complete window
+    return snr + 10 * np.log10(window_size / windows.shape[1])
+
+
+# select the number of channels and window length with the highest bit rate
+# for which every used channel is above REQUIRED_SNR in both directions.
+# Returns (num_channels, window_length) or None if no setting is usable.
+def choose_parameters(params, snr_to_slave, snr_to_master):
+    candidate = copy.copy(params)
+    best = None
+    best_bps = 0.0
+    for num_channels in range(2, PROBE_CHANNELS + 1):
+        # the master sends on the even channels, the slave on the odd ones
+        snr = min(np.min(snr_to_slave[0:num_channels:2]), np.min(snr_to_master[1:num_channels:2]))
+        for window_length in WINDOW_LENGTHS:
+            # the noise in a channel is proportional to its bandwidth, i.e.,
+            # inversely proportional to the window length
+            if snr + 10 * math.log10(window_length / params.get_window_length()) < REQUIRED_SNR:
+                continue
+
+            candidate.set_num_channels(num_channels)
+            candidate.set_window_length(window_length)
+            bps = math.inf
+            for is_master in [True, False]:
+                candidate.set_is_master(is_master)
+                bps = min(bps, candidate.get_max_bps())
+
+            if bps > best_bps:
+                best = (num_channels, window_length)
+                best_bps = bps
+            # longer windows only lower the bit rate
+            break
+    return best
+
+
+def encode_snr(snr):
+    return bytes(int(np.clip(round(2 * (value + 20)), 0, 255)) for value in snr)
+
+
+def decode_snr(data):
+    return np.array(list(data)) / 2 - 20
+
+
+# Measures the link at connection start and reconfigures the parameters on
+# both sides. The master sends a probe, the slave measures it and answers with
+# its own probe and a report of the measured snr. The master combines both
+# measurements, sends the decision and waits for it to be acknowledged.
+#
+# Like the sliding window, this object is polling based, call tick around 10
+# times a second until is_done returns true. The audio stream and the clock
+# (used for the timeouts) can be passed like to the sliding window.
+class LinkProbe:
+    def __init__(self, params, timeout=120.0, audio_stream=None, clock=time.time):
+        self.__params = params
+        self.__clock = clock
+
+        # the messages exchanged during probing use the current channels and
+        # window length, but have to be large enough to carry a report
+        self.__probe_params = copy.copy(params)
+        self.__probe_params.set_max_payload_size(PROBE_CHANNELS + 1)
+        self.__probe_params.set_bits_per_symbol(1)
+
+        self.__probe = make_probe(self.__params)
+        self.__capture = np.empty((0,), dtype='float32')
+        self.__snr_local = None
+        self.__snr_remote = None
+        self.__decision = None
+        self.__result = None
+        self.__done = False
+
+        self.__message_decoder = MessageDecoder(self.__probe_params)
+        self.__message_encoder = MessageEncoder(self.__probe_params)
+        self.__message_decoder.start()
+
+        self.__owns_stream = audio_stream is None
+        if self.__owns_stream:
+            audio_stream = AudioStream(self.__params)
+            audio_stream.start()
+        self.__audio_stream = audio_stream
+
+        sample_rate = self.__params.get_sample_rate()
+        report_size = len(self.__message_encoder.encode(bytes(PROBE_CHANNELS + 1)))
+        self.__retry_interval = (2 * len(self.__probe) + report_size) / sample_rate + LATENCY
+        self.__deadline = self.__clock() + timeout
+        self.__retry = 0
+        self.__linger = 0
+
+
+    def __send_message(self, message):
+        audio_data = self.__message_encoder.encode(message)
+        self.__audio_stream.play(audio_data)
+
+
+    def __measure(self):
+        cursor = find_probe(self.__params, self.__capture)
+        if cursor == -1:
+            # a probe can only start in the last part of the capture
+            self.__capture = self.__capture[-len(self.__probe):]
+            return None
+
+        if cursor + len(self.__probe) > len(self.__capture):
+            # wait for the remainder of the probe
+            return None
+
+        snr = measure_snr(self.__params, self.__capture, cursor)
+        self.__capture = self.__capture[cursor + len(self.__probe):]
+        print(f'measured probe snr: {np.round(snr, 1)}')
+        return snr
+
+
+    def __finish(self, result):
+        if result is not None:
+            num_channels, window_length = result
+            self.__params.set_num_channels(num_channels)
+            self.__params.set_window_length(window_length)
+            print(f'link probe selected {num_channels} channels, window length {window_length}')
+        else:
+            print('link probe failed, keeping parameters')
+
+        self.__result = result
+        self.__done = True
+        self.stop()
+
+
+    def __process_message(self, message):
+        is_master = self.__params.get_is_master()
+        if is_master and message[0] == REPORT and len(message) == PROBE_CHANNELS + 1:
+            self.__snr_remote = decode_snr(message[1:])
+        elif not is_master and message[0] == DECISION and len(message) == 4:
+            num_channels = message[1]
+            window_length = int.from_bytes(message[2:4], 'big') / 1000
+            self.__decision = (num_channels, window_length)
+            self.__linger = self.__clock() + 3 * self.__retry_interval
+            self.__send_message(bytes([DECISION_ACK]))
+        elif is_master and message[0] == DECISION_ACK and self.__decision is not None:
+            self.__finish(self.__decision)
+
+
+    def tick(self):
+        if self.__done:
+            return
+
+        recv_data = self.__audio_stream.record()
+        self.__message_decoder.add_frames(recv_data)
+
+        # the master measures a single probe, the slave answers every probe
+        # (the master repeats it when the report is lost) until it knows the
+        # decision
+        is_master = self.__params.get_is_master()
+        measuring = self.__snr_local is None if is_master else self.__decision is None
+        if measuring:
+            self.__capture = np.hstack([self.__capture, recv_data])
+            snr = self.__measure()
+            if snr is not None:
+                self.__snr_local = snr
+                if not is_master:
+                    # answer with our own probe and report what we have measured
+                    self.__audio_stream.play(self.__probe)
+                    self.__send_message(bytes([REPORT]) + encode_snr(snr))
+
+        while not self.__done:
+            message = self.__message_decoder.get_message()
+            if message is None:
+                break
+            if len(message) > 0:
+                self.__process_message(message)
+
+        if self.__done:
+            return
+
+        now = self.__clock()
+        if is_master:
+            if self.__decision is None and self.__snr_local is not None and self.__snr_remote is not None:
+                self.__decision = choose_parameters(self.__params, self.__snr_remote, self.__snr_local)
+                if self.__decision is None:
+                    self.__finish(None)
+                    return
+                self.__retry = 0
+
+            if now > self.__retry:
+                if self.__decision is None:
+                    self.__audio_stream.play(self.__probe)
+                else:
+                    num_channels, window_length = self.__decision
+                    message = bytes([DECISION, num_channels])
+                    message += round(window_length * 1000).to_bytes(2, 'big')
+                    self.__send_message(message)
+                self.__retry = now + self.__retry_interval
+        elif self.__decision is not None and now > self.__linger:
+            # the master did not repeat the decision, hence it received our ack
+            self.__finish(self.__decision)
+            return
+
+        if now > self.__deadline:
+            self.__finish(None)
+
+
+    def is_done(self):
+        return self.__done
+
+
+    # the selected (num_channels, window_length), None if probing failed
+    def get_result(self):
+        return self.__result
+
+
+    def stop(self):
+        self.__message_decoder.stop()
+        if self.__owns_stream:
+            self.__audio_stream.stop()
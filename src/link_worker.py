@@ -0,0 +1,146 @@
+import collections
+import threading
+import time
+
+# time (s) between two ticks of the link
+TICK_INTERVAL = 0.1
+
+
+def call_directly(func, *args):
+    func(*args)
+
+
+# Runs the link probe and the sliding window on a dedicated thread, such that
+# encoding and the protocol timing do not depend on the load of the ui. The
+# callbacks are passed to dispatch, e.g., GLib.idle_add to run them on the
+# GTK main loop. Received data is collected until the previous batch has been
+# handled, hence a busy ui gets fewer but larger batches.
+class LinkWorker(threading.Thread):
+    # the probe (auto_tune) measures the link using the sound card, while
+    # audio_stream, if given, is used by the sliding window. The decoder of
+    # the sliding window publishes to spectrum_feed, if given.
+    def __init__(self, params, auto_tune=False, dispatch=call_directly, audio_stream=None, spectrum_feed=None):
+        threading.Thread.__init__(self)
+        self.__params = params
+        self.__auto_tune = auto_tune
+        self.__dispatch = dispatch
+        self.__audio_stream = audio_stream
+        self.__spectrum_feed = spectrum_feed
+        self.__running = True
+        self.__stopped = threading.Event()
+
+        self.__lock = threading.Lock()
+        self.__send_pending = collections.deque()
+        self.__recv_pending = bytearray()
+        self.__recv_scheduled = False
+        self.__sliding_window = None
+
+        self.__on_probe_done = lambda result: None
+        self.__on_link_started = lambda: None
+        self.__on_send_complete = lambda: None
+        self.__on_data = lambda data: None
+
+
+    def attach_on_probe_done(self, func):
+        self.__on_probe_done = func
+
+
+    def attach_on_link_started(self, func):
+        self.__on_link_started = func
+
+
+    def attach_on_send_complete(self, func):
+        self.__on_send_complete = func
+
+
+    def attach_on_data(self, func):
+        self.__on_data = func
+
+
+    # called on the worker thread by the sliding window
+    def __data_available(self):
+        data = self.__sliding_window.recv()
+        with self.__lock:
+            self.__recv_pending += data
+            if self.__recv_scheduled or not self.__recv_pending:
+                return
+            self.__recv_scheduled = True
+        self.__dispatch(self.__deliver_data)
+
+
+    # called by dispatch, passes everything received so far in one batch
+    def __deliver_data(self):
+        with self.__lock:
+            data = bytes(self.__recv_pending)
+            self.__recv_pending.clear()
+            self.__recv_scheduled = False
+        if data:
+            self.__on_data(data)
+
+
+    def __sleep_until(self, deadline):
+        self.__stopped.wait(max(0.0, deadline - time.monotonic()))
+
+
+    def __probe(self):
+        from link_probe import LinkProbe
+
+        link_probe = LinkProbe(self.__params)
+        next_tick = time.monotonic()
+        while self.__running and not link_probe.is_done():
+            link_probe.tick()
+            next_tick += TICK_INTERVAL
+            self.__sleep_until(next_tick)
+        if not link_probe.is_done():
+            link_probe.stop()
+            return
+        self.__dispatch(self.__on_probe_done, link_probe.get_result())
+
+
+    # move the queued data to the sliding window, data that does not fit
+    # stays at the head of the queue until the next tick
+    def __flush_pending(self):
+        with self.__lock:
+            while self.__send_pending:
+                if not self.__sliding_window.send(self.__send_pending[0]):
+                    break
+                self.__send_pending.popleft()
+
+
+    def run(self):
+        from sliding_window import SlidingWindow
+
+        if self.__auto_tune:
+            self.__probe()
+        if not self.__running:
+            return
+
+        self.__sliding_window = SlidingWindow(self.__params, self.__audio_stream,
+                spectrum_feed=self.__spectrum_feed)
+        self.__sliding_window.attach_on_send_complete(
+                lambda: self.__dispatch(self.__on_send_complete))
+        self.__sliding_window.attach_on_data_availbale(self.__data_available)
+        self.__dispatch(self.__on_link_started)
+
+        # ticks are scheduled at a fixed rate, a slow tick does not delay the
+        # following ones
+        next_tick = time.monotonic()
+        while self.__running:
+            self.__flush_pending()
+
+            self.__sliding_window.tick()
+            next_tick = max(next_tick + TICK_INTERVAL, time.monotonic() - TICK_INTERVAL)
+            self.__sleep_until(next_tick)
+        self.__sliding_window.stop()
+
+
+    # queue data, can be called from any thread before and after the link started
+    def send(self, data):
+        with self.__lock:
+            self.__send_pending.append(data)
+
+
+    def stop(self):
+        self.__running = False
+        self.__stopped.set()
+        self.join()
@@ -1,12 +1,63 @@
+import collections
 import enum
 import threading
-import math
 
 import numpy as np
 
+from transmission_parameters import BARKER_SEQ
 from transmission_parameters import FrequencySet
-
-START_SEQ = [0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0]
+from transmission_parameters import Preamble
+from transmission_parameters import START_SEQ
+
+# number of decoded messages kept until they are retrieved, the oldest message
+# is dropped when the queue is full
+MAX_QUEUED_MESSAGES = 1024
+# number of spectrum rows kept for a subscriber of a SpectrumFeed
+MAX_SPECTRUM_ROWS = 256
+
+# the squelch opens when the energy of a window exceeds the noise floor by this factor
+SQUELCH_RATIO = 4.0
+# smallest energy that opens the squelch, i.e., when the input is silent
+SQUELCH_MIN_ENERGY = 1e-2
+# rate at which the noise floor follows the energy of the windows
+SQUELCH_FLOOR_RATE = 0.05
+# number of windows passed to the decoder before the squelch opened
+SQUELCH_PREROLL = 2
+# number of windows used to estimate the initial noise floor, longer than a
+# start sequence such that it contains off windows
+SQUELCH_SETTLE_WINDOWS = 16
+# while the squelch is open the floor follows the minimum energy of the
+# windows of this many messages of the maximal size (off windows carry only
+# noise), i.e., a rise of the noise does not keep the gate open forever
+SQUELCH_MINIMUM_MESSAGES = 2
+
+# minimal correlation of the summed channels with the Barker code
+BARKER_THRESHOLD = 0.9
+# the matched filter detects a chirp when its output exceeds the median output
+# (i.e., the noise) by this factor
+CHIRP_THRESHOLD = 10.0
+# smallest amplitude (relative to full scale) of a chirp that is detected,
+# i.e., when the input is silent
+CHIRP_MIN_LEVEL = 1e-3
+
+
+# (off, on) level of a channel, the mean Fourier coefficient of the off and
+# of the on windows of the start sequence
+def preamble_levels(fbin_data, start_seq=START_SEQ):
+    preamble = np.asarray(fbin_data)[:len(start_seq)]
+    start_seq = np.array(start_seq, dtype='bool')
+    return np.mean(preamble[~start_seq]), np.mean(preamble[start_seq])
+
+
+# scale the fourier coefficients of a channel such that the mean of the off
+# windows of the start sequence maps to 0 and the mean of the on windows to 1
+def equalize_gain(fbin_data, start_seq=START_SEQ):
+    fbin_data = np.asarray(fbin_data)
+    off_level, on_level = preamble_levels(fbin_data, start_seq)
+    if on_level <= off_level:
+        # the channel did not carry a valid start sequence, leave it as is
+        return fbin_data
+    return (fbin_data - off_level) / (on_level - off_level)
 
 def redundancy_check16(data):
     data = data[:]
@@ -53,22 +104,168 @@ def remove_parity_bits(bin_data):
     return new_bin_data
 
 
+# group bits into symbols of bits_per_symbol bits and map them to amplitude
+# levels in [0, 2**bits_per_symbol - 1]. The levels are Gray coded, hence an
+# error to a neighbouring amplitude level only flips a single bit.
+def bits_to_levels(bin_data, bits_per_symbol):
+    bin_data = list(bin_data) + [0] * (-len(bin_data) % bits_per_symbol)
+    levels = []
+    for cursor in range(0, len(bin_data), bits_per_symbol):
+        value = 0
+        for bit in bin_data[cursor:cursor + bits_per_symbol]:
+            value = (value << 1) | bit
+
+        # inverse Gray code
+        level = value
+        shift = value >> 1
+        while shift:
+            level ^= shift
+            shift >>= 1
+        levels.append(level)
+    return levels
+
+
+def levels_to_bits(levels, bits_per_symbol):
+    bin_data = []
+    for level in levels:
+        value = level ^ (level >> 1)
+        bin_data += map(int, format(value, f'0{bits_per_symbol}b'))
+    return bin_data
+
+
+# fbin_data contains the Fourier coefficients of channel 0 of len(START_SEQ) windows
+def is_start_seq(fbin_data):
+    threshold = (fbin_data[0] + fbin_data[1]) / 2
+    bin_data = np.array(np.asarray(fbin_data) > threshold, dtype='int')
+    return np.array_equal(bin_data, START_SEQ)
+
+
+# correlation coefficient of the Fourier coefficients of len(BARKER_SEQ)
+# windows (summed over the channels) with the Barker code
+def barker_correlation(fbin_data):
+    fbin_data = np.asarray(fbin_data) - np.mean(fbin_data)
+    code = np.array(BARKER_SEQ) - np.mean(BARKER_SEQ)
+    norm = np.sqrt(np.sum(fbin_data**2) * np.sum(code**2))
+    if norm == 0:
+        return 0.0
+    return np.sum(fbin_data * code) / norm
+
+
+# fbin_data_ch contains the Fourier coefficients of every RECV channel (rows)
+# of the windows of the start sequence (columns)
+def detect_start_seq(params, fbin_data_ch):
+    if params.get_preamble() == Preamble.BARKER:
+        return barker_correlation(np.sum(fbin_data_ch, axis=0)) >= BARKER_THRESHOLD
+    return is_start_seq(fbin_data_ch[0])
+
+
+# magnitude of the cross correlation of data and template at every offset at
+# which the template fits into data
+def matched_filter(data, template):
+    size = len(data) + len(template) - 1
+    nfft = 1 << (size - 1).bit_length()
+    spectrum = np.fft.fft(data, nfft) * np.conj(np.fft.fft(template, nfft))
+    return np.abs(np.fft.ifft(spectrum)[:len(data) - len(template) + 1])
+
+
+# fbin_data_ch contains the Fourier coefficients of every RECV channel, with
+# the first window at the preamble. Returns the message or None if the
+# coefficients do not contain a valid message.
+def decode_message(params, fbin_data_ch):
+    frequencies = params.get_frequencies(FrequencySet.RECV)
+    bits_per_symbol = params.get_bits_per_symbol()
+    start_seq = params.get_start_seq()
+    # the windows in front of the start sequence (i.e., the chirp) do not
+    # carry any levels
+    sync_windows = params.get_preamble_windows() - len(start_seq)
+    bin_data_ch = [[] for _ in range(len(frequencies))]
+    for ch, _ in enumerate(frequencies):
+        fbin_data = fbin_data_ch[ch][sync_windows:]
+        if bits_per_symbol > 1:
+            # multiple amplitude levels, slice the equalized coefficients
+            # to the nearest level
+            max_level = 2**bits_per_symbol - 1
+            fbin_data = equalize_gain(fbin_data, start_seq)
+            levels = np.clip(np.rint(fbin_data[len(start_seq):] * max_level), 0, max_level)
+            bin_data_ch[ch] = start_seq + levels_to_bits(levels.astype('int'), bits_per_symbol)
+            continue
+
+        if params.get_gain_equalization():
+            fbin_data = equalize_gain(fbin_data, start_seq)
+            min_value = 0.0
+            max_value = 1.0
+        else:
+            # the first off and on window of the start sequence
+            min_value = fbin_data[start_seq.index(0)]
+            max_value = fbin_data[start_seq.index(1)]
+        for value in fbin_data:
+            threshold = (min_value + max_value) / 2
+            if value > threshold:
+                bin_data_ch[ch].append(1)
+                max_value = value
+            else:
+                bin_data_ch[ch].append(0)
+                min_value = value
+
+    # drop start seq and parity bits
+    for channel, _ in enumerate(frequencies):
+        no_start_seq = bin_data_ch[channel][len(start_seq):]
+        bin_data_ch[channel] = remove_parity_bits(no_start_seq)
+
+    # recreate the original bit stream
+    bin_data = []
+    for i in range(len(bin_data_ch[0])):
+        for channel, _ in enumerate(frequencies):
+            bin_data.append(bin_data_ch[channel][i])
+
+    # convert bit steam to bytes object
+    data = b''
+    cursor = 0
+    while cursor + 8 <= len(bin_data):
+        byte = bin_data[cursor:cursor + 8]
+        bit_string = ''.join(map(str, byte))
+        data += bytes([int(bit_string, 2)])
+        cursor += 8
+
+    # length of the payload
+    length = data[2] & 0x3f
+    if length + 3 > len(data):
+        # there is not enough data to recv the message (e.g., length is invalidated during transmission)
+        return None
+
+    # do the `normal' parity check
+    data = data[:length + 3]
+    if redundancy_check16(data) != 0:
+        return None
+
+    # drop header containing redundancy check and length (3 byte)
+    # TODO: we can check parity bits however, this tured out to be quite a difficult/ugly task
+    return data[3:]
+
+
 class MessageEncoder:
     def __init__(self, params):
-        self.__params = params
+        self.__params = params.snapshot()
 
 
-    def __ifourier(self, ch, bin_data):
+    def __ifourier(self, ch, levels):
         window_size = self.__params.get_window_size()
         sample_rate = self.__params.get_sample_rate()
         freq = self.__params.get_frequencies(FrequencySet.SEND)[ch]
 
-        size = len(bin_data) * window_size
+        # spread the initial phases of the carriers (Schroeder phases), this
+        # lowers the peak of the summed signal and thus the normalization
+        # in encode does not attenuate every channel as much
+        nchannels = len(self.__params.get_frequencies(FrequencySet.SEND))
+        phase = np.pi * ch**2 / nchannels
+
+        size = len(levels) * window_size
         t = np.arange(size) / sample_rate
-        carrier_data = np.cos(2 * np.pi * freq * t, dtype='float32')
-        mask = np.empty((0,), dtype='float32')
-        for d in bin_data:
-            mask = np.hstack([mask, np.full(window_size, d, dtype='float32')])
+        carrier_data = np.cos(2 * np.pi * freq * t + phase, dtype='float32')
+        # every symbol is shaped by the pulse, which ramps the carrier on and
+        # off at the window boundaries
+        pulse = self.__params.get_symbol_pulse().astype('float32')
+        mask = np.outer(np.asarray(levels, dtype='float32'), pulse).reshape(-1)
         return mask * carrier_data
 
 
@@ -93,10 +290,15 @@ class MessageEncoder:
         bin_data = self.__to_bin_data(complete_message)
         bin_data += bytes(-len(bin_data) % nchannels)
 
-        bin_data_ch = [START_SEQ[:] for _ in range(nchannels)]
+        # the start sequence always uses the lowest and highest amplitude,
+        # the data is send using 2**bits_per_symbol amplitude levels
+        bits_per_symbol = self.__params.get_bits_per_symbol()
+        max_level = 2**bits_per_symbol - 1
+        bin_data_ch = [self.__params.get_start_seq() for _ in range(nchannels)]
         for ch, _ in enumerate(frequencies):
-            ch_data = bin_data[ch::nchannels]
-            bin_data_ch[ch] += add_parity_bits(ch_data)
+            ch_data = add_parity_bits(bin_data[ch::nchannels])
+            levels = np.array(bits_to_levels(ch_data, bits_per_symbol)) / max_level
+            bin_data_ch[ch] += list(levels)
 
         audio_data = self.__ifourier(0, bin_data_ch[0])
         for ch in range(1, nchannels):
@@ -106,84 +308,398 @@ class MessageEncoder:
         max_value = np.max(np.abs(audio_data))
         audio_data /= max_value
 
+        if self.__params.get_preamble() == Preamble.CHIRP:
+            audio_data = np.hstack([self.__params.get_chirp(FrequencySet.SEND), audio_data])
         return audio_data
 
 
-class MessageDecoder(threading.Thread):
-    def __init__(self, params):
+# Encodes messages on a worker thread and passes the audio, in the order the
+# messages were submitted, to output (e.g., AudioStream.play). The audio of a
+# message submitted with a key is kept until the key is released, such that
+# a retransmission replays the audio without encoding it again.
+class EncoderPipeline(threading.Thread):
+    def __init__(self, params, output):
         threading.Thread.__init__(self)
         self.__running = True
 
-        self.__params = params
-        self.__buffer = np.empty((0,), dtype='float32')
-        self.__buffer_lock = threading.Condition()
-        self.__decode_buffer = np.empty((0,), dtype='float32')
-        self.__messages = []
-        self.__messages_lock = threading.Lock()
+        self.__encoder = MessageEncoder(params)
+        self.__output = output
+        self.__queue = collections.deque()
+        self.__queue_lock = threading.Condition()
+        self.__busy = False
+        self.__cache = {}
 
-        # initialize constant sin and cos measurement functions
-        # used for calculating the discrete Fourier coefficients
-        frequencies = self.__params.get_frequencies(FrequencySet.RECV)
-        self.__ch_sin = len(frequencies) * [None]
-        self.__ch_cos = len(frequencies) * [None]
 
-        window_size = self.__params.get_window_size()
-        sample_rate = self.__params.get_sample_rate()
-        t = np.arange(window_size) / sample_rate
-        for ch, freq in enumerate(frequencies):
-            self.__ch_sin[ch] = np.sin(2 * np.pi * freq * t)
-            self.__ch_cos[ch] = np.cos(2 * np.pi * freq * t)
+    def __render(self, key, message):
+        if message is None:
+            return self.__cache.get(key)
+
+        audio_data = self.__encoder.encode(message)
+        if key is not None:
+            self.__cache[key] = audio_data
+        return audio_data
 
 
-    def __fourier(self, ch, audio):
-        window_size = self.__params.get_window_size()
+    def run(self):
+        while True:
+            with self.__queue_lock:
+                self.__queue_lock.wait_for(lambda: self.__queue or not self.__running)
+                if not self.__queue:
+                    return
+                action, key, message = self.__queue.popleft()
+                self.__busy = True
+
+            # the cache is only accessed by this thread, release is queued as well
+            if action == 'release':
+                self.__cache.pop(key, None)
+            else:
+                audio_data = self.__render(key, message)
+                if audio_data is not None:
+                    self.__output(audio_data)
+
+            with self.__queue_lock:
+                self.__busy = False
+                self.__queue_lock.notify_all()
+
+
+    def __put(self, action, key=None, message=None):
+        with self.__queue_lock:
+            self.__queue.append((action, key, message))
+            self.__queue_lock.notify_all()
+
+
+    # encode and output the message, the audio is cached if key is not None
+    def submit(self, message, key=None):
+        self.__put('submit', key, message)
+
+
+    # output the cached audio of key again
+    def replay(self, key):
+        self.__put('submit', key)
 
-        assert len(audio) % self.__params.get_window_size() == 0
+
+    def release(self, key):
+        self.__put('release', key)
+
+
+    # block until all submitted messages are passed to output, returns false on a timeout
+    def wait_idle(self, timeout=None):
+        with self.__queue_lock:
+            return self.__queue_lock.wait_for(lambda: not self.__queue and not self.__busy, timeout)
+
+
+    # the queued messages are still passed to output
+    def stop(self):
+        with self.__queue_lock:
+            self.__running = False
+            self.__queue_lock.notify_all()
+        self.join()
+
+
+# Bounded queue of decoded messages, shared by the decoder thread and the
+# protocol layer. Messages are dropped (and counted) when nobody retrieves them.
+class MessageQueue:
+    def __init__(self, max_size=MAX_QUEUED_MESSAGES):
+        self.__messages = collections.deque()
+        self.__lock = threading.Condition()
+        self.__max_size = max_size
+        self.__dropped = 0
+
+
+    def put(self, message):
+        with self.__lock:
+            if len(self.__messages) >= self.__max_size:
+                self.__messages.popleft()
+                self.__dropped += 1
+            self.__messages.append(message)
+            self.__lock.notify_all()
+
+
+    # returns at most max_n (all if None) messages. With block this waits at
+    # most timeout seconds (forever if None) for the first message.
+    def get_messages(self, max_n=None, block=False, timeout=None):
+        with self.__lock:
+            if block:
+                self.__lock.wait_for(lambda: self.__messages, timeout)
+            count = len(self.__messages) if max_n is None else min(max_n, len(self.__messages))
+            return [self.__messages.popleft() for _ in range(count)]
+
+
+    # returns the oldest message or None
+    def get_message(self, block=False, timeout=None):
+        messages = self.get_messages(1, block, timeout)
+        return messages[0] if messages else None
+
+
+    # number of messages dropped because the queue was full
+    def get_dropped(self):
+        with self.__lock:
+            return self.__dropped
+
+
+# Gate in front of the start sequence search. The energy of the RECV band is
+# measured per window and compared to an adaptive noise floor. Audio is only
+# passed on when there is energy above the noise floor, including a few
+# windows before it (the start sequence starts with an off window) and enough
+# windows after it to complete a message.
+class Squelch:
+    # basis is the basis of the decoder, i.e., at the rate of the front end.
+    # The magnitudes of the windows are published to spectrum_feed, if given.
+    def __init__(self, params, basis, spectrum_feed=None):
+        self.__window_size = basis.shape[0]
+        self.__basis = basis
+        self.__spectrum_feed = spectrum_feed
+        self.__hang_windows = params.get_message_windows(params.get_max_payload_size(), FrequencySet.RECV)
+        # energies of the last windows and of the last windows while the
+        # gate was closed, the ratio of the floor to the minimum of the
+        # latter scales the minimum of the former to a floor
+        self.__recent = collections.deque(maxlen=SQUELCH_MINIMUM_MESSAGES * self.__hang_windows)
+        self.__quiet = collections.deque(maxlen=SQUELCH_MINIMUM_MESSAGES * self.__hang_windows)
+
+        # the first windows may already carry a message, hence the gate is
+        # open until the noise floor is established. The energies of these
+        # windows are kept to estimate the floor.
+        self.__floor = None
+        self.__settling = []
+        self.__hang = 0
+        self.__preroll = collections.deque(maxlen=SQUELCH_PREROLL)
+        self.__remainder = np.empty((0,), dtype='float32')
+
+
+    def is_open(self):
+        return self.__floor is None or self.__hang > 0
+
+
+    # the noise floor is the mean energy of the windows that are not much
+    # louder than the quietest window
+    def __settle(self):
+        energies = np.array(self.__settling)
+        self.__floor = np.mean(energies[energies <= SQUELCH_RATIO * np.min(energies)])
+        self.__settling = []
+
+        # a message may still be in progress, hang on after the last loud window
+        loud = np.flatnonzero(energies > max(SQUELCH_RATIO * self.__floor, SQUELCH_MIN_ENERGY))
+        if len(loud) > 0:
+            self.__hang = max(0, self.__hang_windows - (len(energies) - 1 - loud[-1]))
+
+
+    # returns the part of the audio that should be decoded
+    def process(self, frames):
+        data = np.hstack([self.__remainder, frames])
+        nwindows = len(data) // self.__window_size
+        self.__remainder = data[nwindows * self.__window_size:]
+        windows = data[:nwindows * self.__window_size].reshape((nwindows, self.__window_size))
+        magnitudes = np.abs(windows @ self.__basis)
+        energies = np.sum(magnitudes, axis=1)
+        if self.__spectrum_feed is not None:
+            self.__spectrum_feed.publish(magnitudes)
+
+        output = []
+        for window, energy in zip(windows, energies):
+            if self.__floor is None:
+                self.__settling.append(energy)
+                if len(self.__settling) == SQUELCH_SETTLE_WINDOWS:
+                    self.__settle()
+                output.append(window)
+                continue
+
+            self.__recent.append(energy)
+            if self.is_open() and len(self.__recent) == self.__recent.maxlen and \
+                    len(self.__quiet) == self.__quiet.maxlen and min(self.__quiet) > 0:
+                floor = min(self.__recent) * self.__floor / min(self.__quiet)
+                if floor > self.__floor:
+                    self.__floor += SQUELCH_FLOOR_RATE * (floor - self.__floor)
+
+            if energy > max(SQUELCH_RATIO * self.__floor, SQUELCH_MIN_ENERGY):
+                if not self.is_open():
+                    output += self.__preroll
+                    self.__preroll.clear()
+                self.__hang = self.__hang_windows
+            elif self.is_open():
+                self.__hang -= 1
+            else:
+                self.__floor += SQUELCH_FLOOR_RATE * (energy - self.__floor)
+                # silent windows (e.g., a muted input) tell nothing about the noise
+                if energy > 0:
+                    self.__quiet.append(energy)
+                self.__preroll.append(window)
+                continue
+            output.append(window)
+
+        if not output:
+            return np.empty((0,), dtype='float32')
+        return np.hstack(output)
+
+
+# Passes the magnitudes of the RECV channels, as computed by the decoder, to
+# subscribers (e.g., a waterfall in the ui). A subscriber gets a bounded
+# queue (MessageQueue, the oldest rows are dropped) of (magnitudes,
+# thresholds) rows. magnitudes contains the maximum magnitude of every channel
+# over decimation windows, thresholds the decision threshold of every channel
+# of the last decoded message (None before the first message). Nothing is
+# computed while there are no subscribers.
+class SpectrumFeed:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # [queue, decimation, magnitudes not published yet] of every subscriber
+        self.__subscribers = []
+        self.__thresholds = None
+
+
+    def subscribe(self, decimation=1, max_rows=MAX_SPECTRUM_ROWS):
+        queue = MessageQueue(max_rows)
+        with self.__lock:
+            self.__subscribers.append([queue, decimation, []])
+        return queue
+
+
+    def unsubscribe(self, queue):
+        with self.__lock:
+            self.__subscribers = [subscriber for subscriber in self.__subscribers
+                    if subscriber[0] is not queue]
+
+
+    def has_subscribers(self):
+        with self.__lock:
+            return len(self.__subscribers) > 0
+
+
+    def set_thresholds(self, thresholds):
+        thresholds = np.array(thresholds, dtype='float32')
+        thresholds.setflags(write=False)
+        with self.__lock:
+            self.__thresholds = thresholds
+
+
+    # magnitudes of every window (rows) and RECV channel (columns)
+    def publish(self, magnitudes):
+        with self.__lock:
+            for queue, decimation, pending in self.__subscribers:
+                pending.extend(magnitudes)
+                while len(pending) >= decimation:
+                    queue.put((np.max(pending[:decimation], axis=0).astype('float32'), self.__thresholds))
+                    del pending[:decimation]
+
+
+class MessageDecoder(threading.Thread):
+    # the magnitudes of the windows and the thresholds of the decoded
+    # messages are published to spectrum_feed, if given
+    def __init__(self, params, spectrum_feed=None):
+        threading.Thread.__init__(self)
+        self.__running = True
+
+        self.__params = params.snapshot()
+        self.__buffer = np.empty((0,), dtype='float32')
+        self.__buffer_lock = threading.Condition()
+        self.__idle = True
+        self.__decode_buffer = np.empty((0,), dtype='float32')
+        self.__messages = MessageQueue()
+
+        # constant measurement functions used for calculating the discrete
+        # Fourier coefficients, precomputed by the parameter snapshot. With
+        # the front end the audio is decimated, and so are the windows.
+        self.__front_end = None
+        self.__basis = self.__params.get_basis(FrequencySet.RECV)
+        if self.__params.get_front_end():
+            from front_end import FrontEnd
+            self.__front_end = FrontEnd(self.__params)
+            self.__basis = self.__front_end.get_basis()
+        self.__window_size = self.__basis.shape[0]
+
+        # the feed is shared by the decoders of successive links, every
+        # decoder splits its own audio into windows
+        self.__spectrum_feed = spectrum_feed
+        self.__spectrum_remainder = np.empty((0,), dtype='float32')
+        self.__squelch = None
+        if self.__params.get_squelch():
+            self.__squelch = Squelch(self.__params, self.__basis, spectrum_feed)
+
+        # the chirp as it appears in the decoded audio, i.e., after the front end
+        self.__chirp = None
+        if self.__params.get_preamble() == Preamble.CHIRP:
+            self.__chirp = self.__params.get_chirp(FrequencySet.RECV)
+            if self.__front_end is not None:
+                from front_end import FrontEnd
+                self.__chirp = FrontEnd(self.__params).process(self.__chirp)
+
+        # audio required to detect a preamble
+        if self.__chirp is not None:
+            self.__search_size = len(self.__chirp)
+        else:
+            self.__search_size = len(self.__params.get_start_seq()) * self.__window_size
+
+
+    # publishes the magnitudes of the audio, without squelch they are not
+    # computed anyway. Nothing is kept while there are no subscribers.
+    def __publish_spectrum(self, frames):
+        if not self.__spectrum_feed.has_subscribers():
+            self.__spectrum_remainder = np.empty((0,), dtype='float32')
+            return
+        data = np.hstack([self.__spectrum_remainder, frames])
+        nwindows = len(data) // self.__window_size
+        self.__spectrum_remainder = data[nwindows * self.__window_size:]
+        windows = data[:nwindows * self.__window_size].reshape((nwindows, self.__window_size))
+        self.__spectrum_feed.publish(np.abs(windows @ self.__basis))
+
+
+    # returns the Fourier coefficients of every window (rows) and channel (columns)
+    def __fourier(self, audio, channels=slice(None)):
+        window_size = self.__window_size
+
+        assert len(audio) % window_size == 0
 
         # we should divide multiply by dt, and then divide by the sum of
         # sin(t) and cos(t), however as this is just a constant do not really
         # care for this. However, as a side effect the fourier constants are
         # not scaled correctly.
-        fbin_data = []
-        for window in audio.reshape((-1, window_size)):
-            a = np.sum(self.__ch_sin[ch] * window)
-            b = np.sum(self.__ch_cos[ch] * window)
-            fbin_data.append(np.sqrt(a**2 + b**2))
-
-        assert len(fbin_data) == len(audio) // window_size
-
-        return fbin_data
+        return np.abs(audio.reshape((-1, window_size)) @ self.__basis[:, channels])
 
 
     # length is the payload length (i.e., excluding the 3 header bytes but not the 1 sliding window byte)
     def __calc_message_size(self, length, freq_set):
-        window_size = self.__params.get_window_size()
-        frequencies = self.__params.get_frequencies(freq_set)
-
-        channel_size = math.ceil(8 * (length + 3) / len(frequencies))
-        channel_size += channel_size // 8
-        return window_size * (len(START_SEQ) + channel_size)
+        window_size = self.__window_size
+        return window_size * self.__params.get_message_windows(length, freq_set)
 
 
     def __find_start(self, data):
-        window_size = self.__params.get_window_size()
+        if self.__chirp is not None:
+            return self.__find_chirp(data)
+
+        window_size = self.__window_size
+        preamble = self.__params.get_preamble()
+        # only channel 0 carries the ON_OFF start sequence
+        channels = slice(None) if preamble == Preamble.BARKER else slice(0, 1)
 
-        start_seq_size = len(START_SEQ) * window_size
+        start_seq_size = len(self.__params.get_start_seq()) * window_size
         step_size = window_size // 4
 
         cursor = 0
         while cursor + start_seq_size <= len(data):
-            fbin_data = self.__fourier(0, data[cursor:cursor + start_seq_size])
-            threshold = (fbin_data[0] + fbin_data[1]) / 2
-            bin_data = np.array(fbin_data > threshold, dtype='int')
-            if np.array_equal(bin_data, START_SEQ):
+            fbin_data_ch = self.__fourier(data[cursor:cursor + start_seq_size], channels).T
+            if detect_start_seq(self.__params, fbin_data_ch):
                 return cursor
             cursor += step_size
         return -1
 
 
+    # the first peak of the matched filter above the noise. The sidelobes
+    # precede the main peak by less than the length of the chirp.
+    def __find_chirp(self, data):
+        chirp_size = len(self.__chirp)
+        if len(data) < chirp_size:
+            return -1
+
+        output = matched_filter(data, self.__chirp)
+        min_output = CHIRP_MIN_LEVEL * np.sum(np.abs(self.__chirp)**2)
+        detections = np.flatnonzero(output > max(CHIRP_THRESHOLD * np.median(output), min_output))
+        if len(detections) == 0:
+            return -1
+        first = detections[0]
+        return first + int(np.argmax(output[first:first + chirp_size]))
+
+
     def __process_message(self, audio_data):
-        window_size = self.__params.get_window_size()
+        window_size = self.__window_size
         max_payload_size = self.__params.get_max_payload_size()
 
         # this will speed up decoding, and align force a multiple of window_size frames
@@ -191,75 +707,36 @@ class MessageDecoder(threading.Thread):
         max_size = self.__calc_message_size(max_payload_size, FrequencySet.RECV)
         audio_data = audio_data[:min(new_size, max_size)]
 
-        frequencies = self.__params.get_frequencies(FrequencySet.RECV)
-        bin_data_ch = [[] for _ in range(len(frequencies))]
-        for ch, _ in enumerate(frequencies):
-            fbin_data = self.__fourier(ch, audio_data)
-            min_value = fbin_data[0]
-            max_value = fbin_data[1]
-            for value in fbin_data:
-                threshold = (min_value + max_value) / 2
-                if value > threshold:
-                    bin_data_ch[ch].append(1)
-                    max_value = value
-                else:
-                    bin_data_ch[ch].append(0)
-                    min_value = value
-
-        # drop start seq and parity bits
-        for channel, _ in enumerate(frequencies):
-            no_start_seq = bin_data_ch[channel][len(START_SEQ):]
-            bin_data_ch[channel] = remove_parity_bits(no_start_seq)
-
-        # recreate the original bit stream
-        bin_data = []
-        for i in range(len(bin_data_ch[0])):
-            for channel, _ in enumerate(frequencies):
-                bin_data.append(bin_data_ch[channel][i])
-
-        # convert bit steam to bytes object
-        data = b''
-        cursor = 0
-        while cursor + 8 <= len(bin_data):
-            byte = bin_data[cursor:cursor + 8]
-            bit_string = ''.join(map(str, byte))
-            data += bytes([int(bit_string, 2)])
-            cursor += 8
-
-        # length of the payload
-        length = data[2] & 0x3f
-        if length + 3 > len(data):
-            # there is not enough data to recv the message (e.g., length is invalidated during transmission)
-            return -1
-
-        # do the `normal' parity check
-        data = data[:length + 3]
-        if redundancy_check16(data) != 0:
+        fbin_data_ch = self.__fourier(audio_data).T
+        message = decode_message(self.__params, fbin_data_ch)
+        if message is None:
             return -1
 
-        # drop header containing redundancy check and length (3 byte)
-        message = data[3:]
-
-        # TODO: we can check parity bits however, this tured out to be quite a difficult/ugly task
-
         print(f'recved: {message}')
 
-        with self.__messages_lock:
-            self.__messages.append(message)
+        if self.__spectrum_feed is not None and self.__spectrum_feed.has_subscribers():
+            # halfway between the off and on level of the start sequence
+            start_seq = self.__params.get_start_seq()
+            sync_windows = self.__params.get_preamble_windows() - len(start_seq)
+            levels = [preamble_levels(fbin_data[sync_windows:], start_seq) for fbin_data in fbin_data_ch]
+            self.__spectrum_feed.set_thresholds([(off_level + on_level) / 2 for off_level, on_level in levels])
+
+        self.__messages.put(message)
 
         return self.__calc_message_size(len(message), FrequencySet.RECV)
 
 
     def __process(self):
-        window_size = self.__params.get_window_size()
+        window_size = self.__window_size
         max_required = self.__calc_message_size(self.__params.get_max_payload_size(), FrequencySet.RECV)
 
         cursor = 0
         while cursor + max_required <= len(self.__decode_buffer):
             offset = self.__find_start(self.__decode_buffer[cursor:])
             if offset == -1:
-                # no start sequence found, drop entire buffer
-                return len(self.__decode_buffer)
+                # no start sequence found, drop the buffer except for the
+                # part that may contain the beginning of a preamble
+                return max(cursor, len(self.__decode_buffer) - self.__search_size)
             cursor += offset
 
             if cursor + max_required > len(self.__decode_buffer):
@@ -280,18 +757,30 @@ class MessageDecoder(threading.Thread):
     def __wait_for_data(self):
         new_data = np.empty((0,), dtype='float32')
         with self.__buffer_lock:
+            self.__idle = True
+            self.__buffer_lock.notify_all()
             while len(self.__buffer) == 0:
                 self.__buffer_lock.wait()
                 if not self.__running:
                     return new_data
             new_data = self.__buffer
             self.__buffer = np.empty((0,), dtype='float32')
+            self.__idle = False
         return new_data
 
 
     def run(self):
         while self.__running:
             new_data = self.__wait_for_data()
+            if self.__front_end is not None:
+                new_data = self.__front_end.process(new_data)
+            if self.__squelch is not None:
+                # silent audio is not searched for a start sequence
+                new_data = self.__squelch.process(new_data)
+                if len(new_data) == 0:
+                    continue
+            elif self.__spectrum_feed is not None:
+                self.__publish_spectrum(new_data)
             self.__decode_buffer = np.hstack([self.__decode_buffer, new_data])
 
             processed = self.__process()
@@ -306,21 +795,33 @@ class MessageDecoder(threading.Thread):
     def add_frames(self, frames):
         with self.__buffer_lock:
             self.__buffer = np.hstack([self.__buffer, frames])
-            self.__buffer_lock.notify()
+            self.__idle = False
+            self.__buffer_lock.notify_all()
+
+
+    # block until all frames added so far are processed, returns false on a timeout
+    def wait_idle(self, timeout=None):
+        with self.__buffer_lock:
+            return self.__buffer_lock.wait_for(lambda: self.__idle, timeout)
+
+
+    # see MessageQueue.get_message
+    def get_message(self, block=False, timeout=None):
+        return self.__messages.get_message(block, timeout)
+
+
+    # see MessageQueue.get_messages
+    def get_messages(self, max_n=None, block=False, timeout=None):
+        return self.__messages.get_messages(max_n, block, timeout)
 
 
-    def get_message(self):
-        message = None
-        with self.__messages_lock:
-            if self.__messages:
-                message = self.__messages[0]
-                self.__messages = self.__messages[1:]
-        return message
+    def get_dropped(self):
+        return self.__messages.get_dropped()
 
 
     def stop(self):
         self.__running = False
         with self.__buffer_lock:
-            self.__buffer_lock.notify()
+            self.__buffer_lock.notify_all()
         self.join()
 
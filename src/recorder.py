@@ -0,0 +1,285 @@
+import json
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from echo_canceller import EchoCanceller
+from transmission_parameters import AnalysisWindow
+from transmission_parameters import Preamble
+from transmission_parameters import TransmissionParameters
+
+# a recording starts with MAGIC, the length of the json header and the json
+# header itself, followed by a single zlib stream of blocks
+MAGIC = b'BEEPREC1'
+# every block starts with its type, the time (s) since the start of the
+# recording and the number of float32 samples. The samples are stored byte
+# plane by byte plane (i.e., all first bytes, then all second bytes, etc.),
+# the exponent bytes of audio hardly change and compress well this way.
+BLOCK_HEADER = struct.Struct('>Bdi')
+RECORDED = 0x52
+PLAYED = 0x50
+# default limit of the size of a recording on disk
+MAX_RECORDING_SIZE = 64 * 1024 * 1024 # 64 MiB
+
+
+def parameters_to_dict(params):
+    return {
+        'sample_rate': params.get_sample_rate(),
+        'window_length': params.get_window_length(),
+        'base_freq': params.get_base_freq(),
+        'num_channels': params.get_num_channels(),
+        'is_master': params.get_is_master(),
+        'max_payload_size': params.get_max_payload_size(),
+        'seq_max': params.get_seq_max(),
+        'bits_per_symbol': params.get_bits_per_symbol(),
+        'preamble': params.get_preamble().name,
+        'full_duplex': params.get_full_duplex(),
+        'channel_spacing': params.get_channel_spacing(),
+        'symbol_ramp': params.get_symbol_ramp(),
+        'analysis_window': params.get_analysis_window().name,
+        'gain_equalization': params.get_gain_equalization(),
+        'squelch': params.get_squelch(),
+        'front_end': params.get_front_end(),
+        'echo_cancellation': params.get_echo_cancellation(),
+    }
+
+
+def parameters_from_dict(header):
+    params = TransmissionParameters()
+    params.set_sample_rate(header['sample_rate'])
+    params.set_window_length(header['window_length'])
+    params.set_base_freq(header['base_freq'])
+    params.set_num_channels(header['num_channels'])
+    params.set_is_master(header['is_master'])
+    params.set_max_payload_size(header['max_payload_size'])
+    params.set_seq_max(header['seq_max'])
+    params.set_bits_per_symbol(header['bits_per_symbol'])
+    # recordings made before the preamble was configurable use START_SEQ
+    params.set_preamble(Preamble[header.get('preamble', Preamble.ON_OFF.name)])
+    params.set_full_duplex(header.get('full_duplex', False))
+    params.set_channel_spacing(header.get('channel_spacing', 0.2))
+    params.set_symbol_ramp(header.get('symbol_ramp', 0.0))
+    params.set_analysis_window(AnalysisWindow[header.get('analysis_window', AnalysisWindow.RECTANGULAR.name)])
+    params.set_gain_equalization(header.get('gain_equalization', True))
+    # recordings made before the squelch and front end were stored are
+    # decoded without them
+    params.set_squelch(header.get('squelch', False))
+    params.set_front_end(header.get('front_end', False))
+    # the audio of older recordings was recorded after the echo canceller
+    params.set_echo_cancellation(header.get('echo_cancellation', False))
+    return params
+
+
+# Tees the audio of a session to disk, i.e., the captured audio, the played
+# frames and the time at which they passed. The recording stops (the file
+# stays valid) once max_size bytes are written. The captured audio is
+# recorded before the echo canceller, the played frames (as written to the
+# sound card) are its reference. The played frames are added by the audio
+# thread and the recorded ones by the thread that records.
+class SessionRecorder:
+    def __init__(self, path, params, max_size=MAX_RECORDING_SIZE):
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'wb')
+        self.__compressor = zlib.compressobj(6)
+        self.__max_size = max_size
+        self.__start = time.monotonic()
+        self.__full = False
+
+        # the header is written with the first block, the audio stream sets
+        # the delay of the echo before
+        self.__header = parameters_to_dict(params)
+        self.__header['echo_delay'] = 0
+        self.__size = 0
+
+
+    # delay (samples) of the echo canceller, i.e., the output latency
+    def set_echo_delay(self, delay):
+        self.__header['echo_delay'] = delay
+
+
+    def __write_header(self):
+        if self.__size == 0:
+            header = json.dumps(self.__header).encode('utf-8')
+            self.__file.write(MAGIC + len(header).to_bytes(4, 'big') + header)
+            self.__size = self.__file.tell()
+
+
+    def __add_block(self, block_type, frames):
+        frames = np.asarray(frames, dtype='<f4')
+        planes = frames.view('uint8').reshape((-1, 4)).T.tobytes()
+        with self.__lock:
+            if self.__full or self.__file.closed:
+                return
+            self.__write_header()
+
+            block = BLOCK_HEADER.pack(block_type, time.monotonic() - self.__start, len(frames))
+            # every block is flushed, such that the file ends at a block
+            # boundary when the limit is reached
+            data = self.__compressor.compress(block + planes)
+            data += self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+            if self.__size + len(data) > self.__max_size:
+                print('Warning recording is full, stopped recording')
+                self.__full = True
+                return
+
+            self.__file.write(data)
+            self.__size += len(data)
+
+
+    def add_recorded(self, frames):
+        self.__add_block(RECORDED, frames)
+
+
+    def add_played(self, frames):
+        self.__add_block(PLAYED, frames)
+
+
+    def is_full(self):
+        return self.__full
+
+
+    def close(self):
+        with self.__lock:
+            if not self.__file.closed:
+                self.__write_header()
+                # the compressor contains the block that did not fit anymore
+                if not self.__full:
+                    self.__file.write(self.__compressor.flush())
+                self.__file.close()
+
+
+# removes the echo from the recorded frames of blocks, the played frames are
+# the reference
+def cancel_echo(params, delay, blocks):
+    echo_canceller = EchoCanceller(params, delay)
+    for block_type, timestamp, frames in blocks:
+        if block_type == PLAYED:
+            echo_canceller.add_played(frames)
+        elif block_type == RECORDED:
+            frames = echo_canceller.process(frames)
+        yield block_type, timestamp, frames
+
+
+# returns (params, blocks) where blocks yields (type, time, frames) of every
+# block in the recording. A truncated recording yields the complete blocks.
+# With echo_cancellation the recorded frames are passed through the echo
+# canceller, if the session used one.
+def read_recording(path, echo_cancellation=False):
+    file = open(path, 'rb')
+    if file.read(len(MAGIC)) != MAGIC:
+        file.close()
+        raise ValueError(f'{path} is not a recording')
+    header_size = int.from_bytes(file.read(4), 'big')
+    header = json.loads(file.read(header_size))
+    params = parameters_from_dict(header)
+
+    def blocks():
+        decompressor = zlib.decompressobj()
+        buffer = bytearray()
+        with file:
+            while True:
+                data = file.read(64 * 1024)
+                if data:
+                    buffer += decompressor.decompress(data)
+                while len(buffer) >= BLOCK_HEADER.size:
+                    block_type, timestamp, nframes = BLOCK_HEADER.unpack_from(buffer)
+                    end = BLOCK_HEADER.size + 4 * nframes
+                    if len(buffer) < end:
+                        break
+                    planes = np.frombuffer(bytes(buffer[BLOCK_HEADER.size:end]), dtype='uint8')
+                    frames = planes.reshape((4, -1)).T.copy().view('<f4')[:, 0]
+                    del buffer[:end]
+                    yield block_type, timestamp, frames.astype('float32')
+                if not data:
+                    return
+
+    if echo_cancellation and params.get_echo_cancellation():
+        return params, cancel_echo(params, header.get('echo_delay', 0), blocks())
+    return params, blocks()
+
+
+# Audio stream that plays back the captured audio of a recording, this can be
+# passed to a SlidingWindow (or LinkProbe, Hub) instead of an AudioStream.
+# With realtime the audio is returned at the pace it was recorded, otherwise
+# every call of record returns the next block. Played frames are discarded.
+class ReplayStream:
+    def __init__(self, path, realtime=False):
+        self.__params, self.__blocks = read_recording(path, echo_cancellation=True)
+        self.__realtime = realtime
+        self.__start = None
+        self.__next = None
+        self.__done = False
+
+
+    # the parameters of the recorded session
+    def get_parameters(self):
+        return self.__params
+
+
+    def __next_block(self):
+        for block_type, timestamp, frames in self.__blocks:
+            if block_type == RECORDED:
+                return timestamp, frames
+        self.__done = True
+        return None
+
+
+    def start(self):
+        self.__start = time.monotonic()
+
+
+    def stop(self):
+        self.__done = True
+
+
+    def play(self, frames):
+        pass
+
+
+    def record(self):
+        if self.__start is None:
+            self.start()
+
+        chunks = []
+        elapsed = time.monotonic() - self.__start
+        while not self.__done:
+            if self.__next is None:
+                self.__next = self.__next_block()
+                if self.__next is None:
+                    break
+            timestamp, frames = self.__next
+            if self.__realtime and timestamp > elapsed:
+                break
+            chunks.append(frames)
+            self.__next = None
+            if not self.__realtime:
+                break
+        return np.hstack(chunks) if chunks else np.empty((0,), dtype='float32')
+
+
+    # all captured audio has been returned by record
+    def is_done(self):
+        return self.__done and self.__next is None
+
+
+# decodes the captured audio of a recording as fast as possible, returns
+# the received messages and the time (s) it took to decode them
+def replay_decode(path, params=None):
+    from message_protocol import MessageDecoder
+
+    recording_params, blocks = read_recording(path, echo_cancellation=True)
+    decoder = MessageDecoder(params or recording_params)
+    decoder.start()
+
+    start = time.perf_counter()
+    for block_type, _, frames in blocks:
+        if block_type == RECORDED:
+            decoder.add_frames(frames)
+    decoder.wait_idle()
+    elapsed = time.perf_counter() - start
+    decoder.stop()
+
+    return decoder.get_messages(), elapsed
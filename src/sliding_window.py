@@ -1,33 +1,213 @@
+import collections
+import threading
 import time
 import math
+import zlib
 
 import numpy as np
 
+from message_protocol import EncoderPipeline
 from message_protocol import MessageDecoder
-from message_protocol import MessageEncoder
 from transmission_parameters import FrequencySet
+from transmission_parameters import MAX_STREAMS
 from audio_stream import AudioStream
+from compression import StreamCompressor
+from compression import StreamDecompressor
+
+# flags in the first byte of every frame, the lower 4 bits contain the sequence number
+HEADER_ACK = 0x80
+HEADER_MASTER = 0x40
+# the sender of the frame is able to decompress payloads
+HEADER_COMPRESSION = 0x20
+# the payload of the frame is part of the compressed stream
+HEADER_COMPRESSED = 0x10
+
+# high-water marks of the send and recv buffers (of every stream)
+MAX_SEND_BUF_SIZE = 1024 * 1024 # 1 MiB
+MAX_RECV_BUF_SIZE = 1024 * 1024 # 1 MiB
+
+# with multiple streams the payload of a data frame is a sequence of
+# segments, every segment starts with a byte containing the stream (upper 2
+# bits) and the length of the segment data (lower 6 bits)
+SEGMENT_STREAM_SHIFT = 6
+SEGMENT_LENGTH_MASK = 0x3f
 
 
-class SlidingWindow:
-    def __init__(self, params):
-        self.__params = params
+# The send and recv buffers of one logical stream of a SlidingWindow. Every
+# stream is compressed separately, as the frames interleave the streams. The
+# caller has to hold the buffer lock of the sliding window.
+class LogicalStream:
+    def __init__(self):
+        # the send buffer is a queue of memoryviews (i.e., the data passed to
+        # send is not copied) and the number of bytes queued
+        self.__send_buffer = collections.deque()
+        self.__send_buffer_size = 0
+        # number of bytes at the head of the send buffer that are sent
+        # without waiting for more data, see SlidingWindow.flush
+        self.__flushed = 0
+        self.__recv_buffer = bytearray()
+        self.__priority = 0
+
+        self.__compressing = False
+        self.__compressor = StreamCompressor()
+        self.__decompressor = StreamDecompressor()
+        # the compressed stream could not be decompressed, e.g., a corrupted
+        # frame passed the redundancy check. The data that follows can not
+        # be decompressed anymore and is dropped.
+        self.__broken = False
+
+
+    def set_priority(self, priority):
+        self.__priority = priority
+
+
+    def get_priority(self):
+        return self.__priority
+
+
+    # from now on the send buffer contains the compressed stream
+    def start_compression(self):
+        self.__compressing = True
+        if self.__send_buffer:
+            data = self.__compressor.compress(b''.join(self.__send_buffer))
+            self.__send_buffer = collections.deque([memoryview(data)])
+            self.__send_buffer_size = len(data)
+            self.__flushed = min(self.__flushed, self.__send_buffer_size)
+
+
+    def put(self, data):
+        if self.__compressing:
+            data = self.__compressor.compress(data)
+        if len(data) > 0:
+            self.__send_buffer.append(memoryview(data).cast('B'))
+            self.__send_buffer_size += len(data)
+
+
+    # remove at most size bytes from the head of the send buffer
+    def take(self, size):
+        chunks = []
+        while size > 0 and self.__send_buffer:
+            chunk = self.__send_buffer.popleft()
+            if len(chunk) > size:
+                self.__send_buffer.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.__send_buffer_size -= len(chunk)
+            self.__flushed = max(0, self.__flushed - len(chunk))
+        return b''.join(chunks)
+
+
+    def get_send_buffer_size(self):
+        return self.__send_buffer_size
+
+
+    # the data queued so far is sent without waiting for more data
+    def flush(self):
+        self.__flushed = self.__send_buffer_size
+
+
+    def is_flushed(self):
+        return self.__flushed > 0
+
+
+    def deliver(self, payload, compressed):
+        if self.__broken:
+            return
+        if compressed:
+            try:
+                payload = self.__decompressor.decompress(payload)
+            except zlib.error as e:
+                print(f'Error decompressing stream, dropping its data: {e}')
+                self.__broken = True
+                return
+        self.__recv_buffer += payload
+
+
+    def is_broken(self):
+        return self.__broken
+
+
+    def get_recv_buffer_size(self):
+        return len(self.__recv_buffer)
+
+
+    def recv(self):
+        data = bytes(self.__recv_buffer)
+        self.__recv_buffer.clear()
+        return data
 
-        self.__send_buffer = b''
+
+# splits the payload of a data frame into (stream, data) segments, a
+# truncated segment ends the payload
+def split_segments(payload):
+    segments = []
+    cursor = 0
+    while cursor < len(payload):
+        stream = payload[cursor] >> SEGMENT_STREAM_SHIFT
+        length = payload[cursor] & SEGMENT_LENGTH_MASK
+        if cursor + 1 + length > len(payload):
+            print(f'truncated segment in {payload}')
+            break
+        segments.append((stream, payload[cursor + 1:cursor + 1 + length]))
+        cursor += 1 + length
+    return segments
+
+
+# The data passed to send is transmitted reliably (Go Back N) over the audio
+# link. With num_streams > 1 the link carries multiple logical streams, each
+# with its own send and recv buffer. Every data frame is filled from the
+# streams with the highest priority first, streams of the same priority take
+# turns in being the first stream of a frame.
+class SlidingWindow:
+    # audio_stream and message_decoder can be shared with other sliding
+    # windows (see Hub). In that case the owner of the decoder records the
+    # audio stream and feeds the decoder, this object only uses them.
+    # recorder (a SessionRecorder) is passed to the audio stream and
+    # spectrum_feed (a SpectrumFeed) to the decoder created by this object.
+    # The timeouts are measured by clock (s), e.g., the time of a simulated
+    # stream (see SimulatedStream.get_time) that runs faster than real time.
+    def __init__(self, params, audio_stream=None, message_decoder=None, recorder=None, spectrum_feed=None,
+            clock=time.time):
+        self.__params = params.snapshot()
+        self.__clock = clock
+
+        assert 1 <= self.__params.get_num_streams() <= MAX_STREAMS
+        self.__streams = [LogicalStream() for _ in range(self.__params.get_num_streams())]
+        # the stream that is served first among streams of the same priority
+        self.__next_stream = 0
+        # time at which queued data is sent even if it does not fill a frame,
+        # see TransmissionParameters.set_coalesce_delay
+        self.__send_due = 0.0
         self.__send_frames = (self.__params.get_seq_max() + 1) * [None]
         self.__send_ack = 0
         self.__send_seq = 0
         self.__timeout = 0
 
-        self.__recv_buffer = b''
         self.__recv_seq = 0
 
-        self.__message_decoder = MessageDecoder(self.__params)
-        self.__message_encoder = MessageEncoder(self.__params)
-        self.__message_decoder.start()
+        # protects the buffers, send and recv can be called from other threads than tick
+        self.__buffer_lock = threading.Condition()
+
+        # the send buffers are compressed once both sides support compression
+        self.__compressing = False
+
+        self.__owns_decoder = message_decoder is None
+        if self.__owns_decoder:
+            message_decoder = MessageDecoder(self.__params, spectrum_feed)
+            message_decoder.start()
+        self.__message_decoder = message_decoder
 
-        self.__audio_stream = AudioStream(self.__params)
-        self.__audio_stream.start()
+        self.__owns_stream = audio_stream is None
+        if self.__owns_stream:
+            audio_stream = AudioStream(self.__params, recorder)
+            audio_stream.start()
+        self.__audio_stream = audio_stream
+
+        # frames are encoded on a worker thread, the audio of a data frame is
+        # cached until it has been acknowledged
+        self.__encoder_pipeline = EncoderPipeline(self.__params, self.__audio_stream.play)
+        self.__encoder_pipeline.start()
 
         self.__on_send_complete = lambda: None
         self.__on_data_available = lambda: None
@@ -37,43 +217,87 @@ class SlidingWindow:
         print(f'recving freq set: {self.__params.get_frequencies(FrequencySet.RECV)}')
 
 
+    def __header(self):
+        header = 0x00
+        header |= HEADER_MASTER if self.__params.get_is_master() else 0x00
+        header |= HEADER_COMPRESSION if self.__params.get_compression() else 0x00
+        return header
+
+
     def __send_ack_message(self):
         print(f'send_ack_message {self.__recv_seq}')
-        header = 0x00
-        header |= 0x80
-        header |= 0x40 if self.__params.get_is_master() else 0x00
+        header = self.__header()
+        header |= HEADER_ACK
         message = bytes([header | self.__recv_seq])
+        self.__encoder_pipeline.submit(message)
 
-        audio_data = self.__message_encoder.encode(message)
-        self.__audio_stream.play(audio_data)
+
+    # the streams with data to send, in the order they fill the next frame
+    def __schedule(self):
+        nstreams = len(self.__streams)
+        order = [i for i, stream in enumerate(self.__streams) if stream.get_send_buffer_size()]
+        order.sort(key=lambda i: (-self.__streams[i].get_priority(), (i - self.__next_stream) % nstreams))
+        return order
+
+
+    # the payload of the next data frame, at most size bytes
+    def __take_send_data(self, size):
+        with self.__buffer_lock:
+            if len(self.__streams) == 1:
+                payload = self.__streams[0].take(size)
+            else:
+                order = self.__schedule()
+                if order:
+                    self.__next_stream = (order[0] + 1) % len(self.__streams)
+                segments = []
+                for i in order:
+                    if size <= 1:
+                        break
+                    data = self.__streams[i].take(min(size - 1, SEGMENT_LENGTH_MASK))
+                    segments.append(bytes([i << SEGMENT_STREAM_SHIFT | len(data)]) + data)
+                    size -= 1 + len(data)
+                payload = b''.join(segments)
+
+            # the remainder waits for more data again, unless it was flushed
+            if any(buffers.get_send_buffer_size() for buffers in self.__streams):
+                self.__send_due = self.__clock() + self.__params.get_coalesce_delay()
+            self.__buffer_lock.notify_all()
+        return payload
+
+
+    # pass the payload of a data frame to the recv buffers
+    def __deliver(self, payload, compressed):
+        if len(self.__streams) == 1:
+            segments = [(0, payload)]
+        else:
+            segments = split_segments(payload)
+        with self.__buffer_lock:
+            for i, data in segments:
+                if i >= len(self.__streams):
+                    print(f'segment of unknown stream {i}')
+                    continue
+                self.__streams[i].deliver(data, compressed)
 
 
     def __send_data_message(self):
         max_payload_size = self.__params.get_max_payload_size()
-        data_available = len(self.__send_buffer)
 
-        header = 0x00
-        header |= 0x40 if self.__params.get_is_master() else 0x00
+        header = self.__header()
+        header |= HEADER_COMPRESSED if self.__compressing else 0x00
         header |= self.__send_seq
 
-        message_size = min(data_available, max_payload_size - 1)
-        message = bytes([header]) + self.__send_buffer[:message_size]
-        self.__send_buffer = self.__send_buffer[message_size:]
+        message = bytes([header]) + self.__take_send_data(max_payload_size - 1)
 
-        # save message such that it can be resent later if a timeout occurs
+        # the rendered audio is kept such that it can be resent later if a timeout occurs
         self.__send_frames[self.__send_seq] = message
-
-        audio_data = self.__message_encoder.encode(message)
-        self.__audio_stream.play(audio_data)
+        self.__encoder_pipeline.submit(message, self.__send_seq)
         print(f'send_data_message {message}')
 
 
     def __resend_data_message(self, seq):
         message = self.__send_frames[seq]
         print(f'resend_data_message {message}')
-
-        audio_data = self.__message_encoder.encode(message)
-        self.__audio_stream.play(audio_data)
+        self.__encoder_pipeline.replay(seq)
 
 
     def attach_on_send_complete(self, func):
@@ -84,47 +308,125 @@ class SlidingWindow:
         self.__on_data_available = func
 
 
-    # send data, returns immediately.
-    def send(self, data):
-        self.__send_buffer += data
+    # the remote side is able to decompress, from now on the send buffers
+    # contain the compressed streams
+    def __start_compression(self):
+        print('remote side supports compression')
+        with self.__buffer_lock:
+            self.__compressing = True
+            for stream in self.__streams:
+                stream.start_compression()
+
+
+    # data of streams with a higher priority is sent first, the default
+    # priority of all streams is 0
+    def set_stream_priority(self, stream, priority):
+        with self.__buffer_lock:
+            self.__streams[stream].set_priority(priority)
+
+
+    # send data on a stream, the data should not be modified after it has
+    # been passed. If more than MAX_SEND_BUF_SIZE bytes are queued on the
+    # stream, the data is only accepted once tick has made room. Without
+    # block this returns False immediately, otherwise it waits at most timeout
+    # seconds (forever if timeout is None), which requires tick to be called
+    # from another thread. Returns True if the data has been queued.
+    def send(self, data, block=False, timeout=None, stream=0):
+        with self.__buffer_lock:
+            has_room = lambda: self.__streams[stream].get_send_buffer_size() < MAX_SEND_BUF_SIZE
+            if not self.__buffer_lock.wait_for(has_room, timeout if block else 0):
+                return False
+            if not any(buffers.get_send_buffer_size() for buffers in self.__streams):
+                self.__send_due = self.__clock() + self.__params.get_coalesce_delay()
+            self.__streams[stream].put(data)
+        return True
+
+
+    # send the data queued so far with the next tick, without waiting for
+    # more data to fill the frame. Data queued later is coalesced again.
+    def flush(self):
+        with self.__buffer_lock:
+            for stream in self.__streams:
+                stream.flush()
+
+
+    # a partial frame is held back while frames are outstanding, until it is
+    # due. Without outstanding frames nothing is gained by waiting, as the
+    # data is only acknowledged once it has been sent.
+    def __is_held(self, outstanding):
+        max_payload_size = self.__params.get_max_payload_size()
+        with self.__buffer_lock:
+            if outstanding == 0 or self.__clock() >= self.__send_due or \
+                    any(buffers.is_flushed() for buffers in self.__streams):
+                return False
+            sizes = [buffers.get_send_buffer_size() for buffers in self.__streams]
+            # every stream in a frame takes a segment header
+            overhead = np.count_nonzero(sizes) if len(sizes) > 1 else 0
+            return sum(sizes) + overhead < max_payload_size - 1
 
 
-    # try to receive data, returns a byte array of size >= 0
-    def recv(self):
-        data = self.__recv_buffer
-        self.__recv_buffer = b''
-        return data
+    # number of bytes that are queued but have not been put in a frame yet,
+    # of a stream or of all streams if stream is None
+    def get_send_buffer_size(self, stream=None):
+        with self.__buffer_lock:
+            if stream is not None:
+                return self.__streams[stream].get_send_buffer_size()
+            return sum(buffers.get_send_buffer_size() for buffers in self.__streams)
+
+
+    # all data passed to send has been acknowledged, can be called from
+    # other threads than tick
+    def is_send_complete(self):
+        with self.__buffer_lock:
+            return self.__send_ack == self.__send_seq and \
+                    not any(buffers.get_send_buffer_size() for buffers in self.__streams)
+
+
+    # try to receive data of a stream, returns a bytes object of size >= 0
+    def recv(self, stream=0):
+        with self.__buffer_lock:
+            return self.__streams[stream].recv()
+
+
+    # the received data of a stream could not be decompressed, nothing is
+    # received on the stream anymore
+    def is_stream_broken(self, stream=0):
+        with self.__buffer_lock:
+            return self.__streams[stream].is_broken()
 
 
     # stop and close connection
     def stop(self):
-        self.__message_decoder.stop()
-        self.__audio_stream.stop()
+        self.__encoder_pipeline.stop()
+        if self.__owns_decoder:
+            self.__message_decoder.stop()
+        if self.__owns_stream:
+            self.__audio_stream.stop()
         print('called stop on sliding window object')
 
 
     # because this is a polling based system, this object required periodic updates
     # to process the data, call this methods around 10 times a second
     def tick(self):
-        recv_data = self.__audio_stream.record()
-        self.__message_decoder.add_frames(recv_data)
+        if self.__owns_decoder:
+            recv_data = self.__audio_stream.record()
+            self.__message_decoder.add_frames(recv_data)
 
         window_size = self.__params.get_seq_max()
         # note this is NOT the same window size in the en/decoder
         # methods, rather it is the max number of frames in the
         # Go Back N protocol
-        while True:
-            message = self.__message_decoder.get_message()
-            if message is None:
-                break
+        # all decoded messages are retrieved at once
+        for message in self.__message_decoder.get_messages():
             if len(message) == 0:
                 print('Received empty message, this should not happen')
                 continue
 
             # Go Back N (sliding window) status
             status = message[0]
-            ack = bool(status & 0x80)
-            is_master = bool(status & 0x40)
+            ack = bool(status & HEADER_ACK)
+            is_master = bool(status & HEADER_MASTER)
+            compressed = bool(status & HEADER_COMPRESSED)
             seq = status & 0x0f
 
             if is_master == self.__params.get_is_master():
@@ -134,36 +436,54 @@ class SlidingWindow:
                 print('trigged on my own message')
                 continue
 
+            if status & HEADER_COMPRESSION and self.__params.get_compression() and not self.__compressing:
+                self.__start_compression()
+
             if ack:
-                # we received a acknowledgement
-                self.__send_ack = seq
-                if self.__send_ack == self.__send_seq and not self.__send_buffer:
+                # we received a acknowledgement, the frames before seq
+                # will not be resent. Stale acknowledgements are ignored.
+                acked = (seq - self.__send_ack) % (window_size + 1)
+                if acked > (self.__send_seq - self.__send_ack) % (window_size + 1):
+                    print(f'ignoring stale ack {seq}')
+                    continue
+                while self.__send_ack != seq:
+                    self.__encoder_pipeline.release(self.__send_ack)
+                    self.__send_ack = (self.__send_ack + 1) % (window_size + 1)
+                if self.__send_ack == self.__send_seq and not self.get_send_buffer_size():
                     self.__on_send_complete()
             else:
                 # we received a new data frame
-                if self.__recv_seq == seq:
-                    self.__recv_buffer += message[1:]
+                # do not accept new frames if the application does not keep
+                # up (on any stream), the remote side resends them after a timeout
+                with self.__buffer_lock:
+                    has_room = all(buffers.get_recv_buffer_size() < MAX_RECV_BUF_SIZE
+                            for buffers in self.__streams)
+                if self.__recv_seq == seq and has_room:
+                    self.__deliver(message[1:], compressed)
                     self.__recv_seq = (self.__recv_seq + 1) % (self.__params.get_seq_max() + 1)
                 self.__send_ack_message()
                 self.__on_data_available()
 
         # Try to send some data, if available
-        while self.__send_buffer:
+        while self.get_send_buffer_size():
             # check if we can send (i.e., 1 or more frames had been acknowledged or not
             # window_size frames have been send yet).
             diff = (self.__send_seq - self.__send_ack) % (window_size + 1)
-            if window_size - diff <= 0:
+            if window_size - diff <= 0 or self.__is_held(diff):
                 break
 
-            self.__send_data_message()
-            self.__send_seq = (self.__send_seq + 1) % (window_size + 1)
-            self.__timeout = time.time() + self.__params.get_timeout()
+            # the data leaves the send buffer and becomes outstanding at once,
+            # see is_send_complete
+            with self.__buffer_lock:
+                self.__send_data_message()
+                self.__send_seq = (self.__send_seq + 1) % (window_size + 1)
+            self.__timeout = self.__clock() + self.__params.get_timeout()
 
-        if time.time() > self.__timeout:
+        if self.__clock() > self.__timeout:
             start = self.__send_ack
             end = self.__send_seq
             while (end - start) % (window_size + 1) != 0:
                 self.__resend_data_message(start)
                 start = (start + 1) % (window_size + 1)
-            self.__timeout = time.time() + self.__params.get_timeout()
+            self.__timeout = self.__clock() + self.__params.get_timeout()
 
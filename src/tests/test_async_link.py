@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+import asyncio
+import sys
+
+sys.path.append('..')
+from async_link import AsyncLink
+
+
+# reliable byte stream with the interface of a sliding window, every tick
+# moves at most rate bytes to the other side and fires the callbacks
+class Link:
+    def __init__(self, rate):
+        self.peer = None
+        self.rate = rate
+        self.error = None
+        self.send_buffer = bytearray()
+        self.recv_buffer = bytearray()
+        self.on_send_complete = lambda: None
+        self.on_data_available = lambda: None
+
+
+    def attach_on_send_complete(self, func):
+        self.on_send_complete = func
+
+
+    def attach_on_data_availbale(self, func):
+        self.on_data_available = func
+
+
+    def send(self, data, block=False, timeout=None):
+        if len(self.send_buffer) >= 100:
+            return False
+        self.send_buffer += data
+        return True
+
+
+    def get_send_buffer_size(self):
+        return len(self.send_buffer)
+
+
+    def flush(self):
+        pass
+
+
+    def is_send_complete(self):
+        return not self.send_buffer
+
+
+    def recv(self):
+        data = bytes(self.recv_buffer)
+        self.recv_buffer.clear()
+        return data
+
+
+    def tick(self):
+        if self.error is not None:
+            raise self.error
+        if not self.send_buffer:
+            return
+        data = self.send_buffer[:self.rate]
+        del self.send_buffer[:self.rate]
+        self.peer.recv_buffer += data
+        self.peer.on_data_available()
+        if not self.send_buffer:
+            self.on_send_complete()
+
+
+    def stop(self):
+        pass
+
+
+async def transfer(org_data):
+    link_a = Link(10)
+    link_b = Link(10)
+    link_a.peer = link_b
+    link_b.peer = link_a
+
+    async_link_a = AsyncLink(link_a, tick_interval=0.001)
+    async_link_b = AsyncLink(link_b, tick_interval=0.001)
+    async_link_a.start()
+    async_link_b.start()
+    writer = async_link_a.get_writer()
+    reader = async_link_b.get_reader()
+
+    async def write():
+        for i in range(0, len(org_data), 50):
+            writer.write(org_data[i:i + 50])
+            await writer.drain()
+        await writer.wait_sent()
+
+    write_task = asyncio.ensure_future(write())
+    recv_data = await asyncio.wait_for(reader.readexactly(len(org_data)), 10)
+    await asyncio.wait_for(write_task, 10)
+
+    writer.close()
+    await writer.wait_closed()
+    await async_link_b.stop()
+    return recv_data
+
+
+def test_transfer():
+    org_data = bytes(range(256)) * 10
+    recv_data = asyncio.run(transfer(org_data))
+    if recv_data != org_data:
+        print('test_transfer failed')
+        print(recv_data)
+    else:
+        print('test_transfer success')
+
+
+# a completion that is scheduled before a write does not complete the write
+async def stale_completion():
+    link = Link(10)
+    link.peer = Link(10)
+    async_link = AsyncLink(link)
+    writer = async_link.get_writer()
+    await writer.wait_sent()
+
+    # the link is not ticked, the data is never sent
+    link.on_send_complete()
+    writer.write(b'hello')
+    try:
+        await asyncio.wait_for(writer.wait_sent(), 0.2)
+        completed = True
+    except asyncio.TimeoutError:
+        completed = False
+    await async_link.stop()
+    return completed
+
+
+def test_stale_completion():
+    if asyncio.run(stale_completion()):
+        print('test_stale_completion failed')
+    else:
+        print('test_stale_completion success')
+
+
+# an exception raised by tick is passed to the waiting readers and writers
+async def failing_tick():
+    link = Link(10)
+    link.peer = Link(10)
+    async_link = AsyncLink(link, tick_interval=0.001)
+    async_link.start()
+    reader = async_link.get_reader()
+    writer = async_link.get_writer()
+
+    # the first write fills the send buffer, the second stays pending
+    writer.write(bytes(200))
+    writer.write(bytes(200))
+    waiters = [reader.read(10), writer.drain(), writer.wait_sent()]
+    tasks = [asyncio.ensure_future(waiter) for waiter in waiters]
+    await asyncio.sleep(0.01)
+    link.error = ValueError('broken link')
+    done, _ = await asyncio.wait(tasks, timeout=1)
+    errors = [task.exception() for task in tasks if task in done]
+    await async_link.stop()
+    return errors
+
+
+def test_failing_tick():
+    errors = asyncio.run(failing_tick())
+    if len(errors) != 3 or not all(isinstance(error, ValueError) for error in errors):
+        print('test_failing_tick failed')
+        print(errors)
+    else:
+        print('test_failing_tick success')
+
+
+if __name__ == '__main__':
+    test_transfer()
+    test_stale_completion()
+    test_failing_tick()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import sys
+
+import numpy as np
+
+sys.path.append('..')
+from channel_model import ChannelModel
+from channel_model import ChannelParameters
+from channel_model import NoiseColor
+from channel_model import frame_error_rate
+from channel_model import measure_goodput
+from transmission_parameters import TransmissionParameters
+
+
+def make_params(is_master):
+    params = TransmissionParameters()
+    params.set_num_channels(4)
+    params.set_is_master(is_master)
+    return params
+
+
+def test_blocks():
+    channel_params = ChannelParameters()
+    channel_params.set_echoes([(0.01, 0.5), (0.023, -0.2)])
+    channel_params.set_band((300.0, 8000.0))
+
+    # the filter state is kept between blocks, i.e., the output does not
+    # depend on how the audio is split
+    audio_data = np.random.normal(0, 0.3, 44100).astype('float32')
+    whole = ChannelModel(make_params(True), channel_params).apply(audio_data)
+    model = ChannelModel(make_params(True), channel_params)
+    blocks = np.hstack([model.apply(audio_data[i:i + 1000]) for i in range(0, len(audio_data), 1000)])
+    if not np.allclose(whole, blocks, atol=1e-5):
+        print('test_blocks failed')
+        return
+    print('test_blocks success')
+
+
+def test_clock_skew():
+    channel_params = ChannelParameters()
+    channel_params.set_clock_skew(1000.0)
+    model = ChannelModel(make_params(True), channel_params)
+
+    t = np.arange(441000) / 44100
+    audio_data = np.sin(2 * np.pi * 1000 * t).astype('float32')
+    resampled = np.hstack([model.apply(audio_data[i:i + 4410]) for i in range(0, len(audio_data), 4410)])
+
+    # the tone is 0.1 % higher at the receiver
+    spectrum = np.abs(np.fft.rfft(resampled))
+    freq = np.argmax(spectrum) * 44100 / len(resampled)
+    if abs(len(resampled) - len(audio_data) / 1.001) > 2 or abs(freq - 1001) > 0.2:
+        print('test_clock_skew failed')
+        print(f'{len(resampled)=} {freq=}')
+        return
+    print('test_clock_skew success')
+
+
+def test_noise():
+    channel_params = ChannelParameters()
+    channel_params.set_snr(10.0)
+    for noise_color in NoiseColor:
+        channel_params.set_noise_color(noise_color)
+        model = ChannelModel(make_params(True), channel_params, seed=1)
+        noise = model.apply(np.zeros(44100, dtype='float32'))
+
+        from channel_model import signal_power
+        snr = 10 * np.log10(signal_power(make_params(True)) / np.mean(noise**2))
+        if abs(snr - 10.0) > 0.5:
+            print('test_noise failed')
+            print(f'{noise_color=} {snr=}')
+            return
+    print('test_noise success')
+
+
+def test_frame_error_rate():
+    channel_params = ChannelParameters()
+    channel_params.set_echoes([(0.005, 0.3)])
+    channel_params.set_gain_range((-6.0, 0.0))
+
+    channel_params.set_snr(20.0)
+    fer_high = frame_error_rate(make_params(True), make_params(False), channel_params, 10, seed=1)
+    channel_params.set_snr(-40.0)
+    fer_low = frame_error_rate(make_params(True), make_params(False), channel_params, 10, seed=1)
+    if fer_high > 0.0 or fer_low < 0.5:
+        print('test_frame_error_rate failed')
+        print(f'{fer_high=} {fer_low=}')
+        return
+    print(f'test_frame_error_rate success ({fer_high=} {fer_low=})')
+
+
+def test_goodput():
+    channel_params = ChannelParameters()
+    channel_params.set_snr(20.0)
+    channel_params.set_band((300.0, 8000.0))
+
+    # without retransmissions only the acknowledgements slow the link down
+    goodput = measure_goodput(make_params(True), make_params(False), channel_params,
+            nbytes=30, speed=20.0, seed=1)
+    max_goodput = make_params(True).get_max_bps() / 8
+    if goodput < 0.5 * max_goodput or goodput > max_goodput:
+        print('test_goodput failed')
+        print(f'{goodput=}')
+        return
+    print(f'test_goodput success ({goodput:.1f} B/s)')
+
+
+if __name__ == '__main__':
+    test_blocks()
+    test_clock_skew()
+    test_noise()
+    test_frame_error_rate()
+    test_goodput()
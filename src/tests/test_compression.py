@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+import random
+import sys
+
+sys.path.append('..')
+from compression import StreamCompressor
+from compression import StreamDecompressor
+
+
+def test_stream():
+    compressor = StreamCompressor()
+    decompressor = StreamDecompressor()
+
+    messages = [b'{"status": "ok", "value": 1}\n', b'', b'Hello World\n'] * 10
+    messages += [bytes([random.randint(0, 255) for _ in range(100)])]
+
+    for message in messages:
+        compressed = compressor.compress(message)
+
+        # the frames split the compressed stream at arbitrary positions
+        recv_data = b''
+        cursor = 0
+        while cursor < len(compressed):
+            size = random.randint(1, 11)
+            recv_data += decompressor.decompress(compressed[cursor:cursor + size])
+            cursor += size
+
+        # every message is flushed, thus completely available at the receiver
+        if recv_data != message:
+            print('test_stream failed')
+            print(message)
+            print(recv_data)
+            return
+    print('test_stream success')
+
+
+def test_ratio():
+    compressor = StreamCompressor()
+
+    data = b''.join(b'{"id": %d, "status": "ok", "message": "hello"}\n' % i for i in range(50))
+    compressed = compressor.compress(data)
+    if len(compressed) > len(data) / 3:
+        print('test_ratio failed')
+        print(f'{len(data)=} {len(compressed)=}')
+    else:
+        print('test_ratio success')
+
+
+if __name__ == '__main__':
+    test_stream()
+    test_ratio()
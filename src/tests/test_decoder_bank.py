@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+import time
+import sys
+
+import numpy as np
+
+sys.path.append('..')
+from decoder_bank import DecoderBank
+from message_protocol import MessageEncoder
+from transmission_parameters import TransmissionParameters
+
+
+def make_plans(base_freqs):
+    plans = []
+    encoders = []
+    for base_freq in base_freqs:
+        params_hub = TransmissionParameters()
+        params_hub.set_num_channels(4)
+        params_hub.set_base_freq(base_freq)
+        plans.append(params_hub)
+
+        params_peer = TransmissionParameters()
+        params_peer.set_num_channels(4)
+        params_peer.set_base_freq(base_freq)
+        params_peer.set_is_master(False)
+        encoders.append(MessageEncoder(params_peer))
+    return plans, encoders
+
+
+def test_concurrent_peers():
+    plans, encoders = make_plans([2000.0, 5000.0])
+    decoder_bank = DecoderBank(plans)
+    decoder_bank.start()
+
+    org_data = [b'Hello peer 0', b'Hello peer 1']
+
+    # both peers transmit at the same time, slightly shifted
+    audio_data = np.zeros(600000, dtype='float32')
+    for peer, encoder in enumerate(encoders):
+        message = encoder.encode(org_data[peer])
+        offset = 12672 + 3000 * peer
+        audio_data[offset:offset + len(message)] += 0.5 * message
+
+    for i in range(0, len(audio_data), 2205):
+        decoder_bank.add_frames(audio_data[i:i + 2205])
+    time.sleep(5)
+    recv_data0 = decoder_bank.get_decoder(0).get_message()
+    recv_data1 = decoder_bank.get_decoder(1).get_message()
+
+    decoder_bank.stop()
+
+    if org_data[0] != recv_data0 or org_data[1] != recv_data1:
+        print('test_concurrent_peers failed')
+        print(recv_data0)
+        print(recv_data1)
+    else:
+        print('test_concurrent_peers success')
+
+
+def test_overlapping_plans():
+    plans, _ = make_plans([2000.0, 2000.0])
+    try:
+        DecoderBank(plans)
+    except AssertionError:
+        print('test_overlapping_plans success')
+        return
+    print('test_overlapping_plans failed')
+
+
+if __name__ == '__main__':
+    test_concurrent_peers()
+    test_overlapping_plans()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+from channel_model import ChannelParameters
+from channel_model import echo_taps
+from channel_model import make_loopback
+from echo_canceller import EchoCanceller
+from message_protocol import MessageDecoder
+from message_protocol import MessageEncoder
+from sliding_window import SlidingWindow
+from transmission_parameters import TransmissionParameters
+
+SELF_ECHOES = [(0.002, 0.8), (0.011, 0.3)]
+
+
+def make_params(is_master, full_duplex=True):
+    params = TransmissionParameters()
+    params.set_num_channels(8)
+    params.set_is_master(is_master)
+    params.set_full_duplex(full_duplex)
+    params.set_echo_cancellation(full_duplex)
+    return params
+
+
+# messages separated by short pauses, returns the audio and the messages
+def make_audio(params, rng, nmessages):
+    encoder = MessageEncoder(params)
+    audio_data = []
+    messages = []
+    for _ in range(nmessages):
+        messages.append(rng.bytes(12))
+        audio_data.append(np.zeros(int(rng.uniform(0.0, 0.5) * 44100), dtype='float32'))
+        audio_data.append(encoder.encode(messages[-1]))
+    return np.hstack(audio_data), messages
+
+
+def cancel(echo_canceller, played, recorded):
+    cleaned = []
+    for i in range(0, len(played), 1000):
+        echo_canceller.add_played(played[i:i + 1000])
+        cleaned.append(echo_canceller.process(recorded[i:i + 1000]))
+    return np.hstack(cleaned)
+
+
+def test_convergence():
+    rng = np.random.default_rng(1)
+    played, _ = make_audio(make_params(True), rng, 2)
+
+    # the echo arrives 300 samples late
+    taps = np.hstack([np.zeros(300), echo_taps(SELF_ECHOES, 44100)])
+    echo = np.convolve(played, taps)[:len(played)]
+    noise = rng.normal(0, 1e-4, len(played))
+    cleaned = cancel(EchoCanceller(make_params(True), 300), played, echo + noise)
+
+    # after the first message, what remains of the echo is compared to the echo
+    start = len(played) // 2
+    residual = cleaned[start:] - noise[start:len(cleaned)]
+    erle = 10 * np.log10(np.mean(echo[start:len(cleaned)]**2) / np.mean(residual**2))
+    if len(played) - len(cleaned) >= 2048 or erle < 20.0:
+        print('test_convergence failed')
+        print(f'{len(played)=} {len(cleaned)=} {erle=}')
+        return
+    print(f'test_convergence success ({erle:.1f} dB)')
+
+
+def test_double_talk():
+    rng = np.random.default_rng(2)
+    played, _ = make_audio(make_params(True), rng, 8)
+    heard, messages = make_audio(make_params(False), rng, 8)
+
+    # both are padded, such that the last message is decoded
+    size = max(len(played), len(heard)) + 44100
+    played = np.hstack([played, np.zeros(size - len(played), dtype='float32')])
+    heard = np.hstack([heard, np.zeros(size - len(heard), dtype='float32')])
+
+    # the remote side, which uses the same channels, is as loud as the echo
+    echo = np.convolve(played, echo_taps(SELF_ECHOES, 44100))[:size]
+    cleaned = cancel(EchoCanceller(make_params(True)), played, echo + heard)
+
+    decoder = MessageDecoder(make_params(True))
+    decoder.start()
+    decoder.add_frames(cleaned)
+    decoder.wait_idle(60)
+    decoded = decoder.get_messages()
+    decoder.stop()
+    received = [message in decoded for message in messages]
+
+    # the first messages may be lost while the filter converges
+    if not all(received[3:]):
+        print('test_double_talk failed')
+        print(received)
+        return
+    print(f'test_double_talk success ({sum(received)} of {len(messages)} messages)')
+
+
+def test_full_duplex():
+    channel_params = ChannelParameters()
+    channel_params.set_snr(30.0)
+    channel_params.set_self_echoes(SELF_ECHOES)
+    stream_master, stream_slave = make_loopback(make_params(True), make_params(False),
+            channel_params, speed=10.0, seed=1)
+    master = SlidingWindow(make_params(True), stream_master)
+    slave = SlidingWindow(make_params(False), stream_slave)
+
+    # both sides send at the same time on all channels
+    data_master = b'from the master\n' * 2
+    data_slave = b'from the slave\n' * 2
+    master.send(data_master)
+    slave.send(data_slave)
+    received_master = bytearray()
+    received_slave = bytearray()
+    start = time.monotonic()
+    while time.monotonic() - start < 120:
+        master.tick()
+        slave.tick()
+        received_master += master.recv()
+        received_slave += slave.recv()
+        if len(received_master) >= len(data_slave) and len(received_slave) >= len(data_master):
+            break
+        time.sleep(0.01)
+    master.stop()
+    slave.stop()
+
+    if bytes(received_master) != data_slave or bytes(received_slave) != data_master:
+        print('test_full_duplex failed')
+        print(received_master)
+        print(received_slave)
+        return
+    print('test_full_duplex success')
+
+
+if __name__ == '__main__':
+    test_convergence()
+    test_double_talk()
+    test_full_duplex()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+import os
+import random
+import sys
+import tempfile
+
+sys.path.append('..')
+from file_transfer import CHUNK
+from file_transfer import encode_manifest
+from file_transfer import FileReceiver
+from file_transfer import FileSender
+from file_transfer import record_header
+
+
+# reliable in order byte stream with the send/recv interface of a sliding
+# window, every tick moves at most rate bytes to the other side. Like the
+# sliding window, send refuses data while max_buffer bytes are queued.
+class Link:
+    def __init__(self, rate, max_buffer=None):
+        self.peer = None
+        self.rate = rate
+        self.max_buffer = max_buffer
+        self.send_buffer = bytearray()
+        self.recv_buffer = bytearray()
+        self.sent = 0
+
+
+    def send(self, data, block=False, timeout=None):
+        if self.max_buffer is not None and len(self.send_buffer) >= self.max_buffer:
+            return False
+        self.send_buffer += data
+        return True
+
+
+    def get_send_buffer_size(self):
+        return len(self.send_buffer)
+
+
+    def recv(self):
+        data = bytes(self.recv_buffer)
+        self.recv_buffer.clear()
+        return data
+
+
+    def tick(self):
+        data = self.send_buffer[:self.rate]
+        del self.send_buffer[:self.rate]
+        self.peer.recv_buffer += data
+        self.sent += len(data)
+
+
+def make_links(rate, max_buffer=None):
+    link_a = Link(rate, max_buffer)
+    link_b = Link(rate, max_buffer)
+    link_a.peer = link_b
+    link_b.peer = link_a
+    return link_a, link_b
+
+
+def transfer(src, dst, rate, max_ticks, max_buffer=None):
+    link_a, link_b = make_links(rate, max_buffer)
+    sender = FileSender(link_a, src, chunk_size=100)
+    receiver = FileReceiver(link_b, dst)
+    for _ in range(max_ticks):
+        link_a.tick()
+        link_b.tick()
+        sender.tick()
+        receiver.tick()
+        if sender.is_done():
+            break
+    sender.close()
+    receiver.close()
+    return sender.is_done(), link_a.sent
+
+
+def test_transfer_resume():
+    with tempfile.TemporaryDirectory() as directory:
+        src = os.path.join(directory, 'src')
+        dst = os.path.join(directory, 'dst')
+        org_data = bytes([random.randint(0, 255) for _ in range(10000)])
+        with open(src, 'wb') as f:
+            f.write(org_data)
+
+        _, sent_full = transfer(src, os.path.join(directory, 'full'), 50, 1000)
+
+        # the link is stopped half way, the second transfer should only send
+        # the remaining part of the file
+        done0, sent0 = transfer(src, dst, 50, 100)
+        done1, sent1 = transfer(src, dst, 50, 1000)
+
+        with open(dst, 'rb') as f:
+            recv_data = f.read()
+
+        if done0 or not done1 or recv_data != org_data or sent1 > sent_full - sent0 // 2:
+            print('test_transfer_resume failed')
+            print(f'{done0=} {done1=} {sent_full=} {sent0=} {sent1=}')
+        else:
+            print('test_transfer_resume success')
+
+
+def test_empty_file():
+    with tempfile.TemporaryDirectory() as directory:
+        src = os.path.join(directory, 'src')
+        dst = os.path.join(directory, 'dst')
+        open(src, 'wb').close()
+
+        done, _ = transfer(src, dst, 50, 100)
+        if not done or os.path.getsize(dst) != 0:
+            print('test_empty_file failed')
+        else:
+            print('test_empty_file success')
+
+
+# the send buffer accepts a chunk header but refuses the chunk data
+def test_full_send_buffer():
+    with tempfile.TemporaryDirectory() as directory:
+        src = os.path.join(directory, 'src')
+        dst = os.path.join(directory, 'dst')
+        org_data = bytes([random.randint(0, 255) for _ in range(1000)])
+        with open(src, 'wb') as f:
+            f.write(org_data)
+
+        done, _ = transfer(src, dst, 50, 1000, max_buffer=110)
+        with open(dst, 'rb') as f:
+            recv_data = f.read()
+        if not done or recv_data != org_data:
+            print('test_full_send_buffer failed')
+            print(f'{done=} {len(recv_data)=}')
+        else:
+            print('test_full_send_buffer success')
+
+
+# a chunk without a checksum in the manifest fails the transfer
+def test_invalid_offset():
+    with tempfile.TemporaryDirectory() as directory:
+        link_a, link_b = make_links(1000)
+        receiver = FileReceiver(link_b, os.path.join(directory, 'dst'))
+        link_a.send(encode_manifest('src', 100, 100, []))
+        link_a.send(record_header(CHUNK, 9) + (0).to_bytes(8, 'big') + b'x')
+        link_a.tick()
+        receiver.tick()
+        receiver.close()
+        if not receiver.has_failed():
+            print('test_invalid_offset failed')
+        else:
+            print('test_invalid_offset success')
+
+
+if __name__ == '__main__':
+    test_transfer_resume()
+    test_empty_file()
+    test_full_send_buffer()
+    test_invalid_offset()
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+import subprocess
+import sys
+
+sys.path.append('..')
+
+# modules that can be used without audio hardware or a display
+LIBRARY_MODULES = ['transmission_parameters', 'message_protocol', 'sliding_window',
+        'decoder_bank', 'hub', 'link_probe', 'compression', 'file_transfer', 'async_link', 'recorder',
+        'channel_model', 'link_worker', 'front_end', 'echo_canceller']
+# import time budget (ms) of the library modules, numpy is excluded as every
+# worker needs it anyway
+IMPORT_BUDGET = 100
+
+
+# runs the import in a fresh interpreter, such that modules imported by other
+# tests do not hide the cost. Blocking sounddevice and gi makes the import
+# fail if they are imported at module level.
+def import_library():
+    code = f'''
+import sys
+import time
+sys.path.append('..')
+sys.modules['sounddevice'] = None
+sys.modules['gi'] = None
+import numpy
+start = time.perf_counter()
+for name in {LIBRARY_MODULES!r}:
+    __import__(name)
+print((time.perf_counter() - start) * 1000)
+'''
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        return None
+    return float(result.stdout.split()[-1])
+
+
+def test_no_audio_or_gui():
+    if import_library() is None:
+        print('test_no_audio_or_gui failed')
+        return
+    print('test_no_audio_or_gui success')
+
+
+def test_import_time():
+    # take the best of a few runs, the first one may have to fill the disk cache
+    import_time = min(import_library() or float('inf') for _ in range(3))
+    if import_time > IMPORT_BUDGET:
+        print('test_import_time failed')
+        print(f'{import_time=:.1f} ms {IMPORT_BUDGET=} ms')
+        return
+    print(f'test_import_time success ({import_time:.1f} ms)')
+
+
+if __name__ == '__main__':
+    test_no_audio_or_gui()
+    test_import_time()
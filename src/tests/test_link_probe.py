@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+from channel_model import ChannelParameters
+from channel_model import make_loopback
+from link_probe import LinkProbe
+from link_probe import REPORT
+from link_probe import choose_parameters
+from link_probe import find_probe
+from link_probe import make_probe
+from link_probe import measure_snr
+from link_probe import PROBE_CHANNELS
+from message_protocol import MessageEncoder
+from transmission_parameters import TransmissionParameters
+
+
+def capture_probe(noise_level, pad):
+    params_send = TransmissionParameters()
+
+    params_recv = TransmissionParameters()
+    params_recv.set_is_master(False)
+
+    rng = np.random.default_rng(1)
+    probe = make_probe(params_send)
+    audio_data = np.hstack([np.zeros(pad), probe, np.zeros(10000)])
+    audio_data += noise_level * rng.standard_normal(len(audio_data))
+    return params_recv, audio_data
+
+
+def test_find_probe():
+    for pad in [0, 1234, 12672]:
+        params_recv, audio_data = capture_probe(0.1, pad)
+        cursor = find_probe(params_recv, audio_data)
+        if abs(cursor - pad) > params_recv.get_window_size() // 8:
+            print('test_find_probe failed')
+            print(f'{pad=} {cursor=}')
+            return
+    print('test_find_probe success')
+
+
+# the start sequence of a frame of the remote side is not a probe
+def test_frame_is_no_probe():
+    params_send = TransmissionParameters()
+    params_recv = TransmissionParameters()
+    params_recv.set_is_master(False)
+    params_message = TransmissionParameters()
+    params_message.set_max_payload_size(PROBE_CHANNELS + 1)
+    params_message.set_bits_per_symbol(1)
+
+    frame = MessageEncoder(params_message).encode(bytes([REPORT]) + bytes(range(PROBE_CHANNELS)))
+    audio_data = np.hstack([np.zeros(1234), frame, np.zeros(10000)]).astype('float32')
+    cursor = find_probe(params_recv, audio_data)
+    if cursor != -1:
+        print('test_frame_is_no_probe failed')
+        print(f'{cursor=}')
+        return
+    print('test_frame_is_no_probe success')
+
+
+def test_measure_snr():
+    params_recv, audio_data = capture_probe(1.0, 3000)
+    cursor = find_probe(params_recv, audio_data)
+    snr = measure_snr(params_recv, audio_data, cursor)
+
+    # expected snr is 10 * log10(window_size / 4) ~= 30 dB, the measurement
+    # takes the worst window as noise and is thus a bit pessimistic
+    if len(snr) != PROBE_CHANNELS or np.min(snr) < 18 or np.max(snr) > 34:
+        print('test_measure_snr failed')
+        print(snr)
+    else:
+        print('test_measure_snr success')
+
+
+def test_choose_parameters():
+    params = TransmissionParameters()
+
+    clean = np.full(PROBE_CHANNELS, 40.0)
+    if choose_parameters(params, clean, clean) != (PROBE_CHANNELS, 0.02):
+        print('test_choose_parameters failed')
+        print(choose_parameters(params, clean, clean))
+        return
+
+    # the bad upper channels should not be used, and the window has to be
+    # longer to reach the required snr
+    snr = np.full(PROBE_CHANNELS, 16.0)
+    snr[6:] = 0.0
+    if choose_parameters(params, snr, snr) != (6, 0.1):
+        print('test_choose_parameters failed')
+        print(choose_parameters(params, snr, snr))
+        return
+
+    noisy = np.full(PROBE_CHANNELS, 0.0)
+    if choose_parameters(params, noisy, noisy) is not None:
+        print('test_choose_parameters failed')
+        print(choose_parameters(params, noisy, noisy))
+        return
+    print('test_choose_parameters success')
+
+
+# both sides agree on the parameters of a clean link
+def test_handshake():
+    params_master = TransmissionParameters()
+    params_slave = TransmissionParameters()
+    params_slave.set_is_master(False)
+    stream_master, stream_slave = make_loopback(params_master, params_slave, ChannelParameters(),
+            speed=10.0, seed=1)
+    master = LinkProbe(params_master, audio_stream=stream_master, clock=stream_master.get_time)
+    slave = LinkProbe(params_slave, audio_stream=stream_slave, clock=stream_slave.get_time)
+
+    start = time.monotonic()
+    while not (master.is_done() and slave.is_done()) and time.monotonic() - start < 60:
+        master.tick()
+        slave.tick()
+        time.sleep(0.01)
+    master.stop()
+    slave.stop()
+
+    result = master.get_result()
+    if result is None or slave.get_result() != result or \
+            params_slave.get_num_channels() != result[0] or params_slave.get_window_length() != result[1]:
+        print('test_handshake failed')
+        print(f'{result=} {slave.get_result()=}')
+        return
+    print(f'test_handshake success ({result})')
+
+
+if __name__ == '__main__':
+    test_find_probe()
+    test_frame_is_no_probe()
+    test_measure_snr()
+    test_choose_parameters()
+    test_handshake()
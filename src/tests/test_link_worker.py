@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+import queue
+import sys
+import threading
+import time
+
+sys.path.append('..')
+from channel_model import ChannelParameters
+from channel_model import make_loopback
+from link_worker import LinkWorker
+import sliding_window
+from transmission_parameters import TransmissionParameters
+
+
+def make_params(is_master):
+    params = TransmissionParameters()
+    params.set_num_channels(8)
+    params.set_is_master(is_master)
+    return params
+
+
+# the callbacks are queued and run on the test thread, like GLib.idle_add
+# runs them on the GTK main loop
+class MainLoop:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.current_thread()
+        self.wrong_thread = False
+
+
+    def idle_add(self, func, *args):
+        self.queue.put((func, args))
+
+
+    def run(self, until, timeout):
+        deadline = time.time() + timeout
+        while not until() and time.time() < deadline:
+            try:
+                func, args = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.wrong_thread |= threading.current_thread() != self.thread
+            func(*args)
+
+
+def test_transfer():
+    main_loop = MainLoop()
+    stream_master, stream_slave = make_loopback(make_params(True), make_params(False),
+            ChannelParameters(), speed=10.0)
+    master = LinkWorker(make_params(True), dispatch=main_loop.idle_add, audio_stream=stream_master)
+    slave = LinkWorker(make_params(False), dispatch=main_loop.idle_add, audio_stream=stream_slave)
+
+    events = []
+    received = bytearray()
+    def on_data(data):
+        events.append('data')
+        received.extend(data)
+    master.attach_on_link_started(lambda: events.append('started'))
+    master.attach_on_send_complete(lambda: events.append('complete'))
+    slave.attach_on_data(on_data)
+
+    # data can be queued before the link has started
+    data = b'hello world\n' * 4
+    master.send(data)
+    master.start()
+    slave.start()
+
+    # block the main loop for a while, the link continues in the background
+    time.sleep(2)
+    main_loop.run(lambda: len(received) == len(data) and 'complete' in events, 120)
+    master.stop()
+    slave.stop()
+
+    if bytes(received) != data or events[0] != 'started' or main_loop.wrong_thread:
+        print('test_transfer failed')
+        print(events)
+        print(received)
+        return
+    print(f'test_transfer success ({events.count("data")} batches)')
+
+
+# data that does not fit in the send buffer is kept until there is room
+def test_backpressure():
+    main_loop = MainLoop()
+    stream_master, stream_slave = make_loopback(make_params(True), make_params(False),
+            ChannelParameters(), speed=10.0)
+    master = LinkWorker(make_params(True), dispatch=main_loop.idle_add, audio_stream=stream_master)
+    slave = LinkWorker(make_params(False), dispatch=main_loop.idle_add, audio_stream=stream_slave)
+    received = bytearray()
+    slave.attach_on_data(received.extend)
+
+    # every write fills the send buffer
+    max_send_buf_size = sliding_window.MAX_SEND_BUF_SIZE
+    sliding_window.MAX_SEND_BUF_SIZE = 8
+    data = [b'hello world\n', b'backpressure', b'third write\n']
+    for chunk in data:
+        master.send(chunk)
+    master.start()
+    slave.start()
+    main_loop.run(lambda: len(received) == len(b''.join(data)), 120)
+    master.stop()
+    slave.stop()
+    sliding_window.MAX_SEND_BUF_SIZE = max_send_buf_size
+
+    if bytes(received) != b''.join(data):
+        print('test_backpressure failed')
+        print(received)
+        return
+    print('test_backpressure success')
+
+
+if __name__ == '__main__':
+    test_transfer()
+    test_backpressure()
@@ -8,10 +8,16 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 sys.path.append('..')
+from channel_model import ChannelModel
+from channel_model import ChannelParameters
 from message_protocol import MessageEncoder
 from message_protocol import MessageDecoder
+from message_protocol import SpectrumFeed
+from message_protocol import Squelch
 from transmission_parameters import TransmissionParameters
 from transmission_parameters import FrequencySet
+from transmission_parameters import AnalysisWindow
+from transmission_parameters import Preamble
 
 
 def test_simple():
@@ -319,6 +325,534 @@ def test_segmented_pad():
     else:
         print('test_segmented_pad success')
 
+
+def test_analysis_windows():
+    for analysis_window in AnalysisWindow:
+        params_send = TransmissionParameters()
+        params_send.set_num_channels(16)
+
+        params_recv = TransmissionParameters()
+        params_recv.set_num_channels(16)
+        params_recv.set_is_master(False)
+        params_recv.set_analysis_window(analysis_window)
+
+        encoder = MessageEncoder(params_send)
+        decoder = MessageDecoder(params_recv)
+        decoder.start()
+
+        org_data = b'Hello World'
+
+        l = []
+        l.append(np.zeros(12672, dtype='float32'))
+        l.append(0.5 * encoder.encode(org_data))
+        l.append(np.zeros(100000, dtype='float32'))
+        audio_data = np.hstack(l)
+
+        decoder.add_frames(audio_data)
+        time.sleep(5)
+        recv_data0 = decoder.get_message()
+
+        decoder.stop()
+
+        if org_data != recv_data0:
+            print('test_analysis_windows failed')
+            print(f'{analysis_window=}')
+            print(recv_data0)
+            return
+    print('test_analysis_windows success')
+
+
+def test_gain_equalization():
+    from message_protocol import equalize_gain
+    from message_protocol import START_SEQ
+
+    fbin_data = 3.0 * np.array(START_SEQ + [1, 0, 1], dtype='float') + 0.5
+    equalized = equalize_gain(fbin_data)
+    if not np.allclose(equalized, START_SEQ + [1, 0, 1]):
+        print('test_gain_equalization failed')
+        print(equalized)
+    else:
+        print('test_gain_equalization success')
+
+
+def test_multi_level():
+    for bits_per_symbol in range(1, 4):
+        params_send = TransmissionParameters()
+        params_send.set_num_channels(8)
+        params_send.set_bits_per_symbol(bits_per_symbol)
+
+        params_recv = TransmissionParameters()
+        params_recv.set_num_channels(8)
+        params_recv.set_is_master(False)
+        params_recv.set_bits_per_symbol(bits_per_symbol)
+
+        encoder = MessageEncoder(params_send)
+        decoder = MessageDecoder(params_recv)
+        decoder.start()
+
+        org_data = bytes([random.randint(0, 255) for _ in range(params_send.get_max_payload_size())])
+
+        l = []
+        l.append(np.zeros(12672, dtype='float32'))
+        l.append(encoder.encode(org_data))
+        l.append(np.zeros(100000, dtype='float32'))
+        audio_data = np.hstack(l)
+
+        calc_length = decoder._MessageDecoder__calc_message_size(len(org_data), FrequencySet.RECV)
+        true_length = len(encoder.encode(org_data))
+
+        decoder.add_frames(audio_data)
+        time.sleep(5)
+        recv_data0 = decoder.get_message()
+
+        decoder.stop()
+
+        if org_data != recv_data0 or calc_length != true_length:
+            print('test_multi_level failed')
+            print(f'{bits_per_symbol=} {true_length=} {calc_length=}')
+            print(recv_data0)
+            return
+    print('test_multi_level success')
+
+
+def test_levels():
+    from message_protocol import bits_to_levels
+    from message_protocol import levels_to_bits
+
+    for bits_per_symbol in range(1, 5):
+        for length in range(0, 40, bits_per_symbol):
+            orig = [random.randint(0, 1) for _ in range(length)]
+            levels = bits_to_levels(orig, bits_per_symbol)
+            if orig != levels_to_bits(levels, bits_per_symbol):
+                print('test_levels failed')
+                return
+
+        # neighbouring levels should only differ by a single bit
+        levels = list(range(2**bits_per_symbol))
+        bin_data = levels_to_bits(levels, bits_per_symbol)
+        for i in range(1, len(levels)):
+            prev = bin_data[(i - 1) * bits_per_symbol:i * bits_per_symbol]
+            cur = bin_data[i * bits_per_symbol:(i + 1) * bits_per_symbol]
+            if sum(a != b for a, b in zip(prev, cur)) != 1:
+                print('test_levels failed')
+                return
+    print('test_levels success')
+
+
+def test_snapshot():
+    params = TransmissionParameters()
+    params.set_num_channels(4)
+    snapshot = params.snapshot()
+
+    # later changes of the parameters do not affect a running link
+    params.set_num_channels(8)
+    params.set_window_length(0.05)
+    if len(snapshot.get_frequencies(FrequencySet.SEND)) != 2 or snapshot.get_window_length() != 0.1:
+        print('test_snapshot failed')
+        return
+
+    try:
+        snapshot._LinkParameters__num_channels = 8
+        print('test_snapshot failed')
+        return
+    except AttributeError:
+        pass
+
+    params.set_num_channels(4)
+    params.set_window_length(0.1)
+    for length in range(params.get_max_payload_size() + 1):
+        for freq_set in FrequencySet:
+            if snapshot.get_message_windows(length, freq_set) != params.get_message_windows(length, freq_set):
+                print('test_snapshot failed')
+                print(f'{length=} {freq_set=}')
+                return
+    print('test_snapshot success')
+
+
+def test_encoder_pipeline():
+    from message_protocol import EncoderPipeline
+
+    params = TransmissionParameters()
+    params.set_num_channels(4)
+    output = []
+    pipeline = EncoderPipeline(params, output.append)
+    pipeline.start()
+
+    pipeline.submit(b'frame 0', 0)
+    pipeline.submit(b'ack')
+    pipeline.replay(0)
+    pipeline.release(0)
+    # released audio is not output anymore
+    pipeline.replay(0)
+    pipeline.wait_idle()
+    pipeline.stop()
+
+    # the audio is output in order, a replay outputs the cached audio
+    expected = [MessageEncoder(params).encode(message) for message in [b'frame 0', b'ack']]
+    if len(output) != 3 or not np.array_equal(output[0], expected[0]) or \
+            not np.array_equal(output[1], expected[1]) or output[2] is not output[0]:
+        print('test_encoder_pipeline failed')
+        return
+    print('test_encoder_pipeline success')
+
+
+def test_message_queue():
+    import threading
+    from message_protocol import MessageQueue
+
+    queue = MessageQueue(3)
+    for i in range(5):
+        queue.put(bytes([i]))
+    # the oldest messages are dropped
+    if queue.get_dropped() != 2 or queue.get_messages(2) != [b'\x02', b'\x03'] or \
+            queue.get_messages() != [b'\x04'] or queue.get_message() is not None:
+        print('test_message_queue failed')
+        return
+
+    start = time.time()
+    if queue.get_message(block=True, timeout=0.2) is not None or time.time() - start < 0.2:
+        print('test_message_queue failed')
+        return
+
+    # a blocking call returns as soon as a message is put
+    threading.Timer(0.1, queue.put, [b'late']).start()
+    if queue.get_messages(block=True, timeout=5) != [b'late'] or time.time() - start > 2:
+        print('test_message_queue failed')
+        return
+    print('test_message_queue success')
+
+
+def test_squelch():
+    params_send = TransmissionParameters()
+    params_send.set_num_channels(4)
+    params_recv = TransmissionParameters()
+    params_recv.set_num_channels(4)
+    params_recv.set_is_master(False)
+
+    encoder = MessageEncoder(params_send)
+    max_size = len(encoder.encode(bytes(params_send.get_max_payload_size())))
+    noise = np.random.normal(0, 0.01, 30 * params_recv.get_sample_rate()).astype('float32')
+
+    decode_time = {}
+    for squelch in [False, True]:
+        params_recv.set_squelch(squelch)
+        decoder = MessageDecoder(params_recv)
+        decoder.start()
+
+        # only noise, in blocks as returned by the audio stream
+        start = time.time()
+        for cursor in range(0, len(noise), 2205):
+            decoder.add_frames(noise[cursor:cursor + 2205])
+        decoder.wait_idle()
+        decode_time[squelch] = time.time() - start
+
+        # the squelch opens for a message
+        audio_data = np.hstack([encoder.encode(b'hello'), np.zeros(max_size, dtype='float32')])
+        audio_data += noise[:len(audio_data)]
+        decoder.add_frames(audio_data)
+        decoder.wait_idle()
+        decoder.stop()
+        if decoder.get_messages() != [b'hello']:
+            print('test_squelch failed')
+            print(f'{squelch=}')
+            return
+
+    if decode_time[True] > decode_time[False] / 2:
+        print('test_squelch failed')
+        print(decode_time)
+        return
+    print(f'test_squelch success ({decode_time[False]:.2f} s -> {decode_time[True]:.2f} s)')
+
+
+# the squelch closes again after the noise rose and stays high
+def test_squelch_noise_rise():
+    params = TransmissionParameters()
+    params.set_num_channels(4)
+    params.set_is_master(False)
+    snapshot = params.snapshot()
+    squelch = Squelch(snapshot, snapshot.get_basis(FrequencySet.RECV))
+
+    sample_rate = params.get_sample_rate()
+    rng = np.random.default_rng(1)
+    quiet = rng.normal(0, 0.01, 30 * sample_rate).astype('float32')
+    loud = rng.normal(0, 0.1, 60 * sample_rate).astype('float32')
+    open_after_rise = []
+    for cursor in range(0, len(quiet), 2205):
+        squelch.process(quiet[cursor:cursor + 2205])
+    closed_before = not squelch.is_open()
+    for cursor in range(0, len(loud), 2205):
+        squelch.process(loud[cursor:cursor + 2205])
+        open_after_rise.append(squelch.is_open())
+
+    if not closed_before or not any(open_after_rise) or open_after_rise[-1]:
+        print('test_squelch_noise_rise failed')
+        print(f'{closed_before=} {any(open_after_rise)=} {open_after_rise[-1]=}')
+        return
+    closed_after = (len(open_after_rise) - open_after_rise[::-1].index(True)) * 2205 / sample_rate
+
+    # silent windows (e.g., a muted input) do not make the decoder deaf
+    params_send = TransmissionParameters()
+    params_send.set_num_channels(4)
+    encoder = MessageEncoder(params_send)
+    decoder = MessageDecoder(params)
+    decoder.start()
+    window_size = params.get_window_size()
+    messages = [bytes([i]) * 8 for i in range(10)]
+    frames = np.hstack([encoder.encode(message) for message in messages] + [np.zeros(10 * sample_rate)])
+    audio_data = np.hstack([rng.normal(0, 0.01, 20 * window_size), np.zeros(200 * window_size),
+            frames + rng.normal(0, 0.01, len(frames))]).astype('float32')
+    for cursor in range(0, len(audio_data), 2205):
+        decoder.add_frames(audio_data[cursor:cursor + 2205])
+    decoder.wait_idle(60)
+    decoder.stop()
+    received = decoder.get_messages()
+    if received != messages:
+        print('test_squelch_noise_rise failed')
+        print(f'{len(received)=}')
+        return
+    print(f'test_squelch_noise_rise success (closed after {closed_after:.1f} s)')
+
+
+def test_front_end():
+    from front_end import FrontEnd
+
+    for num_channels in [2, 5, 16]:
+        params_send = TransmissionParameters()
+        params_send.set_num_channels(num_channels)
+        params_recv = TransmissionParameters()
+        params_recv.set_num_channels(num_channels)
+        params_recv.set_is_master(False)
+        params_recv.set_front_end(True)
+
+        front_end = FrontEnd(params_recv)
+        if front_end.get_factor() < 2 or params_recv.get_window_size() % front_end.get_factor() != 0:
+            print('test_front_end failed')
+            print(f'{num_channels=} {front_end.get_factor()=}')
+            return
+
+        encoder = MessageEncoder(params_send)
+        max_size = len(encoder.encode(bytes(params_send.get_max_payload_size())))
+        org_data = [b'hello world!', b'', b'x']
+        audio_data = [np.zeros(1234, dtype='float32')]
+        for message in org_data:
+            audio_data += [encoder.encode(message), np.zeros(5000, dtype='float32')]
+        audio_data = np.hstack(audio_data + [np.zeros(max_size, dtype='float32')])
+        audio_data += np.random.normal(0, 0.05, len(audio_data)).astype('float32')
+
+        decoder = MessageDecoder(params_recv)
+        decoder.start()
+        for cursor in range(0, len(audio_data), 2205):
+            decoder.add_frames(audio_data[cursor:cursor + 2205])
+        decoder.wait_idle()
+        decoder.stop()
+
+        recv_data = decoder.get_messages()
+        if recv_data != org_data:
+            print('test_front_end failed')
+            print(f'{num_channels=} {recv_data=}')
+            return
+    print('test_front_end success')
+
+
+def test_preambles():
+    ack_windows = {}
+    for preamble in Preamble:
+        for front_end in [False, True]:
+            params_send = TransmissionParameters()
+            params_send.set_num_channels(8)
+            params_send.set_preamble(preamble)
+            params_recv = TransmissionParameters()
+            params_recv.set_num_channels(8)
+            params_recv.set_is_master(False)
+            params_recv.set_preamble(preamble)
+            params_recv.set_front_end(front_end)
+
+            # the preamble is accounted for in the message size
+            encoder = MessageEncoder(params_send)
+            windows = params_send.get_message_windows(1, FrequencySet.SEND)
+            if len(encoder.encode(b'a')) != windows * params_send.get_window_size():
+                print('test_preambles failed')
+                print(f'{preamble=} {windows=}')
+                return
+            ack_windows[preamble] = windows
+
+            max_size = len(encoder.encode(bytes(params_send.get_max_payload_size())))
+            org_data = [b'hello world!', b'', b'x']
+            audio_data = [np.zeros(5678, dtype='float32')]
+            for message in org_data:
+                audio_data += [encoder.encode(message), np.zeros(3000, dtype='float32')]
+            audio_data = np.hstack(audio_data + [np.zeros(max_size, dtype='float32')])
+            audio_data += np.random.normal(0, 0.05, len(audio_data)).astype('float32')
+
+            decoder = MessageDecoder(params_recv)
+            decoder.start()
+            for cursor in range(0, len(audio_data), 2205):
+                decoder.add_frames(audio_data[cursor:cursor + 2205])
+            decoder.wait_idle()
+            decoder.stop()
+
+            recv_data = decoder.get_messages()
+            if recv_data != org_data:
+                print('test_preambles failed')
+                print(f'{preamble=} {front_end=} {recv_data=}')
+                return
+
+    if not ack_windows[Preamble.CHIRP] < ack_windows[Preamble.BARKER] < ack_windows[Preamble.ON_OFF]:
+        print('test_preambles failed')
+        print(ack_windows)
+        return
+    print(f'test_preambles success ({ack_windows})')
+
+
+# fraction (dB) of the power that is more than 100 Hz from every channel
+def splatter(params, audio_data):
+    frequencies = np.fft.rfftfreq(len(audio_data), 1 / params.get_sample_rate())
+    power = np.abs(np.fft.rfft(audio_data))**2
+    channels = params.get_frequencies(FrequencySet.SEND)
+    distance = np.min(np.abs(frequencies[:, np.newaxis] - channels[np.newaxis, :]), axis=1)
+    return 10 * np.log10(np.sum(power[distance > 100]) / np.sum(power))
+
+
+def test_symbol_ramp():
+    org_data = b'Hello World'
+    levels = {}
+    for symbol_ramp in [0.0, 0.25, 0.5, 1.0]:
+        params_send = TransmissionParameters()
+        params_send.set_symbol_ramp(symbol_ramp)
+        audio_data = MessageEncoder(params_send).encode(org_data)
+        levels[symbol_ramp] = round(float(splatter(params_send, audio_data)), 1)
+
+        # the decoder with and without the front end integrates with the pulse
+        for front_end in [False, True]:
+            params_recv = TransmissionParameters()
+            params_recv.set_is_master(False)
+            params_recv.set_symbol_ramp(symbol_ramp)
+            params_recv.set_front_end(front_end)
+
+            decoder = MessageDecoder(params_recv)
+            decoder.start()
+            decoder.add_frames(np.hstack([np.zeros(5000, dtype='float32'),
+                    0.5 * audio_data, np.zeros(50000, dtype='float32')]))
+            decoder.wait_idle(30)
+            recv_data = decoder.get_message()
+            decoder.stop()
+            if recv_data != org_data:
+                print('test_symbol_ramp failed')
+                print(f'{symbol_ramp=} {front_end=} {recv_data=}')
+                return
+
+    if not levels[0.5] < levels[0.25] < levels[0.0] - 20.0:
+        print('test_symbol_ramp failed')
+        print(levels)
+        return
+    print(f'test_symbol_ramp success ({levels})')
+
+
+# 32 channels 10 Hz apart, i.e., a tenth of the default spacing, through an
+# echoic channel with clock skew
+def test_channel_spacing():
+    def make_params(is_master):
+        params = TransmissionParameters()
+        params.set_num_channels(32)
+        params.set_is_master(is_master)
+        params.set_channel_spacing(0.005)
+        params.set_symbol_ramp(0.5)
+        return params
+
+    rng = np.random.default_rng(1)
+    encoder = MessageEncoder(make_params(True))
+    org_data = []
+    audio_data = []
+    for _ in range(8):
+        org_data.append(rng.bytes(12))
+        audio_data.append(np.zeros(int(rng.uniform(0.2, 0.7) * 44100), dtype='float32'))
+        audio_data.append(0.5 * encoder.encode(org_data[-1]))
+    audio_data.append(np.zeros(2 * 44100, dtype='float32'))
+
+    channel_params = ChannelParameters()
+    channel_params.set_snr(20.0)
+    channel_params.set_echoes([(0.01, 0.4), (0.023, -0.2)])
+    channel_params.set_clock_skew(2e-4)
+    audio_data = ChannelModel(make_params(True), channel_params, seed=1).apply(np.hstack(audio_data))
+
+    decoder = MessageDecoder(make_params(False))
+    decoder.start()
+    decoder.add_frames(audio_data)
+    decoder.wait_idle(60)
+    recv_data = decoder.get_messages()
+    decoder.stop()
+
+    if recv_data != org_data:
+        print('test_channel_spacing failed')
+        print(f'{len(recv_data)=}')
+        return
+    print(f'test_channel_spacing success ({make_params(True).get_max_bps():.1f} bps)')
+
+
+def test_spectrum_feed():
+    params_send = TransmissionParameters()
+    params_send.set_num_channels(8)
+    audio_data = 0.5 * MessageEncoder(params_send).encode(b'Hello World')
+    silence = np.zeros(20 * params_send.get_window_size(), dtype='float32')
+
+    for squelch in [False, True]:
+        params_recv = TransmissionParameters()
+        params_recv.set_num_channels(8)
+        params_recv.set_is_master(False)
+        params_recv.set_squelch(squelch)
+
+        spectrum_feed = SpectrumFeed()
+        rows = spectrum_feed.subscribe(decimation=2)
+        bounded = spectrum_feed.subscribe(max_rows=10)
+        decoder = MessageDecoder(params_recv, spectrum_feed)
+        decoder.start()
+        decoder.add_frames(np.hstack([silence, audio_data, silence]))
+        decoder.wait_idle(30)
+        # the rows of later audio carry the thresholds of the message
+        decoder.add_frames(silence)
+        decoder.wait_idle(30)
+        message = decoder.get_message()
+        decoder.stop()
+
+        nwindows = (3 * len(silence) + len(audio_data)) // params_send.get_window_size()
+        rows = rows.get_messages()
+        magnitudes = np.array([magnitudes for magnitudes, _ in rows])
+        thresholds = rows[-1][1]
+        if message != b'Hello World' or len(rows) != nwindows // 2 or magnitudes.shape[1] != 4 or \
+                thresholds is None or np.any(np.max(magnitudes, axis=0) < 1.5 * thresholds) or \
+                np.any(magnitudes[-1] > thresholds / 2) or len(bounded.get_messages()) != 10:
+            print('test_spectrum_feed failed')
+            print(f'{squelch=} {message=} {len(rows)=} {nwindows=} {thresholds=}')
+            return
+    print('test_spectrum_feed success')
+
+
+# a feed is shared by the decoders of successive links, audio of a previous
+# link does not end up in the windows of the next
+def test_spectrum_feed_links():
+    spectrum_feed = SpectrumFeed()
+    rows = spectrum_feed.subscribe()
+    nrows = []
+    for window_length, nwindows in [(0.1, 1.5), (0.05, 4)]:
+        params = TransmissionParameters()
+        params.set_num_channels(8)
+        params.set_is_master(False)
+        params.set_window_length(window_length)
+        params.set_squelch(False)
+        decoder = MessageDecoder(params, spectrum_feed)
+        decoder.start()
+        decoder.add_frames(np.zeros(int(nwindows * params.get_window_size()), dtype='float32'))
+        decoder.wait_idle(30)
+        decoder.stop()
+        nrows.append(len(rows.get_messages()))
+
+    if nrows != [1, 4]:
+        print('test_spectrum_feed_links failed')
+        print(nrows)
+        return
+    print('test_spectrum_feed_links success')
+
+
 if __name__ == '__main__':
     test_segmented_pad()
     test_segmented_no_pad()
@@ -330,5 +864,18 @@ if __name__ == '__main__':
     test_simple_empty()
     test_simple_full()
     test_message_legnth_calc()
-
-
+    test_analysis_windows()
+    test_gain_equalization()
+    test_multi_level()
+    test_levels()
+    test_snapshot()
+    test_encoder_pipeline()
+    test_message_queue()
+    test_squelch()
+    test_squelch_noise_rise()
+    test_front_end()
+    test_preambles()
+    test_symbol_ramp()
+    test_channel_spacing()
+    test_spectrum_feed()
+    test_spectrum_feed_links()
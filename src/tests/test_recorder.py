@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+import json
+import os
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+sys.path.append('..')
+from echo_canceller import EchoCanceller
+from message_protocol import MessageEncoder
+from recorder import PLAYED
+from recorder import RECORDED
+from recorder import ReplayStream
+from recorder import SessionRecorder
+from recorder import parameters_from_dict
+from recorder import parameters_to_dict
+from recorder import read_recording
+from recorder import replay_decode
+from transmission_parameters import AnalysisWindow
+from transmission_parameters import Preamble
+from transmission_parameters import TransmissionParameters
+
+
+def make_params(is_master):
+    params = TransmissionParameters()
+    params.set_num_channels(4)
+    params.set_is_master(is_master)
+    return params
+
+
+# records the messages send by the remote side, split in blocks as returned
+# by the audio stream, with some silence and noise in between
+def record_session(path, messages, max_size=None):
+    params_send = make_params(True)
+    params_recv = make_params(False)
+    encoder = MessageEncoder(params_send)
+    block_size = params_recv.get_sample_rate() // 20
+    # the decoder waits for enough audio to hold a message of the maximal size
+    max_message = encoder.encode(bytes(params_send.get_max_payload_size()))
+
+    audio_data = [np.zeros(block_size, dtype='float32')]
+    for message in messages:
+        audio_data.append(encoder.encode(message))
+        audio_data.append(np.zeros(3 * block_size, dtype='float32'))
+    audio_data.append(np.zeros(len(max_message), dtype='float32'))
+    audio_data = np.hstack(audio_data)
+    audio_data += np.random.normal(0, 0.01, len(audio_data)).astype('float32')
+
+    if max_size is None:
+        recorder = SessionRecorder(path, params_recv)
+    else:
+        recorder = SessionRecorder(path, params_recv, max_size)
+    recorder.add_played(np.ones(100, dtype='float32'))
+    for cursor in range(0, len(audio_data), block_size):
+        recorder.add_recorded(audio_data[cursor:cursor + block_size])
+    recorder.close()
+    return audio_data
+
+
+def test_record_replay():
+    messages = [b'hello', b'', b'world' * 2]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'session.rec')
+        audio_data = record_session(path, messages)
+
+        params, blocks = read_recording(path)
+        blocks = list(blocks)
+        recorded = np.hstack([frames for block_type, _, frames in blocks if block_type == RECORDED])
+        played = [frames for block_type, _, frames in blocks if block_type == PLAYED]
+        if params.get_is_master() or not np.array_equal(recorded, audio_data) or len(played) != 1:
+            print('test_record_replay failed')
+            return
+
+        # replaying through an audio stream returns the captured audio
+        stream = ReplayStream(path)
+        replayed = []
+        while not stream.is_done():
+            replayed.append(stream.record())
+        if not np.array_equal(np.hstack(replayed), audio_data):
+            print('test_record_replay failed')
+            return
+
+        recv_messages, elapsed = replay_decode(path)
+        if recv_messages != messages:
+            print('test_record_replay failed')
+            print(recv_messages)
+            return
+    print(f'test_record_replay success ({elapsed:.2f} s)')
+
+
+# every setting of the decoder survives the header of a recording
+def test_parameters():
+    params = make_params(False)
+    params.set_window_length(0.05)
+    params.set_base_freq(1500.0)
+    params.set_bits_per_symbol(2)
+    params.set_preamble(Preamble.BARKER)
+    params.set_channel_spacing(0.1)
+    params.set_symbol_ramp(0.5)
+    params.set_analysis_window(AnalysisWindow.HANN)
+    params.set_gain_equalization(False)
+    params.set_squelch(False)
+    params.set_front_end(True)
+    params.set_echo_cancellation(True)
+    restored = parameters_from_dict(json.loads(json.dumps(parameters_to_dict(params))))
+
+    getters = ['get_window_length', 'get_base_freq', 'get_num_channels', 'get_is_master',
+            'get_bits_per_symbol', 'get_preamble', 'get_channel_spacing', 'get_symbol_ramp',
+            'get_analysis_window', 'get_gain_equalization', 'get_squelch', 'get_front_end',
+            'get_echo_cancellation']
+    different = [getter for getter in getters if getattr(params, getter)() != getattr(restored, getter)()]
+    if different:
+        print('test_parameters failed')
+        print(different)
+        return
+    print('test_parameters success')
+
+
+def test_bounded_size():
+    max_size = 64 * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'session.rec')
+        audio_data = record_session(path, 20 * [b'a message of some length'], max_size)
+
+        # the recording is cut off but still readable
+        _, blocks = read_recording(path)
+        recorded = np.hstack([frames for block_type, _, frames in blocks if block_type == RECORDED])
+        size = os.path.getsize(path)
+        if size > max_size or len(recorded) >= len(audio_data) or \
+                not np.array_equal(recorded, audio_data[:len(recorded)]):
+            print('test_bounded_size failed')
+            print(f'{size=} {len(recorded)=} {len(audio_data)=}')
+            return
+    print('test_bounded_size success')
+
+
+# the played frames are added by another thread than the recorded ones
+def test_threads():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'session.rec')
+        recorder = SessionRecorder(path, make_params(True))
+        played = np.random.default_rng(1).normal(0, 0.3, (200, 441)).astype('float32')
+        recorded = np.random.default_rng(2).normal(0, 0.3, (200, 441)).astype('float32')
+        thread = threading.Thread(target=lambda: [recorder.add_played(frames) for frames in played])
+        thread.start()
+        for frames in recorded:
+            recorder.add_recorded(frames)
+        thread.join()
+        recorder.close()
+
+        _, blocks = read_recording(path)
+        blocks = list(blocks)
+        played_read = [frames for block_type, _, frames in blocks if block_type == PLAYED]
+        recorded_read = [frames for block_type, _, frames in blocks if block_type == RECORDED]
+        if not np.array_equal(played_read, played) or not np.array_equal(recorded_read, recorded):
+            print('test_threads failed')
+            print(f'{len(played_read)=} {len(recorded_read)=}')
+            return
+    print('test_threads success')
+
+
+# the captured audio is recorded with the echo, the replay removes it
+def test_echo_replay():
+    params = make_params(True)
+    params.set_full_duplex(True)
+    params.set_echo_cancellation(True)
+    rng = np.random.default_rng(1)
+    played = np.hstack([MessageEncoder(params).encode(rng.bytes(12)) for _ in range(4)])
+    recorded = (0.5 * np.hstack([np.zeros(300), played[:-300]]) + rng.normal(0, 1e-4, len(played))).astype('float32')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'session.rec')
+        recorder = SessionRecorder(path, params)
+        recorder.set_echo_delay(300)
+        echo_canceller = EchoCanceller(params, 300)
+        cleaned = []
+        for cursor in range(0, len(played), 1000):
+            recorder.add_played(played[cursor:cursor + 1000])
+            recorder.add_recorded(recorded[cursor:cursor + 1000])
+            echo_canceller.add_played(played[cursor:cursor + 1000])
+            cleaned.append(echo_canceller.process(recorded[cursor:cursor + 1000]))
+        recorder.close()
+
+        _, blocks = read_recording(path)
+        raw = np.hstack([frames for block_type, _, frames in blocks if block_type == RECORDED])
+        _, blocks = read_recording(path, echo_cancellation=True)
+        replayed = np.hstack([frames for block_type, _, frames in blocks if block_type == RECORDED])
+        if not np.array_equal(raw, recorded) or not np.array_equal(replayed, np.hstack(cleaned)):
+            print('test_echo_replay failed')
+            print(f'{len(raw)=} {len(replayed)=}')
+            return
+    print('test_echo_replay success')
+
+
+if __name__ == '__main__':
+    test_record_replay()
+    test_parameters()
+    test_bounded_size()
+    test_threads()
+    test_echo_replay()
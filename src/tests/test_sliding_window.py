@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+from channel_model import ChannelParameters
+from channel_model import make_loopback
+from compression import StreamCompressor
+from sliding_window import LogicalStream
+from sliding_window import SlidingWindow
+from sliding_window import split_segments
+from transmission_parameters import TransmissionParameters
+
+
+def make_params(is_master, num_streams=1, compression=False, coalesce_delay=0.0):
+    params = TransmissionParameters()
+    params.set_num_channels(8)
+    params.set_is_master(is_master)
+    params.set_num_streams(num_streams)
+    params.set_compression(compression)
+    params.set_coalesce_delay(coalesce_delay)
+    return params
+
+
+# counts the frames played on an audio stream
+class CountingStream:
+    def __init__(self, audio_stream):
+        self.audio_stream = audio_stream
+        self.frames = 0
+
+
+    def play(self, frames):
+        self.frames += 1
+        self.audio_stream.play(frames)
+
+
+    def record(self):
+        return self.audio_stream.record()
+
+
+def test_split_segments():
+    payload = bytes([0x03]) + b'abc' + bytes([0x81]) + b'd' + bytes([0x45]) + b'ef'
+    segments = split_segments(payload)
+    if segments != [(0, b'abc'), (2, b'd')]:
+        print('test_split_segments failed')
+        print(segments)
+        return
+    print('test_split_segments success')
+
+
+# a corrupted compressed payload breaks the stream instead of raising
+def test_corrupted_payload():
+    stream = LogicalStream()
+    stream.deliver(StreamCompressor().compress(b'hello'), True)
+    stream.deliver(b'\xff\xff\xff\xff', True)
+    stream.deliver(b'world', False)
+    data = stream.recv()
+    if data != b'hello' or not stream.is_broken():
+        print('test_corrupted_payload failed')
+        print(f'{data=} {stream.is_broken()=}')
+        return
+    print('test_corrupted_payload success')
+
+
+# an interactive message overtakes bulk data that was queued before it
+def test_priority():
+    stream_master, stream_slave = make_loopback(make_params(True, 3, True), make_params(False, 3, True),
+            ChannelParameters(), speed=10.0, seed=1)
+    master = SlidingWindow(make_params(True, 3, True), stream_master)
+    slave = SlidingWindow(make_params(False, 3, True), stream_slave)
+    master.set_stream_priority(0, 1)
+
+    # random data does not compress, i.e., it takes many frames
+    bulk = np.random.default_rng(1).bytes(150)
+    interactive = b'hello\n'
+    master.send(bulk, stream=2)
+    received = [bytearray() for _ in range(3)]
+    arrival = {}
+    start = time.monotonic()
+    while time.monotonic() - start < 120:
+        master.tick()
+        slave.tick()
+        if time.monotonic() - start > 2 and not arrival:
+            arrival['queued'] = len(received[2])
+            master.send(interactive, stream=0)
+        for stream in range(3):
+            received[stream] += slave.recv(stream)
+        if 'interactive' not in arrival and len(received[0]) == len(interactive):
+            arrival['interactive'] = len(received[2])
+        if len(received[2]) >= len(bulk) and len(received[0]) >= len(interactive):
+            break
+        time.sleep(0.01)
+    master.stop()
+    slave.stop()
+
+    if bytes(received[0]) != interactive or bytes(received[2]) != bulk or received[1] or \
+            arrival.get('interactive', len(bulk)) >= len(bulk) // 2:
+        print('test_priority failed')
+        print(received)
+        print(arrival)
+        return
+    print(f'test_priority success ({arrival})')
+
+
+# a byte is written every 0.1 s, returns the number of frames the master sent
+def send_chatty(coalesce_delay):
+    stream_master, stream_slave = make_loopback(make_params(True), make_params(False),
+            ChannelParameters(), speed=10.0, seed=1)
+    stream_master = CountingStream(stream_master)
+    master = SlidingWindow(make_params(True, coalesce_delay=coalesce_delay), stream_master)
+    slave = SlidingWindow(make_params(False), stream_slave)
+
+    data = bytes(range(48))
+    written = 0
+    received = bytearray()
+    start = time.monotonic()
+    while time.monotonic() - start < 120 and len(received) < len(data):
+        while written < min(len(data), 10 * (time.monotonic() - start)):
+            master.send(data[written:written + 1])
+            written += 1
+        master.tick()
+        slave.tick()
+        received += slave.recv()
+        time.sleep(0.01)
+    master.stop()
+    slave.stop()
+    return bytes(received) == data, stream_master.frames
+
+
+def test_coalescing():
+    delivered, frames = send_chatty(0.0)
+    delivered_coalesced, frames_coalesced = send_chatty(5.0)
+    if not delivered or not delivered_coalesced or frames_coalesced >= frames:
+        print('test_coalescing failed')
+        print(f'{delivered=} {frames=} {delivered_coalesced=} {frames_coalesced=}')
+        return
+    print(f'test_coalescing success ({frames} -> {frames_coalesced} frames)')
+
+
+def test_flush():
+    stream_master, _ = make_loopback(make_params(True), make_params(False), ChannelParameters())
+    master = SlidingWindow(make_params(True, coalesce_delay=60.0), stream_master)
+
+    # the first byte is sent at once, the second waits for more data
+    master.send(b'a')
+    master.tick()
+    sent_first = master.get_send_buffer_size() == 0
+    master.send(b'b')
+    master.tick()
+    held_second = master.get_send_buffer_size() == 1
+    # the flush only applies to the data queued before, the data queued
+    # after it fills a frame and the rest waits again
+    master.flush()
+    master.send(bytes(make_params(True).get_max_payload_size() - 1))
+    master.tick()
+    held_rest = master.get_send_buffer_size() == 1
+    master.flush()
+    master.tick()
+    flushed = master.get_send_buffer_size() == 0
+    master.stop()
+
+    if not sent_first or not held_second or not held_rest or not flushed:
+        print('test_flush failed')
+        print(f'{sent_first=} {held_second=} {held_rest=} {flushed=}')
+        return
+    print('test_flush success')
+
+
+# the remainder of a full frame waits for more data again
+def test_coalescing_remainder():
+    now = [0.0]
+    stream_master, _ = make_loopback(make_params(True), make_params(False), ChannelParameters())
+    master = SlidingWindow(make_params(True, coalesce_delay=1.0), stream_master, clock=lambda: now[0])
+    frame_size = make_params(True).get_max_payload_size() - 1
+
+    master.send(b'a')
+    master.tick()
+    master.send(b'b')
+    master.tick()
+    # the second byte is due, but a frame and one byte are queued now
+    now[0] = 2.0
+    master.send(bytes(frame_size))
+    master.tick()
+    held_remainder = master.get_send_buffer_size() == 1
+    now[0] = 3.5
+    master.tick()
+    sent_remainder = master.get_send_buffer_size() == 0
+    master.stop()
+
+    if not held_remainder or not sent_remainder:
+        print('test_coalescing_remainder failed')
+        print(f'{held_remainder=} {sent_remainder=}')
+        return
+    print('test_coalescing_remainder success')
+
+
+if __name__ == '__main__':
+    test_split_segments()
+    test_corrupted_payload()
+    test_priority()
+    test_coalescing()
+    test_flush()
+    test_coalescing_remainder()
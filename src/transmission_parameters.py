@@ -9,6 +9,59 @@ class FrequencySet(enum.Enum):
     RECV = 1
 
 
+class AnalysisWindow(enum.Enum):
+    RECTANGULAR = 0
+    HANN = 1
+    BLACKMAN = 2
+
+
+class Preamble(enum.Enum):
+    # START_SEQ on every channel, detected on channel 0
+    ON_OFF = 0
+    # BARKER_SEQ on every channel, detected on the sum of all channels
+    BARKER = 1
+    # linear chirp across the band followed by CHIRP_SEQ, detected by a
+    # matched filter
+    CHIRP = 2
+
+
+START_SEQ = [0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0]
+# Barker code of length 7, a one is send as an on window
+BARKER_SEQ = [1, 1, 1, 0, 0, 1, 0]
+# the chirp is followed by an on and an off window, the reference levels of
+# every channel
+CHIRP_SEQ = [1, 0]
+# length of the chirp (windows)
+CHIRP_WINDOWS = 1
+
+# maximum payload length, the length field in the message header is 6 bits
+MAX_MESSAGE_LENGTH = 63
+# maximum number of logical streams of a link, the stream of a segment of a
+# frame is 2 bits
+MAX_STREAMS = 4
+
+
+def analysis_window(kind, size):
+    if kind == AnalysisWindow.HANN:
+        return np.hanning(size)
+    elif kind == AnalysisWindow.BLACKMAN:
+        return np.blackman(size)
+    return np.ones(size)
+
+
+# amplitude of a carrier during a symbol, the first and last ramp / 2 of the
+# window are raised cosine ramps (i.e., a Tukey window), ramp 0 keys the
+# carrier hard on and off
+def symbol_pulse(ramp, size):
+    pulse = np.ones(size)
+    ramp_size = round(ramp * size / 2)
+    if ramp_size > 0:
+        edge = 0.5 - 0.5 * np.cos(np.pi * (np.arange(ramp_size) + 0.5) / ramp_size)
+        pulse[:ramp_size] = edge
+        pulse[size - ramp_size:] = edge[::-1]
+    return pulse
+
+
 class TransmissionParameters:
     def __init__(self):
         self.__base_freq = 2000.0
@@ -18,6 +71,19 @@ class TransmissionParameters:
         self.__sample_rate = 44100
         self.__seq_max = 3
         self.__window_length = 0.1
+        self.__analysis_window = AnalysisWindow.RECTANGULAR
+        self.__gain_equalization = True
+        self.__bits_per_symbol = 1
+        self.__compression = False
+        self.__squelch = True
+        self.__front_end = False
+        self.__preamble = Preamble.ON_OFF
+        self.__echo_cancellation = False
+        self.__full_duplex = False
+        self.__channel_spacing = 0.2
+        self.__symbol_ramp = 0.0
+        self.__num_streams = 1
+        self.__coalesce_delay = 0.0
 
 
     def set_window_length(self, window_length):
@@ -40,9 +106,10 @@ class TransmissionParameters:
     def get_timeout(self):
         # estimate of a resonable timeout, assume START_SEQ len == 1 and header len == 3
         latency = 3.0
-        nchannels = self.__num_channels / 2
-        data_time_ch = self.__seq_max * 9 * (self.__max_payload_size + 3) / nchannels
-        timeout = self.__window_length * (11 + data_time_ch)
+        nchannels = self.__num_channels if self.__full_duplex else self.__num_channels / 2
+        symbols = 9 * (self.__max_payload_size + 3) / self.__bits_per_symbol
+        data_time_ch = self.__seq_max * symbols / nchannels
+        timeout = self.__window_length * (self.get_preamble_windows() + data_time_ch)
         return max(1.5 * timeout, 1.0) + latency
 
 
@@ -70,11 +137,18 @@ class TransmissionParameters:
         return self.__num_channels
 
 
+    # frequencies of all channels, i.e., of both the master and the slave
+    def get_channel_frequencies(self):
+        factor = np.arange(self.__num_channels) * self.__channel_spacing + 1.0
+        return factor * self.__base_freq
+
+
     def get_frequencies(self, freq_set):
-        factor = np.arange(self.__num_channels) * 0.2 + 1.0
-        frequencies = factor * self.__base_freq
+        frequencies = self.get_channel_frequencies()
 
-        if (self.__is_master and freq_set == FrequencySet.SEND) or \
+        if self.__full_duplex:
+            return frequencies
+        elif (self.__is_master and freq_set == FrequencySet.SEND) or \
                 (not self.__is_master and freq_set == FrequencySet.RECV):
             return frequencies[0::2]
         else:
@@ -82,19 +156,107 @@ class TransmissionParameters:
 
 
     def get_max_bps(self):
-        if self.__is_master:
+        if self.__full_duplex:
+            nchannels = self.__num_channels
+        elif self.__is_master:
             nchannels = math.ceil(self.__num_channels / 2)
         else:
             nchannels = math.floor(self.__num_channels / 2)
+        if nchannels == 0:
+            # a single channel link, the slave can not send anything
+            return 0.0
 
-        transmission_time = (11 + math.ceil(9 * (self.__max_payload_size + 3) / nchannels)) * self.__window_length
-        return 8 * (self.__max_payload_size - 1) / transmission_time
+        symbols = 9 * (self.__max_payload_size + 3) / self.__bits_per_symbol
+        transmission_time = (self.get_preamble_windows() + math.ceil(symbols / nchannels)) * self.__window_length
+        # the sliding window header and, with multiple streams, a segment header
+        overhead = 1 if self.__num_streams == 1 else 2
+        return 8 * (self.__max_payload_size - overhead) / transmission_time
 
 
     def get_window_size(self):
         return round(self.__sample_rate * self.__window_length)
 
 
+    # number of windows of a message, length is the payload length (i.e.,
+    # excluding the 3 header bytes but not the 1 sliding window byte)
+    def get_message_windows(self, length, freq_set):
+        frequencies = self.get_frequencies(freq_set)
+
+        channel_size = math.ceil(8 * (length + 3) / len(frequencies))
+        channel_size += channel_size // 8
+        channel_size = math.ceil(channel_size / self.__bits_per_symbol)
+        return self.get_preamble_windows() + channel_size
+
+
+    # on/off pattern at the end of the preamble, keyed on every channel. It
+    # provides the reference levels of the channels.
+    def get_start_seq(self):
+        if self.__preamble == Preamble.BARKER:
+            return BARKER_SEQ
+        elif self.__preamble == Preamble.CHIRP:
+            return CHIRP_SEQ
+        return START_SEQ
+
+
+    # length of the preamble (windows), including the chirp
+    def get_preamble_windows(self):
+        if self.__preamble == Preamble.CHIRP:
+            return CHIRP_WINDOWS + len(CHIRP_SEQ)
+        return len(self.get_start_seq())
+
+
+    # (low, high) frequency of the chirp, from below the lowest to above the
+    # highest frequency of the set. The chirp sweeps halfway to the next
+    # channel at both sides, such that a single channel still gets a sweep.
+    def get_chirp_band(self, freq_set):
+        frequencies = self.get_frequencies(freq_set)
+        margin = self.__channel_spacing * self.__base_freq / 2
+        low = np.min(frequencies, initial=self.__base_freq) - margin
+        high = np.max(frequencies, initial=self.__base_freq) + margin
+        return low, high
+
+
+    # linear chirp of CHIRP_WINDOWS windows across the chirp band. The master
+    # sends an up and the slave a down chirp, hence a side does not detect
+    # the echo of its own chirp.
+    def get_chirp(self, freq_set):
+        low, high = self.get_chirp_band(freq_set)
+        if self.__is_master != (freq_set == FrequencySet.SEND):
+            low, high = high, low
+        size = CHIRP_WINDOWS * self.get_window_size()
+        t = np.arange(size) / self.__sample_rate
+        rate = (high - low) / (size / self.__sample_rate)
+        return np.cos(2 * np.pi * (low * t + rate * t**2 / 2)).astype('float32')
+
+
+    # symbol_pulse of a window
+    def get_symbol_pulse(self):
+        return symbol_pulse(self.__symbol_ramp, self.get_window_size())
+
+
+    # weights of the samples of a window in the decoder, the analysis window
+    # matched to the symbol pulse
+    def get_integration_window(self):
+        window_size = self.get_window_size()
+        return analysis_window(self.__analysis_window, window_size) * self.get_symbol_pulse()
+
+
+    # windowed complex exponentials (window_size x channels), the magnitude of
+    # the product of a window of audio with a column is the Fourier
+    # coefficient of that channel
+    def get_basis(self, freq_set):
+        window_size = self.get_window_size()
+        window = self.get_integration_window()
+        t = np.arange(window_size) / self.__sample_rate
+        frequencies = self.get_frequencies(freq_set)
+        return window[:, np.newaxis] * np.exp(-2j * np.pi * np.outer(t, frequencies))
+
+
+    # immutable copy with all derived values precomputed, used by a running link
+    def snapshot(self):
+        return LinkParameters(self)
+
+
     def set_seq_max(self, seq_max):
         self.__seq_max = seq_max
 
@@ -110,3 +272,336 @@ class TransmissionParameters:
     def get_max_payload_size(self):
         return self.__max_payload_size
 
+
+    def set_analysis_window(self, analysis_window):
+        self.__analysis_window = analysis_window
+
+
+    def get_analysis_window(self):
+        return self.__analysis_window
+
+
+    def set_gain_equalization(self, gain_equalization):
+        self.__gain_equalization = gain_equalization
+
+
+    def get_gain_equalization(self):
+        return self.__gain_equalization
+
+
+    # number of bits carried by a channel per window, the amplitude of a
+    # channel takes one out of 2**bits_per_symbol levels
+    def set_bits_per_symbol(self, bits_per_symbol):
+        self.__bits_per_symbol = bits_per_symbol
+
+
+    def get_bits_per_symbol(self):
+        return self.__bits_per_symbol
+
+
+    # compress the payload if the remote side supports this as well
+    def set_compression(self, compression):
+        self.__compression = compression
+
+
+    def get_compression(self):
+        return self.__compression
+
+
+    # open the decoder only when the energy in the RECV band rises above
+    # the noise floor
+    def set_squelch(self, squelch):
+        self.__squelch = squelch
+
+
+    def get_squelch(self):
+        return self.__squelch
+
+
+    # mix the RECV band down to baseband and decimate before decoding
+    def set_front_end(self, front_end):
+        self.__front_end = front_end
+
+
+    def get_front_end(self):
+        return self.__front_end
+
+
+    # synchronization pattern in front of every message, see Preamble
+    def set_preamble(self, preamble):
+        self.__preamble = preamble
+
+
+    def get_preamble(self):
+        return self.__preamble
+
+
+    # subtract the echo of the local speaker from the recorded audio
+    def set_echo_cancellation(self, echo_cancellation):
+        self.__echo_cancellation = echo_cancellation
+
+
+    def get_echo_cancellation(self):
+        return self.__echo_cancellation
+
+
+    # both sides send on all channels at the same time, this requires echo
+    # cancellation
+    def set_full_duplex(self, full_duplex):
+        self.__full_duplex = full_duplex
+
+
+    def get_full_duplex(self):
+        return self.__full_duplex
+
+
+    # distance of adjacent channels, relative to the base frequency. Smooth
+    # symbols (see set_symbol_ramp) spill less energy into the adjacent
+    # channels and allow a smaller spacing.
+    def set_channel_spacing(self, channel_spacing):
+        self.__channel_spacing = channel_spacing
+
+
+    def get_channel_spacing(self):
+        return self.__channel_spacing
+
+
+    # fraction of a window (0 to 1) the carriers ramp on and off, see symbol_pulse
+    def set_symbol_ramp(self, symbol_ramp):
+        self.__symbol_ramp = symbol_ramp
+
+
+    def get_symbol_ramp(self):
+        return self.__symbol_ramp
+
+
+    # number of logical streams (1 to MAX_STREAMS) the sliding window
+    # multiplexes over the link, both sides have to use the same number
+    def set_num_streams(self, num_streams):
+        self.__num_streams = num_streams
+
+
+    def get_num_streams(self):
+        return self.__num_streams
+
+
+    # maximum time (s) data that does not fill a frame is held back while
+    # frames are outstanding, such that more data can be added to the frame
+    # (see SlidingWindow.flush). 0 sends the data as soon as the window allows.
+    def set_coalesce_delay(self, coalesce_delay):
+        self.__coalesce_delay = coalesce_delay
+
+
+    def get_coalesce_delay(self):
+        return self.__coalesce_delay
+
+
+# Immutable snapshot of the transmission parameters taken at link start. All
+# derived values are computed once, and changing the TransmissionParameters
+# (e.g., in the ui) does not affect the encoder, decoder and sliding window
+# of a running link. Provides the getters of TransmissionParameters.
+class LinkParameters:
+    __slots__ = ['__base_freq', '__is_master', '__max_payload_size',
+            '__num_channels', '__sample_rate', '__seq_max', '__window_length',
+            '__analysis_window', '__gain_equalization', '__bits_per_symbol',
+            '__compression', '__timeout', '__max_bps', '__window_size',
+            '__channel_frequencies', '__frequencies', '__basis',
+            '__message_windows', '__full_duplex', '__echo_cancellation',
+            '__preamble', '__start_seq', '__preamble_windows', '__chirp',
+            '__chirp_band', '__front_end', '__squelch', '__channel_spacing',
+            '__symbol_ramp', '__symbol_pulse', '__integration_window',
+            '__num_streams', '__coalesce_delay', '__frozen']
+
+    def __init__(self, params):
+        self.__base_freq = params.get_base_freq()
+        self.__is_master = params.get_is_master()
+        self.__max_payload_size = params.get_max_payload_size()
+        self.__num_channels = params.get_num_channels()
+        self.__sample_rate = params.get_sample_rate()
+        self.__seq_max = params.get_seq_max()
+        self.__window_length = params.get_window_length()
+        self.__analysis_window = params.get_analysis_window()
+        self.__gain_equalization = params.get_gain_equalization()
+        self.__bits_per_symbol = params.get_bits_per_symbol()
+        self.__compression = params.get_compression()
+        self.__squelch = params.get_squelch()
+        self.__front_end = params.get_front_end()
+        self.__preamble = params.get_preamble()
+        self.__echo_cancellation = params.get_echo_cancellation()
+        self.__full_duplex = params.get_full_duplex()
+        self.__channel_spacing = params.get_channel_spacing()
+        self.__symbol_ramp = params.get_symbol_ramp()
+        self.__num_streams = params.get_num_streams()
+        self.__coalesce_delay = params.get_coalesce_delay()
+
+        self.__timeout = params.get_timeout()
+        self.__max_bps = params.get_max_bps()
+        self.__window_size = params.get_window_size()
+        self.__start_seq = tuple(params.get_start_seq())
+        self.__preamble_windows = params.get_preamble_windows()
+        self.__channel_frequencies = self.__read_only(params.get_channel_frequencies())
+        self.__symbol_pulse = self.__read_only(params.get_symbol_pulse())
+        self.__integration_window = self.__read_only(params.get_integration_window())
+        self.__frequencies = {}
+        self.__basis = {}
+        self.__message_windows = {}
+        self.__chirp = {}
+        self.__chirp_band = {}
+        for freq_set in FrequencySet:
+            self.__frequencies[freq_set] = self.__read_only(params.get_frequencies(freq_set))
+            self.__basis[freq_set] = self.__read_only(params.get_basis(freq_set))
+            self.__chirp[freq_set] = self.__read_only(params.get_chirp(freq_set))
+            self.__chirp_band[freq_set] = params.get_chirp_band(freq_set)
+            # a single channel link does not receive (or send) anything
+            lengths = range(MAX_MESSAGE_LENGTH + 1) if len(self.__frequencies[freq_set]) > 0 else []
+            self.__message_windows[freq_set] = tuple(params.get_message_windows(length, freq_set)
+                    for length in lengths)
+        self.__frozen = True
+
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_LinkParameters__frozen', False):
+            raise AttributeError('LinkParameters can not be modified')
+        object.__setattr__(self, name, value)
+
+
+    def __read_only(self, array):
+        array = np.array(array)
+        array.setflags(write=False)
+        return array
+
+
+    def get_window_length(self):
+        return self.__window_length
+
+
+    def get_sample_rate(self):
+        return self.__sample_rate
+
+
+    def get_timeout(self):
+        return self.__timeout
+
+
+    def get_is_master(self):
+        return self.__is_master
+
+
+    def get_base_freq(self):
+        return self.__base_freq
+
+
+    def get_num_channels(self):
+        return self.__num_channels
+
+
+    def get_channel_frequencies(self):
+        return self.__channel_frequencies
+
+
+    def get_frequencies(self, freq_set):
+        return self.__frequencies[freq_set]
+
+
+    def get_max_bps(self):
+        return self.__max_bps
+
+
+    def get_window_size(self):
+        return self.__window_size
+
+
+    def get_message_windows(self, length, freq_set):
+        return self.__message_windows[freq_set][length]
+
+
+    def get_basis(self, freq_set):
+        return self.__basis[freq_set]
+
+
+    def get_seq_max(self):
+        return self.__seq_max
+
+
+    def get_max_payload_size(self):
+        return self.__max_payload_size
+
+
+    def get_analysis_window(self):
+        return self.__analysis_window
+
+
+    def get_gain_equalization(self):
+        return self.__gain_equalization
+
+
+    def get_bits_per_symbol(self):
+        return self.__bits_per_symbol
+
+
+    def get_compression(self):
+        return self.__compression
+
+
+    def get_squelch(self):
+        return self.__squelch
+
+
+    def get_front_end(self):
+        return self.__front_end
+
+
+    def get_preamble(self):
+        return self.__preamble
+
+
+    def get_start_seq(self):
+        return list(self.__start_seq)
+
+
+    def get_preamble_windows(self):
+        return self.__preamble_windows
+
+
+    def get_chirp_band(self, freq_set):
+        return self.__chirp_band[freq_set]
+
+
+    def get_chirp(self, freq_set):
+        return self.__chirp[freq_set]
+
+
+    def get_echo_cancellation(self):
+        return self.__echo_cancellation
+
+
+    def get_full_duplex(self):
+        return self.__full_duplex
+
+
+    def get_channel_spacing(self):
+        return self.__channel_spacing
+
+
+    def get_symbol_ramp(self):
+        return self.__symbol_ramp
+
+
+    def get_symbol_pulse(self):
+        return self.__symbol_pulse
+
+
+    def get_integration_window(self):
+        return self.__integration_window
+
+
+    def get_num_streams(self):
+        return self.__num_streams
+
+
+    def get_coalesce_delay(self):
+        return self.__coalesce_delay
+
+
+    def snapshot(self):
+        return self
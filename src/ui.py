@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
+import cairo
 import gi
+import numpy as np
 
 gi.require_version('Gtk', '3.0')
 gi.require_version('GLib', '2.0')
@@ -9,12 +11,40 @@ from gi.repository import GLib
 
 from transmission_parameters import FrequencySet
 from transmission_parameters import TransmissionParameters
-from sliding_window import SlidingWindow
+from link_worker import LinkWorker
+from message_protocol import SpectrumFeed
 
 MESSAGE_INPUT_ACTIVE = 'Start typing your message'
 MESSAGE_INPUT_DISABLED = 'Message input is disabled'
 MESSAGE_INPUT_SENDING = 'Sending message, input disabled'
 
+# number of windows shown by the waterfall
+WATERFALL_ROWS = 120
+# interval (ms) at which new rows are added to the waterfall
+WATERFALL_INTERVAL = 100
+# the waterfall shows the magnitudes from WATERFALL_RANGE (dB) below to
+# WATERFALL_RANGE above the decision threshold
+WATERFALL_RANGE = 20.0
+
+
+# colors (BGRx, as cairo.FORMAT_RGB24) of the magnitudes of every window
+# (rows) and channel (columns). The threshold maps to orange, black is far
+# below and white far above it. Before the first message the loudest
+# magnitude is the reference.
+def waterfall_image(magnitudes, thresholds):
+    reference = thresholds
+    if reference is None or len(reference) != magnitudes.shape[1]:
+        reference = np.max(magnitudes, initial=0.0) / 2
+    level = 20 * np.log10(np.maximum(magnitudes, 1e-12) / np.maximum(reference, 1e-12))
+    value = np.clip((level + WATERFALL_RANGE) / (2 * WATERFALL_RANGE), 0.0, 1.0)
+
+    image = np.zeros(magnitudes.shape + (4,), dtype='uint8')
+    image[:, :, 2] = 255 * np.clip(3 * value, 0.0, 1.0)
+    image[:, :, 1] = 255 * np.clip(3 * value - 1, 0.0, 1.0)
+    image[:, :, 0] = 255 * np.clip(3 * value - 2, 0.0, 1.0)
+    return image
+
+
 class MainWindow:
     def __init__(self, ui_file):
         builder = Gtk.Builder()
@@ -23,6 +53,7 @@ class MainWindow:
 
         self.__builder = builder
         self.__activate_switch  = builder.get_object('activate_switch')
+        self.__auto_tune        = builder.get_object('auto_tune')
         self.__base_frequency   = builder.get_object('base_frequency')
         self.__max_payload_size = builder.get_object('max_payload_size')
         self.__max_windows      = builder.get_object('max_windows')
@@ -36,6 +67,15 @@ class MainWindow:
         self.__timeout          = builder.get_object('timeout')
         self.__headerbar        = builder.get_object('headerbar')
         self.__message_history  = builder.get_object('message_history')
+        self.__waterfall        = builder.get_object('waterfall')
+
+        # the decoder publishes the magnitudes of the channels, the rows of
+        # the waterfall are collected by a timer on the main loop
+        self.__spectrum_feed = SpectrumFeed()
+        self.__spectrum = self.__spectrum_feed.subscribe(max_rows=WATERFALL_ROWS)
+        self.__waterfall_rows = np.zeros((WATERFALL_ROWS, 0), dtype='float32')
+        self.__thresholds = None
+        GLib.timeout_add(WATERFALL_INTERVAL, self.__update_waterfall)
 
         self.__window.show_all()
         self.__params = None
@@ -43,13 +83,16 @@ class MainWindow:
 
         self.__set_default()
 
-        self.__sliding_window = None
-        GLib.timeout_add(100, self.on_stream_tick)
+        # the link runs on its own thread, the callbacks are run on the GTK
+        # main loop by GLib.idle_add
+        self.__link_worker = None
 
         self.__partial_message = ''
+        self.__pending_messages = []
 
 
     def __enable_settings(self, state):
+        self.__auto_tune.set_sensitive(state)
         self.__base_frequency.set_sensitive(state)
         self.__max_payload_size.set_sensitive(state)
         self.__max_windows.set_sensitive(state)
@@ -78,7 +121,11 @@ class MainWindow:
         self.__enable_settings(True)
 
         self.__params = TransmissionParameters()
+        self.__auto_tune.set_active(False)
+        self.__show_parameters()
 
+
+    def __show_parameters(self):
         self.__resetting = True
         self.__base_frequency.set_value(self.__params.get_base_freq())
         self.__max_windows.set_value(self.__params.get_seq_max())
@@ -92,35 +139,95 @@ class MainWindow:
         self.__resetting = False
 
 
+    # the history is updated once per main loop iteration, with all messages
+    # added in the meantime
     def __add_message(self, msg):
+        if not self.__pending_messages:
+            GLib.idle_add(self.__flush_messages)
+        self.__pending_messages.append(msg)
+
+
+    def __flush_messages(self):
         it = self.__message_history.get_end_iter()
-        self.__message_history.insert(it, msg)
+        self.__message_history.insert(it, ''.join(self.__pending_messages))
+        self.__pending_messages = []
+        return False
+
+
+    def __start_link(self, auto_tune):
+        self.__link_worker = LinkWorker(self.__params, auto_tune, GLib.idle_add,
+                spectrum_feed=self.__spectrum_feed)
+        self.__link_worker.attach_on_probe_done(self.on_probe_done)
+        self.__link_worker.attach_on_link_started(self.on_link_started)
+        self.__link_worker.attach_on_send_complete(self.on_send_complete)
+        self.__link_worker.attach_on_data(self.on_data)
+        self.__link_worker.start()
+
+
+    def __stop_link(self):
+        if self.__link_worker:
+            self.__link_worker.stop()
+            self.__link_worker = None
+
+
+    def __update_waterfall(self):
+        rows = self.__spectrum.get_messages()
+        if rows:
+            magnitudes = np.array([magnitudes for magnitudes, _ in rows])
+            # the number of channels changes with the parameters of a link
+            if magnitudes.shape[1] != self.__waterfall_rows.shape[1]:
+                self.__waterfall_rows = np.zeros((WATERFALL_ROWS, magnitudes.shape[1]), dtype='float32')
+            self.__waterfall_rows = np.vstack([self.__waterfall_rows, magnitudes])[-WATERFALL_ROWS:]
+            self.__thresholds = rows[-1][1]
+            self.__waterfall.queue_draw()
+        return True
 
 
-    def on_send_complete(self):
+    def on_draw_waterfall(self, widget, cr):
+        cr.set_source_rgb(0.0, 0.0, 0.0)
+        cr.paint()
+        nrows, ncolumns = self.__waterfall_rows.shape
+        if ncolumns == 0:
+            return False
+
+        image = waterfall_image(self.__waterfall_rows, self.__thresholds)
+        surface = cairo.ImageSurface.create_for_data(image, cairo.FORMAT_RGB24, ncolumns, nrows, 4 * ncolumns)
+        cr.scale(widget.get_allocated_width() / ncolumns, widget.get_allocated_height() / nrows)
+        cr.set_source_surface(surface, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_NEAREST)
+        cr.paint()
+        return False
+
+
+    def on_probe_done(self, result):
+        if result is None:
+            self.__add_message('* auto tune failed, using the configured parameters\n')
+        else:
+            self.__add_message('* auto tune selected {} channels, window length {:.2f} s\n'.format(*result))
+            self.__show_parameters()
+
+
+    def on_link_started(self):
         self.__message_box.set_sensitive(True)
         self.__message_box.set_placeholder_text(MESSAGE_INPUT_ACTIVE)
 
 
-    def on_data_available(self):
-        data = self.__sliding_window.recv()
-        self.__partial_message += data.decode('ascii')
-        if self.__partial_message.endswith('\n'):
-            self.__add_message('< ' + self.__partial_message)
-            self.__partial_message = ''
-
+    def on_send_complete(self):
+        self.__message_box.set_sensitive(True)
+        self.__message_box.set_placeholder_text(MESSAGE_INPUT_ACTIVE)
 
-    def on_stream_tick(self):
-        if self.__sliding_window:
-            self.__sliding_window.tick()
 
-        return True
+    def on_data(self, data):
+        self.__partial_message += data.decode('ascii')
+        # a batch can contain multiple messages
+        lines = self.__partial_message.split('\n')
+        for line in lines[:-1]:
+            self.__add_message('< ' + line + '\n')
+        self.__partial_message = lines[-1]
 
 
     def on_destroy(self, widget):
-        if self.__sliding_window:
-            self.__sliding_window.stop()
-            self.__sliding_window = None
+        self.__stop_link()
         Gtk.main_quit()
 
 
@@ -142,13 +249,14 @@ class MainWindow:
     def on_activate(self, widget, state):
         if state:
             self.__enable_settings(False)
-            self.__sliding_window = SlidingWindow(self.__params)
-            self.__sliding_window.attach_on_send_complete(self.on_send_complete)
-            self.__sliding_window.attach_on_data_availbale(self.on_data_available)
+            # the message box is enabled once the sliding window has been
+            # started, i.e., after probing when auto tune is enabled
+            self.__message_box.set_sensitive(False)
+            self.__message_box.set_placeholder_text(MESSAGE_INPUT_DISABLED)
+            self.__start_link(self.__auto_tune.get_active())
         else:
             self.__enable_settings(True)
-            self.__sliding_window.stop()
-            self.__sliding_window = None
+            self.__stop_link()
 
 
     def on_reset(self, widget):
@@ -179,5 +287,5 @@ class MainWindow:
         self.__message_box.set_text('')
         self.__message_box.set_sensitive(False)
         self.__message_box.set_placeholder_text(MESSAGE_INPUT_SENDING)
-        self.__sliding_window.send(message.encode('ascii'))
+        self.__link_worker.send(message.encode('ascii'))
 